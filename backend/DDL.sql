@@ -3,6 +3,13 @@ EXTENSION IF NOT EXISTS vector;
 CREATE
 EXTENSION IF NOT EXISTS postgis;
 
+-- tags are stored as a normalized text[]; generated columns need an immutable way to flatten them
+CREATE
+OR REPLACE FUNCTION tags_to_text(tags TEXT[])
+RETURNS TEXT AS $$
+  SELECT COALESCE(array_to_string(tags, ' '), '');
+$$
+LANGUAGE 'sql' IMMUTABLE;
 
 CREATE TABLE IF NOT EXISTS users (
   user_id TEXT PRIMARY KEY,  
@@ -24,8 +31,8 @@ CREATE TABLE IF NOT EXISTS image_detail (
   thumbnail_url TEXT NOT NULL,
   title TEXT,
   caption TEXT,
-  tags TEXT,
-  title_caption_tags_fts_vector tsvector generated always as (to_tsvector('english', COALESCE(tags, '') || ' ' ||
+  tags TEXT[],
+  title_caption_tags_fts_vector tsvector generated always as (to_tsvector('english', tags_to_text(tags) || ' ' ||
                                                                                    COALESCE(title, '') || ' ' ||
                                                                                    COALESCE(caption, ''))) stored,
   embedding_vector VECTOR(512),
@@ -38,6 +45,27 @@ CREATE TABLE IF NOT EXISTS image_detail (
   FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
 );
 
+-- per-user facet counts (season, year, capture month, tag), kept up to date by triggers on image_detail
+CREATE TABLE IF NOT EXISTS image_facet (
+  user_id TEXT NOT NULL,
+  facet TEXT NOT NULL,
+  value TEXT NOT NULL,
+  count INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (user_id, facet, value),
+  FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+);
+
+-- per-user version of the embeddings, bumped on every insert, delete or re-embedding of the user's images,
+-- so process-local copies (vector_search.NumpyBackend) can tell they are stale. Versions come from one
+-- sequence, so they never repeat, even for a deleted and re-created user
+CREATE SEQUENCE IF NOT EXISTS image_embedding_version_seq;
+
+CREATE TABLE IF NOT EXISTS image_embedding_version (
+  user_id TEXT PRIMARY KEY,  -- no foreign key: the trigger writes it while a user's images are cascade-deleted
+  version BIGINT NOT NULL,
+  previous_version BIGINT
+);
+
 CREATE TABLE IF NOT EXISTS FileQueue (
   tmp_file_loc TEXT PRIMARY KEY,
   tag_list TEXT NOT NULL,
@@ -47,6 +75,9 @@ CREATE TABLE IF NOT EXISTS FileQueue (
   batch_id TEXT,
   is_saved_to_db BOOLEAN DEFAULT FALSE,
   is_cleaned_from_disk BOOLEAN DEFAULT FALSE,
+  claimed_by TEXT,  -- worker holding the row; the claim lapses at claimed_until
+  claimed_until TIMESTAMP,
+  batch_attempts INTEGER NOT NULL DEFAULT 0,  -- OpenAI batches that failed, expired or were cancelled with the file in them
   updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
   FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
@@ -62,16 +93,120 @@ CREATE TABLE IF NOT EXISTS BatchQueue (
   are_all_files_updated_in_db BOOLEAN DEFAULT FALSE,
   are_files_deleted_from_oai_storage BOOLEAN DEFAULT FALSE,
   is_cleaned_from_disk BOOLEAN DEFAULT FALSE,
+  claimed_by TEXT,
+  claimed_until TIMESTAMP,
+  next_check_at TIMESTAMP,  -- next status poll of a running batch; backs off as the batch gets older
   updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- title, caption and tags to sync back to Dropbox, one row per file; later updates coalesce into it
+CREATE TABLE IF NOT EXISTS DropboxWriteback (
+  user_id TEXT NOT NULL,
+  path TEXT NOT NULL,
+  title TEXT,
+  caption TEXT,
+  tags TEXT[] NOT NULL DEFAULT '{}',
+  version INTEGER NOT NULL DEFAULT 1,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  last_error TEXT,
+  next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  claimed_by TEXT,
+  claimed_until TIMESTAMP,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (user_id, path),
+  FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+);
+
+-- files the Dropbox poller failed to ingest, skipped until next_retry_at (exponential backoff per attempt)
+CREATE TABLE IF NOT EXISTS IngestFailure (
+  user_id TEXT NOT NULL,
+  path TEXT NOT NULL,
+  content_hash TEXT NOT NULL DEFAULT '',  -- a new version of the file is a new row, tried right away
+  reason TEXT,
+  attempts INTEGER NOT NULL DEFAULT 1,
+  next_retry_at TIMESTAMP NOT NULL,
+  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (user_id, path, content_hash),
+  FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+);
+
+-- work that failed for good (fatal error or out of attempts), kept for `python worker.py redrive`
+CREATE TABLE IF NOT EXISTS DeadLetter (
+  id SERIAL PRIMARY KEY,
+  kind TEXT NOT NULL,  -- upload | polled_file | batch_record | dropbox_writeback
+  key TEXT NOT NULL,
+  user_id TEXT,
+  payload JSONB NOT NULL,
+  error TEXT,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  UNIQUE (kind, key)
+);
+
+-- uploads accepted by the API (202) and processed by the worker; one job per /upload request
+CREATE TABLE IF NOT EXISTS IngestJob (
+  job_id TEXT PRIMARY KEY,
+  user_id TEXT NOT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS IngestJobFile (
+  job_id TEXT NOT NULL,
+  file_id TEXT NOT NULL,
+  user_id TEXT NOT NULL,
+  name TEXT,  -- as uploaded
+  tmp_file_loc TEXT NOT NULL,
+  tags TEXT,
+  status TEXT NOT NULL DEFAULT 'stored',  -- stored | embedded | failed; captioned is read off FileQueue
+  image_id TEXT,
+  error TEXT,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  upload_session JSONB,  -- cursor of the closed Dropbox upload session holding the file, until a worker commits it
+  content_hash TEXT,  -- Dropbox content_hash of the file
+  claimed_by TEXT,
+  claimed_until TIMESTAMP,  -- also holds back a retry
+  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (job_id, file_id),
+  FOREIGN KEY (job_id) REFERENCES IngestJob(job_id) ON DELETE CASCADE
+);
+
+-- share of each user in the background queues (batching, uploads, Dropbox writeback and sync); users
+-- without a row get FAIR_SHARE_DEFAULT_WEIGHT and FAIR_SHARE_DEFAULT_CAP (see db._fair_claim_query)
+CREATE TABLE IF NOT EXISTS TenantShare (
+  user_id TEXT PRIMARY KEY,
+  weight REAL NOT NULL DEFAULT 1 CHECK (weight > 0),
+  max_per_claim INTEGER CHECK (max_per_claim > 0),  -- NULL: no cap
+  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+);
+
+-- named singleton jobs (garbage collection, per-user Dropbox polls); held by one worker until expires_at
+CREATE TABLE IF NOT EXISTS worker_lease (
+  name TEXT PRIMARY KEY,
+  owner TEXT NOT NULL,
+  expires_at TIMESTAMP NOT NULL
+);
+
+-- read-your-writes with PG_REPLICA_DSNS: per user, a WAL position at or past their last committed write.
+-- Reads of the user only go to a replica that replayed up to it. Only read on the primary, so not WAL-logged
+CREATE UNLOGGED TABLE IF NOT EXISTS user_last_write (
+  user_id TEXT PRIMARY KEY,
+  lsn PG_LSN NOT NULL,
+  written_at TIMESTAMP NOT NULL DEFAULT now()  -- past READ_YOUR_WRITES_SECS, reads no longer wait for lsn
+);
+
 
 CREATE
 OR REPLACE FUNCTION update_fts_col()
 RETURNS TRIGGER AS $$
 BEGIN
-  NEW.title_caption_tags_fts_vector = to_tsvector('english', COALESCE(tags, '') || ' ' || COALESCE(title, '') || ' ' || COALESCE(caption, ''));
+  NEW.title_caption_tags_fts_vector = to_tsvector('english', tags_to_text(NEW.tags) || ' ' || COALESCE(NEW.title, '') || ' ' || COALESCE(NEW.caption, ''));
   RETURN NEW;
 END;
 $$
@@ -107,14 +242,200 @@ BEFORE UPDATE ON BatchQueue
 FOR EACH ROW
 EXECUTE FUNCTION update_updated_at_column();
 
+-- facet rows an image contributes to (STABLE: to_char depends on settings)
+CREATE
+OR REPLACE FUNCTION image_facet_rows(p_season TEXT, p_capture_time TIMESTAMP, p_tags TEXT[])
+RETURNS TABLE (facet TEXT, value TEXT) AS $$
+  SELECT 'season', p_season WHERE p_season IS NOT NULL
+  UNION ALL
+  SELECT 'year', to_char(p_capture_time, 'YYYY') WHERE p_capture_time IS NOT NULL
+  UNION ALL
+  SELECT 'month', to_char(p_capture_time, 'YYYY-MM') WHERE p_capture_time IS NOT NULL
+  UNION ALL
+  SELECT DISTINCT 'tag', t FROM unnest(p_tags) AS t;
+$$
+LANGUAGE 'sql' STABLE;
+
+-- statement level, so bulk writes apply one aggregated delta per facet instead of one per row
+CREATE
+OR REPLACE FUNCTION update_image_facets()
+RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    INSERT INTO image_facet (user_id, facet, value, count)
+    SELECT n.user_id, r.facet, r.value, count(*)
+    FROM new_rows n, image_facet_rows(n.season, n.capture_time, n.tags) r
+    GROUP BY 1, 2, 3
+    ON CONFLICT (user_id, facet, value) DO UPDATE SET count = image_facet.count + EXCLUDED.count;
+  ELSIF TG_OP = 'UPDATE' THEN
+    INSERT INTO image_facet (user_id, facet, value, count)
+    SELECT user_id, facet, value, sum(delta)
+    FROM (
+      SELECT n.user_id, r.facet, r.value, 1 AS delta
+      FROM new_rows n, image_facet_rows(n.season, n.capture_time, n.tags) r
+      UNION ALL
+      SELECT o.user_id, r.facet, r.value, -1 AS delta
+      FROM old_rows o, image_facet_rows(o.season, o.capture_time, o.tags) r
+    ) AS changes
+    GROUP BY 1, 2, 3
+    HAVING sum(delta) <> 0
+    ON CONFLICT (user_id, facet, value) DO UPDATE SET count = image_facet.count + EXCLUDED.count;
+    DELETE FROM image_facet WHERE count <= 0 AND user_id IN (SELECT user_id FROM old_rows);
+  ELSIF TG_OP = 'DELETE' THEN
+    UPDATE image_facet f SET count = f.count - removed.n
+    FROM (
+      SELECT o.user_id, r.facet, r.value, count(*) AS n
+      FROM old_rows o, image_facet_rows(o.season, o.capture_time, o.tags) r
+      GROUP BY 1, 2, 3
+    ) AS removed
+    WHERE f.user_id = removed.user_id AND f.facet = removed.facet AND f.value = removed.value;
+    DELETE FROM image_facet WHERE count <= 0 AND user_id IN (SELECT user_id FROM old_rows);
+  END IF;
+  RETURN NULL;
+END;
+$$
+LANGUAGE 'plpgsql';
+
+CREATE TRIGGER image_facet_insert_trigger
+AFTER INSERT ON image_detail
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_image_facets();
+
+CREATE TRIGGER image_facet_update_trigger
+AFTER UPDATE ON image_detail
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_image_facets();
+
+CREATE TRIGGER image_facet_delete_trigger
+AFTER DELETE ON image_detail
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_image_facets();
+
+-- statement level: one new version per user and statement; an update only counts if the embedding changed
+CREATE
+OR REPLACE FUNCTION bump_embedding_version()
+RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_OP = 'UPDATE' THEN
+    INSERT INTO image_embedding_version (user_id, version)
+    SELECT u.user_id, nextval('image_embedding_version_seq')
+    FROM (
+      SELECT n.user_id FROM new_rows n JOIN old_rows o ON o.uuid = n.uuid
+      WHERE n.embedding_vector IS DISTINCT FROM o.embedding_vector
+      GROUP BY n.user_id
+    ) AS u
+    ON CONFLICT (user_id) DO UPDATE SET
+      previous_version = image_embedding_version.version, version = EXCLUDED.version;
+  ELSE
+    INSERT INTO image_embedding_version (user_id, version)
+    SELECT u.user_id, nextval('image_embedding_version_seq')
+    FROM (SELECT user_id FROM changed_rows GROUP BY user_id) AS u
+    ON CONFLICT (user_id) DO UPDATE SET
+      previous_version = image_embedding_version.version, version = EXCLUDED.version;
+  END IF;
+  RETURN NULL;
+END;
+$$
+LANGUAGE 'plpgsql';
+
+CREATE TRIGGER embedding_version_insert_trigger
+AFTER INSERT ON image_detail
+REFERENCING NEW TABLE AS changed_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION bump_embedding_version();
+
+CREATE TRIGGER embedding_version_update_trigger
+AFTER UPDATE ON image_detail
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION bump_embedding_version();
+
+CREATE TRIGGER embedding_version_delete_trigger
+AFTER DELETE ON image_detail
+REFERENCING OLD TABLE AS changed_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION bump_embedding_version();
+
+-- queue events: workers LISTEN on these channels instead of polling
+CREATE
+OR REPLACE FUNCTION notify_channel()
+RETURNS TRIGGER AS $$
+BEGIN
+  PERFORM pg_notify(TG_ARGV[0], '');
+  RETURN NULL;
+END;
+$$
+LANGUAGE 'plpgsql';
+
+CREATE TRIGGER filequeue_new_notify_trigger
+AFTER INSERT ON FileQueue
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_channel('filequeue_new');
+
+CREATE TRIGGER batchqueue_new_notify_trigger
+AFTER INSERT ON BatchQueue
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_channel('batchqueue_new');
+
+CREATE TRIGGER batchqueue_finalized_notify_trigger
+AFTER UPDATE ON BatchQueue
+FOR EACH ROW
+WHEN (NEW.are_all_files_updated_in_db AND NOT OLD.are_all_files_updated_in_db)
+EXECUTE FUNCTION notify_channel('batchqueue_finalized');
+
+CREATE TRIGGER users_new_notify_trigger
+AFTER INSERT ON users
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_channel('users_new');
+
+CREATE TRIGGER dropboxwriteback_new_notify_trigger
+AFTER INSERT OR UPDATE OF version ON DropboxWriteback
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_channel('dropboxwriteback_new');
+
+CREATE TRIGGER ingestjobfile_new_notify_trigger
+AFTER INSERT ON IngestJobFile
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_channel('ingestjobfile_new');
+
 -- CREATE TRIGGER update_updated_at
     -- BEFORE UPDATE
     -- ON image_detail
     -- FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
 
+-- Index creation for claiming unbatched files in order
+CREATE INDEX IF NOT EXISTS idx_filequeue_unbatched ON FileQueue (created_at) WHERE batch_id IS NULL AND is_saved_to_db = FALSE;
+
+-- Index creation for claiming uploaded files to process
+CREATE INDEX IF NOT EXISTS idx_ingestjobfile_stored ON IngestJobFile (created_at) WHERE status = 'stored';
+
+-- Index creation for numbering each user's unbatched files in fair-share claims
+CREATE INDEX IF NOT EXISTS idx_filequeue_unbatched_user ON FileQueue (user_id, created_at) WHERE batch_id IS NULL AND is_saved_to_db = FALSE;
+
+-- Index creation for claiming due Dropbox writebacks
+CREATE INDEX IF NOT EXISTS idx_dropboxwriteback_due ON DropboxWriteback (next_attempt_at);
+
+-- Index creation for reading each user's first uploads and due writebacks in fair-share claims
+CREATE INDEX IF NOT EXISTS idx_ingestjobfile_stored_user ON IngestJobFile (user_id, created_at) WHERE status = 'stored';
+CREATE INDEX IF NOT EXISTS idx_dropboxwriteback_due_user ON DropboxWriteback (user_id, next_attempt_at);
+
+-- Index creation for the Dropbox poller's "already ingested?" check of a listing page
+CREATE INDEX IF NOT EXISTS idx_image_detail_user_url ON image_detail (user_id, url);
+
+-- Index creation for finding failed files due for a retry
+CREATE INDEX IF NOT EXISTS idx_ingestfailure_due ON IngestFailure (user_id, next_retry_at);
+
 -- Index creation for searching on coordinates
 CREATE INDEX IF NOT EXISTS idx_image_detail_coordinates ON image_detail USING GIST (coordinates);
 
+-- Index creation for exact tag filtering (tags @> / && lookups)
+CREATE INDEX IF NOT EXISTS idx_image_detail_tags ON image_detail USING GIN (tags);
+
 -- Index creation for searching on the embedding vector
 -- This assumes the use of the pgvector extension or a similar extension
-CREATE INDEX IF NOT EXISTS idx_image_detail_embedding ON image_detail USING hnsw (embedding_vector vector_ip_ops);
+-- m and ef_construction come from HNSW_M / HNSW_EF_CONSTRUCTION (see db.create_tables)
+CREATE INDEX IF NOT EXISTS idx_image_detail_embedding ON image_detail USING hnsw (embedding_vector vector_ip_ops)
+WITH (m = %(hnsw_m)s, ef_construction = %(hnsw_ef_construction)s);
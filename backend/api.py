@@ -1,35 +1,30 @@
+import asyncio
 import imghdr
 import json
-import openai
 import os
-import PIL
 import requests
-import threading
 import time
-import traceback
 import uuid
-from datetime import datetime, timedelta
-from queue import Queue
 from typing import List
 from urllib.parse import urlencode
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Query
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.responses import HTMLResponse, RedirectResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import HTMLResponse, RedirectResponse, StreamingResponse
 from starlette.requests import Request
 from starlette.middleware.sessions import SessionMiddleware
 
 import data_models
 import db
+import dropbox_client
+import ingest
 import process as image_processor
 import search as search_expander  # expands query into additional filters
-import structured_llm_output
 
 app = FastAPI(root_path="/api/v1")
-BATCH_WINDOW_TIME_SECS = int(os.environ.get("BATCH_WINDOW_TIME_SECS", 4 * 3600))
-POLL_WINDOW_TIME_SECS = int(os.environ.get("POLL_WINDOW_TIME_SECS", 4 * 3600))
-GARBAGE_COLLECTION_TIME_SECS = int(os.environ.get("GARBAGE_COLLECTION_TIME_SECS", 4 * 3600))
-IGNORE_FILES = set()
+# background processing lives in worker.py; set to 1 to also run it inside the API process (single-node setups)
+RUN_WORKER_IN_API = os.environ.get("RUN_WORKER_IN_API", "0") == "1"
 
 
 app.add_middleware(SessionMiddleware, secret_key=os.environ["FASTAPI_SESSION_SECRET_KEY"])
@@ -56,7 +51,6 @@ db.check_and_create_tables()
 
 # DROPBOX Setup
 AUTH_URI = "https://www.dropbox.com/oauth2/authorize"
-TOKEN_URI = "https://api.dropboxapi.com/oauth2/token"
 CLIENT_URL = os.environ["WEBPAGE_URL"]
 
 
@@ -78,33 +72,21 @@ async def auth_dropbox_callback(request: Request):
     auth_code = request.query_params["code"]
     redirect_uri = CLIENT_URL + '/api/v1/auth/dropbox/callback'
     try:
-        token_data = {
-            "code": auth_code,
-            "grant_type": "authorization_code",
-            "client_id": os.environ["DROPBOX_CLIENT_ID"],
-            "client_secret": os.environ["DROPBOX_CLIENT_SECRET"],
-            "redirect_uri": redirect_uri,
-        }
-        token_response = requests.post(TOKEN_URI, data=token_data)
-        token_response_data = token_response.json()
+        token_response_data = dropbox_client.exchange_code(auth_code, redirect_uri)
 
         access_token = token_response_data["access_token"]
         print("Access Token:", access_token)
         refresh_token = token_response_data.get("refresh_token")
 
         # Fetch user information
-        user_info_response = requests.post(
-            "https://api.dropboxapi.com/2/users/get_current_account",
-            headers={"Authorization": f"Bearer {access_token}"},
-        )
-        user_info = user_info_response.json()
+        user_info = dropbox_client.rpc("users/get_current_account", access_token=access_token)
         print(user_info)
 
         # create folder
         create_dropbox_folder(access_token, "/Apps/PixQuery/images")
         template_id = create_dropbox_template(access_token)
         # check if user exists in DB
-        user = db.read_user(user_info["account_id"])
+        user = db.read_user(user_info["account_id"], on_primary=True)
         # if no: create one and add to db
         if user is None:
             db.create_user(
@@ -125,6 +107,7 @@ async def auth_dropbox_callback(request: Request):
             user.initials = user_info['name']['abbreviated_name'][:2]
             db.update_user(user.user_id, user)
 
+        dropbox_client.remember_token(user_info["account_id"], access_token, token_response_data.get("expires_in"))
         request.session["user"] = {
             "name": user_info["name"]["display_name"],
             "initials": user_info["name"]["abbreviated_name"],
@@ -154,6 +137,12 @@ async def profile(request: Request):
 # ===
 # Upload Endpoint
 # ===
+# upload progress events: how often the job is checked, and the longest silence before a keepalive
+UPLOAD_EVENTS_POLL_SECS = float(os.environ.get("UPLOAD_EVENTS_POLL_SECS", 2))
+SSE_KEEPALIVE_SECS = 15
+INGEST_DONE_STATUSES = ("captioned", "failed")
+
+
 # Helper function to validate image file types
 def validate_image(file: UploadFile):
     valid_image_formats = {"jpeg", "png", "gif", "bmp", "jpg"}
@@ -165,84 +154,100 @@ def validate_image(file: UploadFile):
     return file_type
 
 
-@app.post("/upload")
+@app.post("/upload", status_code=202)
 async def upload_images(request: Request, files: List[UploadFile] = File(...), tags: str | None = Form(...)) -> dict:
+    """
+    Stages the files in Dropbox upload sessions and queues them for the worker, which may run on any node;
+    processing is followed with GET /upload/{job_id} or its server-sent events at /upload/{job_id}/events.
+    """
     user = request.session.get("user")
     if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
-    access_token = user["access_token"]
     account_id = user["account_id"]
+    job_id = str(uuid.uuid4())
     uploaded_files: List[dict] = []
+    job_files: List[data_models.IngestJobFile] = []
     for file in files:
         file_type: str = validate_image(file)
         file_id: str = str(uuid.uuid4())
         uploaded_files.append({"file_id": file_id, "name": file.filename, "type": file_type, "tags": tags})
-        # store the img in /tmp dir
-        file_location = os.path.join("/tmp", account_id, f"{file_id}.{file_type}")  # Download to the folder
-        os.makedirs(os.path.dirname(file_location), exist_ok=True)
-        with open(file_location, "wb") as buffer:
-            buffer.write(await file.read())
-
-        iid = insert_image_details_in_db(file_location, access_token, account_id)
-        db.create_file_queue(data_models.FileQueue(file_location, tags, access_token, account_id, iid))
-
-    return {"uploaded_files": uploaded_files}
-
-def insert_image_details_in_db(file_location: str, access_token: str, account_id: str) -> str:
-    # upload to dropbox
-    dropbox_destination_path = "/Apps/PixQuery/images/" + os.path.basename(file_location)
-    _ = upload_to_dropbox(access_token, file_location, dropbox_destination_path, account_id)
-    url = f"https://www.dropbox.com/home/Apps/PixQuery/images?preview={os.path.basename(file_location)}"
-    thumbnail_url = image_processor.get_thumbnail(file_location)
-    # extract metadata
-    print("Extracting metadata from image ...")
-    img_metadata = image_processor.extract_image_metadata(file_location)
-    coords = None
-    capture_time_str = None
-    season = None
-    if img_metadata:
-        lat = img_metadata.get("latitude", None)
-        long = img_metadata.get("longitude", None)
-        if lat is not None and long is not None:
-            coords = [lat, long]
-
-        capture_time = img_metadata["capture_date"]
-        if capture_time is not None:
-            capture_time = datetime.strptime(capture_time, "%Y:%m:%d %H:%M:%S")
-            capture_time_str = capture_time.strftime("%d/%m/%Y")
-            # based on month get season as either summer, fall, winter, spring
-            month = capture_time.month
-            if month in [12, 1, 2]:
-                season = "winter"
-            elif month in [3, 4, 5]:
-                season = "spring"
-            elif month in [6, 7, 8]:
-                season = "summer"
-            else:
-                season = "fall"
-    # embed image
-    print("Getting image embeddings ...")
-    while True:
-        embedding_vector = image_processor.get_image_embedding(file_location)
-        if embedding_vector is None:
-            print("get image embedding returned None")
-            continue
-        break
-    # save to db
-    iid = db.insert(
-        url=url,
-        thumbnail_url=thumbnail_url,
-        title=None,
-        caption=None,
-        tags=None,
-        embedded_vector=embedding_vector,
-        coordinates=coords,
-        capture_time=capture_time_str,
-        extended_meta=json.dumps(img_metadata) if img_metadata else None,
-        season=season,
-        user_id=account_id,
-    )
-    return iid  # image uuid in db
+        try:
+            cursor, content_hash = await run_in_threadpool(ingest.upload_session, file.file, account_id)
+        except dropbox_client.DropboxError as e:
+            print(f"Could not stage {file.filename} in Dropbox:", e)
+            raise HTTPException(status_code=502, detail="Could not store the upload in Dropbox")
+        # the worker downloads it there from Dropbox, once the session is committed
+        file_location = os.path.join("/tmp", account_id, f"{file_id}.{file_type}")
+        job_files.append(
+            data_models.IngestJobFile(
+                job_id, file_id, account_id, file.filename, file_location, tags,
+                upload_session=cursor, content_hash=content_hash,
+            )
+        )
+    await run_in_threadpool(db.create_ingest_job, job_id, account_id, job_files)
+
+    return {
+        "job_id": job_id,
+        "uploaded_files": uploaded_files,
+        "status_url": f"/upload/{job_id}",
+        "events_url": f"/upload/{job_id}/events",
+    }
+
+
+def ingest_job_progress(job_files: List[data_models.IngestJobFile]) -> dict:
+    return {
+        "files": [
+            {"file_id": f.file_id, "name": f.name, "status": f.status, "image_id": f.image_id, "error": f.error}
+            for f in job_files
+        ],
+        "done": all(f.status in INGEST_DONE_STATUSES for f in job_files),
+    }
+
+
+@app.get("/upload/{job_id}")
+async def upload_status(request: Request, job_id: str) -> dict:
+    user = request.session.get("user")
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    job_files = db.get_ingest_job(job_id, user["account_id"])
+    if job_files is None:
+        raise HTTPException(status_code=404, detail="Unknown upload job")
+    return {"job_id": job_id, **ingest_job_progress(job_files)}
+
+
+@app.get("/upload/{job_id}/events")
+async def upload_events(request: Request, job_id: str):
+    """
+    Server-sent events: a "progress" event with the file whenever a file's status changes (stored, embedded,
+    captioned, failed), then "done" once every file is captioned or failed.
+    """
+    user = request.session.get("user")
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    account_id = user["account_id"]
+    if db.get_ingest_job(job_id, account_id) is None:
+        raise HTTPException(status_code=404, detail="Unknown upload job")
+
+    async def events():
+        sent: dict[str, str] = {}
+        last_event_at = time.monotonic()
+        while not await request.is_disconnected():
+            job_files = await run_in_threadpool(db.get_ingest_job, job_id, account_id) or []
+            progress = ingest_job_progress(job_files)
+            for f in progress["files"]:
+                if sent.get(f["file_id"]) != f["status"]:
+                    sent[f["file_id"]] = f["status"]
+                    last_event_at = time.monotonic()
+                    yield f"event: progress\ndata: {json.dumps(f)}\n\n"
+            if progress["done"]:
+                yield f"event: done\ndata: {json.dumps({'job_id': job_id})}\n\n"
+                return
+            if time.monotonic() - last_event_at > SSE_KEEPALIVE_SECS:
+                last_event_at = time.monotonic()
+                yield ": keepalive\n\n"  # keeps proxies from closing an idle stream
+            await asyncio.sleep(UPLOAD_EVENTS_POLL_SECS)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 # ===
 # Search Endpoint
@@ -258,76 +263,180 @@ def get_coordinates(location):
     return None, None
 
 
+def format_search_results(results: list[data_models.ImageDetailResult] | None) -> list[dict]:
+    if results is None:
+        return []
+    return [
+        dict(
+            url=x.url,
+            thumbnail_url=x.thumbnail_url,
+            title=x.title,
+            caption=x.caption,
+            tags=x.tags,
+            season=x.season,
+            uuid=x.uuid,
+        )
+        for x in results
+    ]
+
+
+def run_search(account_id: str, query: str | None, tags: List[str] | None, tag_mode: str, ef_search: int | None = None):
+    if not query and tags:
+        # exact tag filter without a text query
+        return db.get_images_by_tags(account_id, tags, tag_mode, match_count=50)
+    if not query:
+        return None
+
+    #search_args = search_expander.get_search_args(query)
+
+    # geo args
+    #if search_args.location is not None:
+    #    coords = get_coordinates(search_args.location)
+    #    distance_radius = 25_000  # 25km
+    #else:
+    #    coords = None
+    #    distance_radius = None
+
+    coords = None
+    distance_radius = None
+
+    start_time = time.monotonic()
+    query_embedding = image_processor.get_text_embedding(query)
+    query_gen_end_time = time.monotonic()
+    results = db.get_search_query_result(
+        query,
+        query_embedding,
+        account_id,
+        None,
+        tags,
+        None,
+        None,
+        None,
+        None,
+        match_count=50,
+        tag_mode=tag_mode,
+        ef_search=ef_search,
+    )
+    results_gen_end_time = time.monotonic()
+    print(f'Query Generation took: {(query_gen_end_time - start_time) * 1e3} ms')
+    print(f'Searching in DB took: {(results_gen_end_time - query_gen_end_time) * 1e3} ms')
+    return results
+
+
 @app.get("/search")
-async def search_files(request: Request, q: str = None):
+async def search_files(
+    request: Request,
+    q: str = None,
+    tags: List[str] | None = Query(None),
+    tag_mode: str = Query("any", pattern="^(any|all)$"),
+    ef_search: int | None = Query(None, ge=1, le=1000),
+):
+    user = request.session.get("user")
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    print("query:", q)
+    results = run_search(user["account_id"], q, tags, tag_mode, ef_search)
+    return {"results": format_search_results(results)}
+
+
+# ===
+# Facets Endpoint
+# ===
+@app.get("/facets")
+async def get_facets(
+    request: Request,
+    q: str = None,
+    tags: List[str] | None = Query(None),
+    tag_mode: str = Query("any", pattern="^(any|all)$"),
+    date_from: str | None = None,
+    date_to: str | None = None,
+    min_lon: float | None = Query(None, ge=-180, le=180),
+    min_lat: float | None = Query(None, ge=-90, le=90),
+    max_lon: float | None = Query(None, ge=-180, le=180),
+    max_lat: float | None = Query(None, ge=-90, le=90),
+    tag_limit: int = Query(50, ge=1, le=500),
+):
+    """
+    Filter chip counts for season, year and tag, plus a capture-time histogram (per month).
+    Without filters they are read from the precomputed image_facet table; with an active search
+    (q, tags, a capture date range and/or a bounding box) they are counted over every matching image.
+    """
     user = request.session.get("user")
     if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
 
-    query = q
-    print("query:", query)
-    if query:
-        #search_args = search_expander.get_search_args(query)
-
-        # geo args
-        #if search_args.location is not None:
-        #    coords = get_coordinates(search_args.location)
-        #    distance_radius = 25_000  # 25km
-        #else:
-        #    coords = None
-        #    distance_radius = None
-
-        coords = None
-        distance_radius = None
-
-        start_time = time.monotonic()
-        query_embedding = image_processor.get_text_embedding(query)
-        query_gen_end_time = time.monotonic()
-        results = db.get_search_query_result(
-            query,
-            query_embedding,
-            user["account_id"],
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            match_count=50,
+    bbox = (min_lon, min_lat, max_lon, max_lat)
+    if any(x is None for x in bbox):
+        if any(x is not None for x in bbox):
+            raise HTTPException(status_code=400, detail="Incomplete bounding box")
+        bbox = None
+    elif min_lat > max_lat:
+        raise HTTPException(status_code=400, detail="Invalid bounding box")
+    if q or tags or date_from or date_to or bbox:
+        facets = db.get_facets_for_search(
+            user["account_id"], q, tags, tag_mode, date_from, date_to, bbox, tag_limit=tag_limit
         )
-        results_gen_end_time = time.monotonic()
-        print(f'Query Generation took: {(query_gen_end_time - start_time) * 1e3} ms')
-        print(f'Searching in DB took: {(results_gen_end_time - query_gen_end_time) * 1e3} ms')
-
-        if results is not None:
-            results = [
-                dict(
-                    url=x.url,
-                    thumbnail_url=x.thumbnail_url,
-                    title=x.title,
-                    caption=x.caption,
-                    tags=x.tags.split(",") if x.tags else None,
-                    season=x.season,
-                    uuid=x.uuid,
-                )
-                for x in results
-            ]
-        else:
-            results = []
-        return {"results": results}
     else:
-        return {"results": []}
+        facets = db.get_facets(user["account_id"], tag_limit)
+
+    def as_counts(values: list[tuple[str, int]]) -> list[dict]:
+        return [{"value": value, "count": count} for value, count in values]
+
+    return {
+        "season": as_counts(sorted(facets["season"], key=lambda x: -x[1])),
+        "year": as_counts(sorted(facets["year"], reverse=True)),
+        "tag": as_counts(sorted(facets["tag"], key=lambda x: (-x[1], x[0]))),
+        "capture_time_histogram": as_counts(sorted(facets["month"])),
+    }
+
+
+# ===
+# Map Endpoint
+# ===
+@app.get("/map")
+async def get_map(
+    request: Request,
+    min_lon: float = Query(..., ge=-180, le=180),
+    min_lat: float = Query(..., ge=-90, le=90),
+    max_lon: float = Query(..., ge=-180, le=180),
+    max_lat: float = Query(..., ge=-90, le=90),
+    zoom: int = Query(..., ge=0, le=22),
+):
+    """
+    Server-side clusters of geotagged images for the visible bounding box at the given zoom level.
+    min_lon > max_lon is a box crossing the antimeridian.
+    """
+    user = request.session.get("user")
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if min_lat > max_lat:
+        raise HTTPException(status_code=400, detail="Invalid bounding box")
+
+    clusters = db.get_map_clusters(user["account_id"], min_lon, min_lat, max_lon, max_lat, zoom)
+    return {
+        "clusters": [
+            dict(
+                longitude=x.longitude,
+                latitude=x.latitude,
+                count=x.count,
+                uuid=x.uuid,
+                thumbnail_url=x.thumbnail_url,
+            )
+            for x in clusters
+        ]
+    }
 
 
 # ===
 # Utils
 # ===
 def create_dropbox_folder(access_token, folder_path):
-    url = "https://api.dropboxapi.com/2/files/create_folder_v2"
-    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
     data = {"path": folder_path, "autorename": False}
     try:
-        response = requests.post(url, headers=headers, json=data)
+        response = dropbox_client.request(
+            f"{dropbox_client.API_URL}/files/create_folder_v2", access_token=access_token, payload=data
+        )
 
         if response.status_code == 200:
             return "Folder created successfully."
@@ -335,19 +444,11 @@ def create_dropbox_folder(access_token, folder_path):
             return "Folder already exists. No action taken."
         else:
             response.raise_for_status()
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, dropbox_client.DropboxError) as e:
         print(f"Error creating folder: {str(e)}")
 
 
 def create_dropbox_template(access_token):
-    # API endpoints
-    add_template_url = "https://api.dropboxapi.com/2/file_properties/templates/add_for_user"
-    list_templates_url = "https://api.dropboxapi.com/2/file_properties/templates/list_for_user"
-
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-    }
-
     # Template data
     template_data = {
         "description": "These properties describe the images in the folder.",
@@ -359,16 +460,11 @@ def create_dropbox_template(access_token):
     }
 
     # Check if template already exists
-    response = requests.post(list_templates_url, headers=headers)
-    response.raise_for_status()
-    existing_templates = response.json().get("template_ids", [])
-
-    for template_id in existing_templates:
-        template_info_url = f"https://api.dropboxapi.com/2/file_properties/templates/get_for_user"
-        template_info_data = {"template_id": template_id}
-        template_info_response = requests.post(template_info_url, headers=headers, json=template_info_data)
-        template_info_response.raise_for_status()
-        template_info = template_info_response.json()
+    existing_templates = dropbox_client.rpc("file_properties/templates/list_for_user", access_token=access_token)
+    for template_id in existing_templates.get("template_ids", []):
+        template_info = dropbox_client.rpc(
+            "file_properties/templates/get_for_user", {"template_id": template_id}, access_token=access_token
+        )
 
         if (
             template_info["name"] == template_data["name"]
@@ -378,9 +474,8 @@ def create_dropbox_template(access_token):
             return template_id
 
     # If template doesn't exist, create it
-    response = requests.post(add_template_url, headers=headers, json=template_data)
-    response.raise_for_status()
-    return response.json()["template_id"]
+    response = dropbox_client.rpc("file_properties/templates/add_for_user", template_data, access_token=access_token)
+    return response["template_id"]
 
 
 # ===
@@ -389,451 +484,21 @@ def create_dropbox_template(access_token):
 
 
 @app.put("/tag/{file_id}")
-async def update_tags(file_id: str, tags: List[str]):
-    db.update_tags(file_id, ",".join(tags))
+async def update_tags(request: Request, file_id: str, tags: List[str]):
+    user = request.session.get("user")
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if not db.update_tags(file_id, user["account_id"], tags):
+        raise HTTPException(status_code=404, detail="Unknown image")
     return {"message": "Tags updated successfully", "file_id": file_id, "tags": tags}
 
 
-# ===
-# Submit Batch Job to OAI
-# ===
-def file_processor():
-    while True:
-        try:
-            unbatched_files = db.get_unbatched_files()
-            if unbatched_files is not None:
-                if len(unbatched_files) >= 50 or (
-                    datetime.utcnow() - unbatched_files[0].created_at > timedelta(seconds=BATCH_WINDOW_TIME_SECS)
-                ):
-                    try:
-                        files_list = [
-                            (
-                                x.tmp_file_loc,
-                                [y.strip() for y in x.tag_list.split(",") if y.strip()],
-                                x.access_token,
-                                x.user_id,
-                                x.image_id,
-                            )
-                            for x in unbatched_files
-                        ]
-                        res = image_processor.process_batch(files_list)
-                        print("process_batch_outuput:", res)
-                        db.create_batch_queue(data_models.BatchQueue(*res))
-                        print(f"Submitted job with id: {res[0]} to OpenAI")
-
-                        for x in unbatched_files:
-                            x.batch_id = res[0]
-                            db.update_file_queue(x.tmp_file_loc, x)
-                    except Exception as e:
-                        print(e)
-                    finally:
-                        files_list = []
-        except Exception as e:
-            print("Error in file_processor:", e)
-            print(traceback.format_exc())
-        finally:
-            time.sleep(60)
-
-
-# ===
-# Image Processing
-# ===
-def upload_to_dropbox(access_token, file_path, dropbox_path, user_id):
-    url = "https://content.dropboxapi.com/2/files/upload"
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Dropbox-API-Arg": json.dumps(
-            {"path": dropbox_path, "mode": "add", "autorename": False, "mute": False, "strict_conflict": False}
-        ),
-        "Content-Type": "application/octet-stream",
-    }
-    # Open the local file in binary mode to send it in the request
-    with open(file_path, "rb") as file:
-        response = requests.post(url, headers=headers, data=file)
-        if response.status_code == 401:
-            user = db.read_user(user_id)
-            user.acces_token = refresh_access_token(user.refresh_token)
-            db.update_user(user.user_id, user)
-            headers['Authorization'] = f"Bearer {user.access_token}"
-            response = requests.post(url, headers=headers, data=file)
-    return response.json() if response.status_code == 200 else {"error": response.text}
-
-
-def add_tag_to_dropbox_file(access_token: str, path: str, tag_text: str, user_id: str) -> None:
-    url: str = "https://api.dropboxapi.com/2/files/tags/add"
-    headers: dict = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-    data: dict = {"path": path, "tag_text": tag_text}
-
-    response: requests.Response = requests.post(url, headers=headers, data=json.dumps(data))
-    if response.status_code == 401:
-        user = db.read_user(user_id)
-        user.acces_token = refresh_access_token(user.refresh_token)
-        db.update_user(user.user_id, user)
-        headers['Authorization'] = f"Bearer {user.access_token}"
-        response: requests.Response = requests.post(url, headers=headers, data=json.dumps(data))
-    if response.status_code == 200:
-        print("Tag added successfully.")
-    else:
-        print(f"Error occurred: {response.status_code}, {response.text}")
+if RUN_WORKER_IN_API:
+    import worker
 
-
-def process_file(
-    file_path: str, tags_list: list[str], access_token: str, img_details: dict[str, str | list[str]], account_id: str, image_id: str
-):
-    dropbox_destination_path = "/Apps/PixQuery/images/" + os.path.basename(file_path)
-    #response = upload_to_dropbox(access_token, file_path, dropbox_destination_path)
-    #print(response)
-    #url = f"https://www.dropbox.com/home/Apps/PixQuery/images?preview={os.path.basename(file_path)}"
-    #thumbnail_url = image_processor.get_thumbnail(file_path)
-
-    print("Getting title, caption, and tags ...")
-    title = img_details["title"]
-    caption = img_details["image_description"]
-    final_tags_list = tags_list + img_details["tags"]
-    tags = ",".join(final_tags_list)
-    # push tags to dropbox
-    for t in final_tags_list:
-        add_tag_to_dropbox_file(access_token, dropbox_destination_path, t.replace(" ", "_"), account_id)
-    # get template id for curr user
-    user = db.read_user(account_id)
-    template_id = user.template_id
-    # push title and caption property for that image to dropbox
-    payload_data = {
-        "path": dropbox_destination_path,
-        "property_groups": [
-            {
-                "fields": [{"name": "Title", "value": title}, {"name": "Caption", "value": caption}],
-                "template_id": template_id,
-            }
-        ],
-    }
-    res = requests.post(
-        "https://api.dropboxapi.com/2/file_properties/properties/add",
-        json=payload_data,
-        headers={"Authorization": f"Bearer {access_token}"},
-    )
-    if res.status_code == 401:
-        user = db.read_user(account_id)
-        user.acces_token = refresh_access_token(user.refresh_token)
-        db.update_user(user.user_id, user)
-        res = requests.post(
-            "https://api.dropboxapi.com/2/file_properties/properties/add",
-            json=payload_data,
-            headers={"Authorization": f"Bearer {user.access_token}"},
-        )
-    if res.status_code != 200 and res.status_code != 409:
-        res.raise_for_status()
-
-    #print("Getting image embeddings ...")
-    #while True:
-    #    embedding_vector = image_processor.get_image_embedding(file_path)
-    #    if embedding_vector is None:
-    #        print("get image embedding returned None")
-    #        continue
-    #    break
-
-    '''
-    # extract_image_metadata
-    print("Extracting metadata from image ...")
-    img_metadata = image_processor.extract_image_metadata(file_path)
-    coords = None
-    capture_time_str = None
-    season = None
-    if img_metadata:
-        lat = img_metadata.get("latitude", None)
-        long = img_metadata.get("longitude", None)
-        if lat is not None and long is not None:
-            coords = [lat, long]
-
-        capture_time = img_metadata["capture_date"]
-        if capture_time is not None:
-            capture_time = datetime.strptime(capture_time, "%Y:%m:%d %H:%M:%S")
-            capture_time_str = capture_time.strftime("%d/%m/%Y")
-            # based on month get season as either summer, fall, winter, spring
-            month = capture_time.month
-            if month in [12, 1, 2]:
-                season = "winter"
-            elif month in [3, 4, 5]:
-                season = "spring"
-            elif month in [6, 7, 8]:
-                season = "summer"
-            else:
-                season = "fall"
-    img_details = db.insert(
-        url=url,
-        thumbnail_url=thumbnail_url,
-        title=title,
-        caption=caption,
-        tags=tags,
-        embedded_vector=embedding_vector,
-        coordinates=coords,
-        capture_time=capture_time_str,
-        extended_meta=json.dumps(img_metadata) if img_metadata else None,
-        season=season,
-        user_id=account_id,
-    )
-    '''
-    db.update_with_title_tags_caption(image_id, title, caption, tags)
-    db.mark_file_as_saved(file_path)
-    print(f"Processed file: {file_path}")
-
-
-# process
-def compute_embeddings_and_metadata_and_push_to_db(
-    batch_id, input_file_id, batch_jsonl_fp, batch_metadata_fp, batch_object
-):
-    with open(batch_metadata_fp, "r") as f:
-        batch_metadata = json.load(f)
-
-    print("\nbatch processing results:")
-    client = openai.OpenAI()
-    output_file_response = client.files.content(batch_object.output_file_id)
-    json_data = output_file_response.content.decode("utf-8")
-    for line in json_data.splitlines():
-        json_record = json.loads(line)
-        response = (
-            json_record.get("response", {}).get("body", {}).get("choices", [])[0].get("message", {}).get("content")
-        )
-        img_details = structured_llm_output.parse_llm_response(image_processor.ImageData, response)
-        if img_details is None:
-            print("get_image_captioning returned None")
-            continue
-        image_path = json_record.get("custom_id")
-        if not db.is_file_saved_to_db(image_path):
-            process_file(
-                image_path,
-                batch_metadata[image_path]["tags"],
-                batch_metadata[image_path]["access_token"],
-                img_details.model_dump(),
-                batch_metadata[image_path]["account_id"],
-                batch_metadata[image_path]["image_id"],
-            )
-        try:
-            os.remove(image_path)
-            print(f"removed file: {image_path} sucessfully")
-        except Exception as e:
-            print("file removal unsuccessful. got error:", e)
-
-
-def job_processor():
-    client = openai.OpenAI()
-    while True:
-        try:
-            running_batch_jobs: list[data_models.BatchQueue] = db.get_running_batch_jobs()
-            if running_batch_jobs is not None:
-                for batch_item in running_batch_jobs:
-                    batch_object = client.batches.retrieve(batch_item.batch_id)
-                    batch_item.status = batch_object.status
-                    if batch_object.status in ["validating", "in_progress", "finalizing"]:
-                        print(f"Batch Object status:", batch_object.status)
-                    elif batch_object.status == "completed":
-                        print("Caption and Tag Generation (batch job) complete")
-                        batch_item.output_file_id = batch_object.output_file_id
-                        compute_embeddings_and_metadata_and_push_to_db(
-                            batch_item.batch_id,
-                            batch_item.input_file_id,
-                            batch_item.batch_jsonl_filepath,
-                            batch_item.batch_metadata_filepath,
-                            batch_object,
-                        )
-                        batch_item.are_all_files_updated_in_db = True
-                    else:
-                        print(f"batch job failed with status: {batch_object.status}")
-
-                    db.update_batch_queue(batch_item.batch_id, batch_item)
-        except Exception as e:
-            print("Error in job_processor:", e)
-            print(traceback.format_exc())
-        finally:
-            time.sleep(60)
-
-
-def garbage_collector():
-    # clean up files from disk and oai storage and everywhere else it needs to be cleaned from
-    client = openai.OpenAI()
-    while True:
-        try:
-            # remove files
-            uncleaned_files = db.get_uncleaned_files()
-            if uncleaned_files is not None:
-                for file_item in uncleaned_files:
-                    try:
-                        os.remove(file_item.tmp_file_loc)
-                        file_item.is_cleaned_from_disk = True
-                        db.update_file_queue(file_item.tmp_file_loc, file_item)
-                    except FileNotFoundError:
-                        file_item.is_cleaned_from_disk = True
-                        db.update_file_queue(file_item.tmp_file_loc, file_item)
-                    except Exception as e:
-                        print("File cleaning broke because of error:", e)
-
-            # remove batch files
-            completed_batches = db.get_completed_jobs_but_not_cleaned()
-            if completed_batches is not None:
-                for batch_item in completed_batches:
-                    # check if all files from that batch are done, if yes continue else skip next steps
-                    still_in_process = False
-                    if not batch_item.are_all_files_updated_in_db:
-                        batch_files = db.get_files_by_batch_id(batch_item.batch_id)
-                        if batch_files is not None:
-                            for f in batch_files:
-                                if not f.is_saved_to_db:
-                                    still_in_process = True
-                                    break
-                    if still_in_process:
-                        continue
-                    try:
-                        if not batch_item.are_files_deleted_from_oai_storage:
-                            client.files.delete(batch_item.input_file_id)
-                            client.files.delete(batch_item.output_file_id)
-                            batch_item.are_files_deleted_from_oai_storage = True
-                        if not batch_item.is_cleaned_from_disk:
-                            os.remove(batch_item.batch_jsonl_filepath)
-                            os.remove(batch_item.batch_metadata_filepath)
-                            batch_item.is_cleaned_from_disk = True
-                        print("Clean up and everything done for batch:", batch_item.batch_id)
-                    except Exception as e:
-                        print("Clean up messed up with err:", e)
-                    finally:
-                        db.update_batch_queue(batch_item.batch_id, batch_item)
-
-        except Exception as e:
-            print("Error in garbage_collector:", e)
-            print(traceback.format_exc())
-        finally:
-            time.sleep(GARBAGE_COLLECTION_TIME_SECS)  # run once a day
-
-
-# ===
-# Poller
-# ===
-def list_dropbox_folder(access_token: str, filepath: str, cursor: str | None = None) -> dict:
-    headers: dict = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-    if cursor is None:
-        url = "https://api.dropboxapi.com/2/files/list_folder"
-        data: dict = {
-            "include_deleted": False,
-            "include_has_explicit_shared_members": True,
-            "include_media_info": True,
-            "include_mounted_folders": True,
-            "include_non_downloadable_files": False,
-            "path": filepath,
-            "recursive": True,
-        }
-    else:
-        url = "https://api.dropboxapi.com/2/files/list_folder/continue"
-        data = {"cursor": cursor}
-    return requests.post(url, headers=headers, json=data)
-
-
-def refresh_access_token(refresh_token):
-    token_url = "https://api.dropboxapi.com/oauth2/token"
-    data = {
-        "grant_type": "refresh_token",
-        "refresh_token": refresh_token,
-        "client_id": os.environ["DROPBOX_CLIENT_ID"],
-        "client_secret": os.environ["DROPBOX_CLIENT_SECRET"]
-    }
-    
-    response = requests.post(token_url, data=data)
-    
-    if response.status_code == 200:
-        new_tokens = response.json()
-        return new_tokens['access_token']
-    else:
-        raise Exception(f"Error refreshing token: {response.status_code} - {response.text}")
-
-def pol_from_dropbox():
-    while True:
-        try:
-            # get all users
-            users_list = db.get_all_users()
-            print('Users list:', [user.user_name for user in users_list])
-            for user in users_list:
-                print(f"Looking into user: {user.user_name}")
-                ROOT_PATH = "/Apps/PixQuery/images"
-                while True:
-                    response = list_dropbox_folder(user.access_token, ROOT_PATH, user.cursor)
-                    if response.status_code == 401:
-                        # renew access_token and retry
-                        user.access_token = refresh_access_token(user.refresh_token)
-                        # udpate user
-                        db.update_user(user.user_id, user)
-                        response = list_dropbox_folder(user.access_token, ROOT_PATH, user.cursor)
-                    res = response.json()
-                    user.cursor = response.json()["cursor"]
-                    for ent in res["entries"]:
-                        handle_dropbox_files(ent, user.access_token, user.user_id)
-                    if not res["has_more"]:
-                        break
-                db.update_user(user.user_id, user)
-        except KeyError as e:
-            print('Response Status Code:', response.status_code)
-            print('Response Text:', response.text)
-        except Exception as e:
-            print(traceback.format_exc())
-            print("Error in pol_from_dropbox:", e)
-        finally:
-            time.sleep(POLL_WINDOW_TIME_SECS)  # once in a day
-
-
-def handle_dropbox_files(ent, access_token, user_id):
-    try:
-        print(f'Handling {ent["name"]} file')
-        if ent[".tag"] != "file":
-            return None
-        if not (ent["name"].lower().endswith((".jpg", ".jpeg", ".png"))):
-            return None
-        # check if already processed in DB
-        url = f"https://www.dropbox.com/home{os.path.dirname(ent['path_display'])}?preview={ent['name']}"
-        if db.check_image_exists(url, user_id):
-            return None
-        # check if in queue
-        file_name = ent["name"]
-        file_path = os.path.join("/tmp", user_id, file_name)  # Download to the folder
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        if db.read_file_queue(file_path) is not None:
-            return None
-        if file_path in IGNORE_FILES:
-            print('Ignoring file at:', file_path)
-            return None
-        # Download the file
-        download_url = "https://content.dropboxapi.com/2/files/download"
-        download_headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Dropbox-API-Arg": f"{{\"path\": \"{ent['path_display']}\"}}",
-        }
-        file_response = requests.post(download_url, headers=download_headers)
-        if file_response.status_code == 401:
-            user = db.read_user(user_id)
-            user.acces_token = refresh_access_token(user.refresh_token)
-            db.update_user(user.user_id, user)
-            download_headers['Authorization'] = f"Bearer {user.access_token}"
-            file_response = requests.post(download_url, headers=download_headers)
-
-        with open(file_path, "wb") as f:
-            f.write(file_response.content)
-        print(f" Downloaded: {file_name} to {file_path}")
-        iid = insert_image_details_in_db(file_path, access_token, user_id)
-        db.create_file_queue(data_models.FileQueue(file_path, "", access_token, user_id, iid))
-    except PIL.UnidentifiedImageError as e:
-        print(traceback.format_exc())
-        print('PIL is unable to identify image type')
-        IGNORE_FILES.add(file_path)
-        return None
-        # mark it as failed, and let it be.
-
-
-# Start a background thread for processing files
-threading.Thread(target=file_processor, daemon=True).start()
-threading.Thread(target=job_processor, daemon=True).start()
-threading.Thread(target=garbage_collector, daemon=True).start()
-threading.Thread(target=pol_from_dropbox, daemon=True).start()
+    worker.start()
 
 
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("api:app", host="localhost", port=8080, reload=True)
-
-
-# if everytime i interacted with DropBox, I needed to wrap a retry mechanism to it, such that it checked if 401 status code was
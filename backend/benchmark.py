@@ -0,0 +1,219 @@
+"""
+Recall/latency benchmarks for the semantic part of search.
+
+A synthetic library (clustered 512-dim vectors) is loaded under a scratch user, every configuration
+is queried with the same query vectors, and recall@k is measured against an exact NumPy top-k over
+the same vectors, together with p50/p99 latency. The scratch user is deleted afterwards.
+
+    python benchmark.py quantization --sizes 10000,100000 --queries 200 --candidates 100,200,400
+    python benchmark.py hnsw --sizes 1000,10000,100000 --ef-search 40,100,200,400 --noise 100000
+
+The HNSW build parameters in use are printed with the results; to compare other m / ef_construction
+values, rebuild the index first (python db.py vector-index none --rebuild --m 32 --ef-construction 128).
+"""
+import argparse
+import time
+import uuid
+
+import numpy as np
+import psycopg2
+from psycopg2.extras import execute_values
+
+import db
+
+
+def make_vectors(rng: np.random.Generator, n: int, n_clusters: int = 64) -> np.ndarray:
+    """Gaussian clusters, closer to real CLIP embeddings than uniform noise"""
+    centers = rng.normal(size=(n_clusters, db.EMBEDDING_DIM)).astype(np.float32)
+    assignment = rng.integers(0, n_clusters, size=n)
+    vectors = centers[assignment] + 0.5 * rng.normal(size=(n, db.EMBEDDING_DIM)).astype(np.float32)
+    normalized: np.ndarray = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    return normalized
+
+
+def connect():
+    return psycopg2.connect(dbname=db.PG_DB, user=db.PG_USER, password=db.PG_PASSWORD, host=db.PG_HOST, port=db.PG_PORT)
+
+
+def load_library(conn, user_id: str, vectors: np.ndarray) -> list[str]:
+    uuids = [str(uuid.uuid4()) for _ in range(len(vectors))]
+    with conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO users (user_id, user_name, email, access_token, refresh_token, template_id) "
+            "VALUES (%s, 'benchmark', 'benchmark@localhost', '', '', '')",
+            (user_id,),
+        )
+        rows = ((uid, user_id, f"bench://{uid}", "", vector.tolist()) for uid, vector in zip(uuids, vectors))
+        execute_values(
+            cur,
+            "INSERT INTO image_detail (uuid, user_id, url, thumbnail_url, embedding_vector) VALUES %s",
+            rows,
+            template="(%s, %s, %s, %s, %s::float4[])",
+            page_size=1000,
+        )
+    conn.commit()
+    with conn.cursor() as cur:
+        cur.execute("ANALYZE image_detail")
+    conn.commit()
+    return uuids
+
+
+def delete_library(conn, user_id: str):
+    conn.rollback()
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM users WHERE user_id = %s", (user_id,))
+    conn.commit()
+
+
+def exact_top_k(vectors: np.ndarray, uuids: list[str], query: np.ndarray, k: int) -> list[str]:
+    scores = vectors @ query
+    top = np.argpartition(-scores, k)[:k]
+    return [uuids[i] for i in top]
+
+
+def run_semantic(
+    conn, user_id: str, query: np.ndarray, k: int, quantization: str, settings: dict
+) -> tuple[list[str], float]:
+    """Returns (uuids, latency in ms) for the semantic CTE that search uses"""
+    search_query = f"WITH {db.semantic_cte('', quantization)} SELECT uuid FROM semantic ORDER BY rank_ix"
+    params = {
+        "query_embedding": query.tolist(),
+        "user_id": user_id,
+        "match_count": k // 2,  # the CTE returns LEAST(match_count, 30) * 2 rows
+        "rerank_candidates": settings.get("rerank_candidates", db.RERANK_CANDIDATES),
+    }
+    with conn.cursor() as cur:
+        for name, value in settings.items():
+            if name.startswith("hnsw."):
+                cur.execute(f"SET LOCAL {name} = %s", (value,))
+        start = time.perf_counter()
+        cur.execute(search_query, params)
+        rows = cur.fetchall()
+        latency = (time.perf_counter() - start) * 1e3
+    conn.rollback()
+    return [str(x[0]) for x in rows], latency
+
+
+def evaluate(conn, user_id, vectors, uuids, queries, k, quantization, settings) -> dict:
+    recalls, latencies = [], []
+    for query in queries:
+        expected = set(exact_top_k(vectors, uuids, query, k))
+        found, latency = run_semantic(conn, user_id, query, k, quantization, settings)
+        recalls.append(len(expected.intersection(found[:k])) / k)
+        latencies.append(latency)
+    return {
+        f"recall@{k}": float(np.mean(recalls)),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
+def index_params(conn) -> dict:
+    params = {}
+    with conn.cursor() as cur:
+        for index_name, _ in db.VECTOR_INDEXES.values():
+            cur.execute("SELECT reloptions FROM pg_class WHERE oid = to_regclass(%s)", (index_name,))
+            row = cur.fetchone()
+            if row is not None:
+                params[index_name] = row[0]
+    conn.rollback()
+    return params
+
+
+def index_sizes(conn) -> dict:
+    sizes = {}
+    with conn.cursor() as cur:
+        for index_name, _ in db.VECTOR_INDEXES.values():
+            cur.execute("SELECT pg_size_pretty(pg_relation_size(to_regclass(%s)))", (index_name,))
+            sizes[index_name] = cur.fetchone()[0]
+    conn.rollback()
+    return sizes
+
+
+def print_row(size: int, label: str, metrics: dict):
+    print(f"{size:>9} | {label:<32} | " + " | ".join(f"{k}={v:.3f}" for k, v in metrics.items()))
+
+
+def benchmark_quantization(args):
+    for quantization in db.VECTOR_INDEXES:
+        db.create_vector_index(quantization)
+
+    rng = np.random.default_rng(args.seed)
+    conn = connect()
+    for size in args.sizes:
+        user_id = f"benchmark-{uuid.uuid4()}"
+        vectors = make_vectors(rng, size)
+        queries = make_vectors(rng, args.queries)
+        try:
+            uuids = load_library(conn, user_id, vectors)
+            metrics = evaluate(
+                conn, user_id, vectors, uuids, queries, args.k, "none", {"hnsw.ef_search": args.ef_search}
+            )
+            print_row(size, f"full hnsw ef_search={args.ef_search}", metrics)
+            for candidates in args.candidates:
+                settings = {"hnsw.ef_search": min(max(candidates, 40), 1000), "rerank_candidates": candidates}
+                metrics = evaluate(conn, user_id, vectors, uuids, queries, args.k, "binary", settings)
+                print_row(size, f"binary + rerank {candidates}", metrics)
+            print("index sizes (all users):", index_sizes(conn))
+        finally:
+            delete_library(conn, user_id)
+    conn.close()
+
+
+def benchmark_hnsw(args):
+    db.create_vector_index("none")
+
+    rng = np.random.default_rng(args.seed)
+    conn = connect()
+    print("index params:", index_params(conn))
+    noise_user_id = f"benchmark-{uuid.uuid4()}"
+    try:
+        if args.noise:
+            # images of another tenant share the global HNSW graph, so the user_id filter drops candidates
+            load_library(conn, noise_user_id, make_vectors(rng, args.noise))
+        for size in args.sizes:
+            user_id = f"benchmark-{uuid.uuid4()}"
+            vectors = make_vectors(rng, size)
+            queries = make_vectors(rng, args.queries)
+            try:
+                uuids = load_library(conn, user_id, vectors)
+                for ef_search in args.ef_search:
+                    for iterative_scan in args.iterative_scan:
+                        settings = {"hnsw.ef_search": ef_search, "hnsw.iterative_scan": iterative_scan}
+                        metrics = evaluate(conn, user_id, vectors, uuids, queries, args.k, "none", settings)
+                        print_row(size, f"ef_search={ef_search} iterative={iterative_scan}", metrics)
+            finally:
+                delete_library(conn, user_id)
+    finally:
+        delete_library(conn, noise_user_id)
+        conn.close()
+
+
+def int_list(value: str) -> list[int]:
+    return [int(x) for x in value.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int_list, default=[10_000, 50_000])
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    quantization_parser = subparsers.add_parser(
+        "quantization", help="full-precision HNSW vs binary candidates + rerank"
+    )
+    quantization_parser.add_argument("--candidates", type=int_list, default=[100, 200, 400])
+    quantization_parser.add_argument("--ef-search", type=int, default=100)
+
+    hnsw_parser = subparsers.add_parser("hnsw", help="recall/latency of the full-precision HNSW index by ef_search")
+    hnsw_parser.add_argument("--ef-search", type=int_list, default=[40, 100, 200, 400])
+    hnsw_parser.add_argument("--iterative-scan", type=lambda x: x.split(","), default=["off", "strict_order"])
+    hnsw_parser.add_argument("--noise", type=int, default=0, help="images loaded under another user")
+
+    args = parser.parse_args()
+    if args.benchmark == "quantization":
+        benchmark_quantization(args)
+    elif args.benchmark == "hnsw":
+        benchmark_hnsw(args)
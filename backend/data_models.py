@@ -1,4 +1,5 @@
 import dataclasses
+from datetime import datetime
 from typing import Optional, List
 
 
@@ -9,7 +10,7 @@ class ImageDetail:
     thumbnail_url: str
     title: str | None
     caption: str | None
-    tags: str | None
+    tags: List[str] | None  # normalized (lowercase, stripped, unique)
     coordinates: List[float] | None
     capture_time: str | None  # dd/mm/yyyy
     extended_meta: str | None
@@ -28,6 +29,15 @@ class ImageDetailResult(ImageDetail):
     created_at: str
 
 
+@dataclasses.dataclass
+class MapCluster:
+    longitude: float  # centroid of the images in the cluster
+    latitude: float
+    count: int
+    uuid: str  # representative image of the cluster
+    thumbnail_url: str
+
+
 @dataclasses.dataclass
 class User:
     user_id: str  # dropbox account
@@ -50,8 +60,8 @@ class FileQueue:
     batch_id: str | None = None  # updated once we submit the file to openai batch job
     is_saved_to_db: bool = False  # whether saved the final image object to DB
     is_cleaned_from_disk: bool = False  # whether the image is removed from tmp file loc on disk
-    created_at: int | None = None  # generated by pg
-    updated_at: int | None = None  # generated by pg
+    created_at: datetime | None = None  # generated by pg
+    updated_at: datetime | None = None  # generated by pg
 
 
 @dataclasses.dataclass
@@ -65,5 +75,45 @@ class BatchQueue:
     are_all_files_updated_in_db: bool = False  # once the job is complete, another thread will read in files and then do further processing, before pushing to db. Once all files from the batch are pushed to db, this will be set to true
     are_files_deleted_from_oai_storage: bool = False  # once all files are updated in DB, we are free to delete these files from openai storage, and post deleteion this will be set to true
     is_cleaned_from_disk: bool = False  # whether the batch_files are removed from tmp file loc on disk
-    created_at: int | None = None  # generated by pg
-    updated_at: int | None = None  # generated by pg
+    created_at: datetime | None = None  # generated by pg
+    updated_at: datetime | None = None  # generated by pg
+
+
+@dataclasses.dataclass
+class DropboxWriteback:
+    user_id: str  # owner of the file
+    path: str  # dropbox path of the file
+    title: str | None = None
+    caption: str | None = None
+    tags: list[str] = dataclasses.field(default_factory=list)  # tags to add; coalesced with pending ones
+    version: int = 1  # bumped on every coalesced update, so a finished attempt only deletes what it sent
+    attempts: int = 0  # failed attempts since the last update
+
+
+@dataclasses.dataclass
+class DeadLetter:
+    id: int
+    kind: str  # what failed: "upload", "polled_file", "batch_record" or "dropbox_writeback"
+    key: str  # identifies the work within its kind (file path, ...); one row per key
+    user_id: str | None
+    payload: dict  # what `worker.py redrive` needs to run the work again
+    error: str | None
+    attempts: int
+    created_at: datetime | None = None  # generated by pg
+    updated_at: datetime | None = None  # generated by pg
+
+
+@dataclasses.dataclass
+class IngestJobFile:
+    job_id: str  # the upload request it came with
+    file_id: str
+    user_id: str
+    name: str | None  # file name as uploaded
+    tmp_file_loc: str  # where the worker processing it downloads it to; its Dropbox name comes from it
+    tags: str | None  # user tags, as given to /upload
+    status: str = "stored"  # stored -> embedded -> captioned, or failed
+    image_id: str | None = None  # image_detail uuid once embedded
+    error: str | None = None
+    attempts: int = 0  # failed attempts to process it
+    upload_session: dict | None = None  # cursor of the Dropbox upload session holding it, until committed
+    content_hash: str | None = None  # Dropbox content_hash of the file
@@ -1,12 +1,22 @@
+import inspect
 import os
+import random
+import re
+import select
+import threading
+import time
 import uuid
-from typing import Optional, List
+from datetime import datetime
+from typing import Callable, Optional, List
 
 import psycopg2
+import psycopg2.extras
+import psycopg2.pool
 from psycopg2 import sql
 
 import data_models
-from data_models import User, FileQueue, BatchQueue
+import vector_search
+from data_models import User, FileQueue, BatchQueue, DropboxWriteback, DeadLetter, IngestJobFile
 
 # Connect to the database
 PG_USER = os.environ["PG_USER"]
@@ -15,39 +25,548 @@ PG_HOST = os.environ["PG_HOST"]
 PG_PORT = os.environ["PG_PORT"]
 PG_DB = os.environ["PG_DB"]
 
+# read replicas: comma separated libpq DSNs (eg. "host=replica1 port=5432 dbname=peec_db user=... password=...")
+PG_REPLICA_DSNS = [x.strip() for x in os.environ.get("PG_REPLICA_DSNS", "").split(",") if x.strip()]
+MAX_REPLICA_LAG_SECS = float(os.environ.get("MAX_REPLICA_LAG_SECS", 5))
+REPLICA_LAG_CHECK_SECS = float(os.environ.get("REPLICA_LAG_CHECK_SECS", 2))
+# reads of a user only wait for a replica to replay their last write for this long after it; past that, any
+# replica within MAX_REPLICA_LAG_SECS has it
+READ_YOUR_WRITES_SECS = float(os.environ.get("READ_YOUR_WRITES_SECS", 30))
+# a user's last write is re-read from the primary at most this often per process; writes of the process
+# itself are known right away
+LAST_WRITE_CACHE_SECS = float(os.environ.get("LAST_WRITE_CACHE_SECS", 1))
+# connections kept open per database (the primary and each replica); more are opened, unpooled, if needed
+PG_POOL_SIZE = int(os.environ.get("PG_POOL_SIZE", 10))
+
+# vector search: "none" uses full-precision vectors, "binary" uses bit vectors for candidates + exact rerank
+EMBEDDING_DIM = 512
+EMBEDDING_QUANTIZATION = os.environ.get("EMBEDDING_QUANTIZATION", "none")
+RERANK_CANDIDATES = int(os.environ.get("RERANK_CANDIDATES", 200))
+# HNSW build parameters (changing them needs `python db.py vector-index <mode> --rebuild`)
+HNSW_M = int(os.environ.get("HNSW_M", 16))
+HNSW_EF_CONSTRUCTION = int(os.environ.get("HNSW_EF_CONSTRUCTION", 64))
+# >0 hash-partitions image_detail by user_id into that many partitions, each with its own local indexes
+IMAGE_DETAIL_PARTITIONS = int(os.environ.get("IMAGE_DETAIL_PARTITIONS", 0))
+# HNSW search parameters, applied with SET LOCAL inside the search transaction
+HNSW_EF_SEARCH = int(os.environ.get("HNSW_EF_SEARCH", 40))
+# off | strict_order | relaxed_order: keep scanning the graph when filters drop candidates (pgvector >= 0.8.0)
+HNSW_ITERATIVE_SCAN = os.environ.get("HNSW_ITERATIVE_SCAN", "strict_order")
+
+# fair share of the background queues: users without a TenantShare row get this weight, and at most this
+# many rows per claim (0: no cap)
+FAIR_SHARE_DEFAULT_WEIGHT = float(os.environ.get("FAIR_SHARE_DEFAULT_WEIGHT", 1))
+FAIR_SHARE_DEFAULT_CAP = int(os.environ.get("FAIR_SHARE_DEFAULT_CAP", 0))
+
+# map clustering: grid cells per 256px web-mercator tile, i.e. one cluster per ~64px on screen
+MAP_CELLS_PER_TILE = int(os.environ.get("MAP_CELLS_PER_TILE", 4))
+MAP_MAX_CLUSTERS = int(os.environ.get("MAP_MAX_CLUSTERS", 500))
+
+
+_replica_lag: dict[str, tuple[float, float]] = {}  # dsn -> (monotonic time of check, lag in secs)
+# user_id -> (monotonic time read, lsn of the last write or None, monotonic time until reads must wait for it)
+_last_writes: dict[str, tuple[float, Optional[str], float]] = {}
+_pools: dict[Optional[str], psycopg2.pool.ThreadedConnectionPool] = {}  # replica dsn (None: primary) -> pool
+_routing_lock = threading.Lock()
+_transactions = threading.local()  # stack of (after-commit callbacks, users written for), one per open with_connection call
+
+
+def _connect_primary():
+    return psycopg2.connect(dbname=PG_DB, user=PG_USER, password=PG_PASSWORD, host=PG_HOST, port=PG_PORT)
+
+
+def _get_connection(dsn: Optional[str] = None):
+    """Connection from the pool of the primary (dsn None) or of a replica; opened unpooled when the pool is in use"""
+    with _routing_lock:
+        pool = _pools.get(dsn)
+        if pool is None:
+            if dsn is None:
+                pool = psycopg2.pool.ThreadedConnectionPool(
+                    0, PG_POOL_SIZE, dbname=PG_DB, user=PG_USER, password=PG_PASSWORD, host=PG_HOST, port=PG_PORT
+                )
+            else:
+                pool = psycopg2.pool.ThreadedConnectionPool(0, PG_POOL_SIZE, dsn, connect_timeout=2)
+            _pools[dsn] = pool
+    try:
+        return pool.getconn()
+    except psycopg2.pool.PoolError:
+        return _connect_primary() if dsn is None else psycopg2.connect(dsn, connect_timeout=2)
+
+
+def _release_connection(conn, dsn: Optional[str] = None):
+    """Hand a connection of _get_connection back, with no transaction open; broken ones are closed"""
+    broken = bool(conn.closed)
+    if not broken:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            broken = True
+    try:
+        _pools[dsn].putconn(conn, close=broken)
+    except psycopg2.pool.PoolError:  # opened unpooled
+        conn.close()
+
+
+def _user_id_of(func_signature: inspect.Signature, args: tuple, kwargs: dict) -> Optional[str]:
+    """user_id argument of a db function call, or the user_id of a dataclass argument (User, FileQueue, ...)"""
+    try:
+        bound = func_signature.bind_partial(None, *args, **kwargs)
+    except TypeError:
+        return None
+    if bound.arguments.get("user_id") is not None:
+        return str(bound.arguments["user_id"])
+    for value in bound.arguments.values():
+        if getattr(value, "user_id", None) is not None:
+            return str(value.user_id)
+    return None
+
+
+def _user_ids_of(func_signature: inspect.Signature, args: tuple, kwargs: dict) -> set[str]:
+    """Every user a db function call may write for: _user_id_of, plus the users of lists of dataclasses or dicts"""
+    user_id = _user_id_of(func_signature, args, kwargs)
+    user_ids = {user_id} if user_id is not None else set()
+    for value in list(args) + list(kwargs.values()):
+        if not isinstance(value, (list, tuple)):
+            continue
+        for item in value:
+            item_user_id = item.get("user_id") if isinstance(item, dict) else getattr(item, "user_id", None)
+            if isinstance(item_user_id, str):
+                user_ids.add(item_user_id)
+    return user_ids
+
+
+def _record_user_writes(conn, user_ids: set[str]) -> None:
+    """
+    Store, per user, a WAL position at or past the commit that just happened, in user_last_write on the
+    primary. Reads for these users then only use a replica that replayed up to it: right away in this
+    process, within LAST_WRITE_CACHE_SECS in the others.
+    """
+    with conn.cursor() as cur:
+        rows = psycopg2.extras.execute_values(
+            cur,
+            """
+            INSERT INTO user_last_write (user_id, lsn) VALUES %s
+            ON CONFLICT (user_id) DO UPDATE SET
+                lsn = GREATEST(user_last_write.lsn, EXCLUDED.lsn), written_at = EXCLUDED.written_at
+            RETURNING user_id, lsn::text
+            """,
+            [(user_id,) for user_id in sorted(user_ids)],
+            template="(%s, pg_current_wal_insert_lsn())",
+            fetch=True,
+        )
+    conn.commit()
+    now = time.monotonic()
+    with _routing_lock:
+        for user_id, lsn in rows:
+            _last_writes[user_id] = (now, lsn, now + READ_YOUR_WRITES_SECS)
+
+
+def _last_write_lsn(user_id: str) -> Optional[str]:
+    """WAL position a replica must have replayed to serve reads of user_id; None if any replica within lag will do"""
+    now = time.monotonic()
+    with _routing_lock:
+        cached = _last_writes.get(user_id)
+    if cached is None or now - cached[0] >= LAST_WRITE_CACHE_SECS:
+        conn = _get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT lsn::text, EXTRACT(EPOCH FROM now() - written_at) FROM user_last_write WHERE user_id = %s",
+                    (user_id,),
+                )
+                row = cur.fetchone()
+        finally:
+            _release_connection(conn)
+        cached = (now, row[0], now + READ_YOUR_WRITES_SECS - float(row[1])) if row else (now, None, now)
+        with _routing_lock:
+            _last_writes[user_id] = cached
+    _, lsn, wait_until = cached
+    return lsn if now < wait_until else None
+
+
+def _has_replayed(conn, lsn: str) -> bool:
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_last_wal_replay_lsn() >= %s::pg_lsn", (lsn,))
+        replayed = bool(cur.fetchone()[0])
+    conn.rollback()
+    return replayed
+
+
+def _measure_replica_lag(conn) -> float:
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT CASE
+                WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+            END
+            """
+        )
+        lag = float(cur.fetchone()[0])
+    conn.rollback()
+    return lag
+
+
+def _connect_for_read(user_id: Optional[str]) -> tuple:
+    """
+    (connection, replica dsn or None for the primary) from the pools: a replica that is within
+    MAX_REPLICA_LAG_SECS and has replayed user_id's recent writes (see _last_write_lsn), falling back to the
+    primary when no replica is configured, healthy or caught up.
+    """
+    if not PG_REPLICA_DSNS:
+        return _get_connection(), None
+    last_write_lsn = _last_write_lsn(user_id) if user_id is not None else None
+
+    now = time.monotonic()
+    for dsn in random.sample(PG_REPLICA_DSNS, len(PG_REPLICA_DSNS)):
+        with _routing_lock:
+            checked_at, lag = _replica_lag.get(dsn, (None, None))
+        if lag is not None and lag > MAX_REPLICA_LAG_SECS and now - checked_at < REPLICA_LAG_CHECK_SECS:
+            continue
+        try:
+            conn = _get_connection(dsn)
+        except psycopg2.OperationalError as e:
+            print(f"Replica unreachable, skipping it: {e}")
+            with _routing_lock:
+                _replica_lag[dsn] = (now, float("inf"))
+            continue
+        if checked_at is None or now - checked_at >= REPLICA_LAG_CHECK_SECS:
+            lag = _measure_replica_lag(conn)
+            with _routing_lock:
+                _replica_lag[dsn] = (now, lag)
+        if lag <= MAX_REPLICA_LAG_SECS and (last_write_lsn is None or _has_replayed(conn, last_write_lsn)):
+            return conn, dsn
+        _release_connection(conn, dsn)
+    return _get_connection(), None
+
 
 def with_connection(func):
     """
     Function decorator for passing connections
     """
+    func_signature = inspect.signature(func)
 
     def connection(*args, **kwargs):
-        # Here, you may even use a connection pool
-        conn = psycopg2.connect(dbname=PG_DB, user=PG_USER, password=PG_PASSWORD, host=PG_HOST, port=PG_PORT)
+        conn = _get_connection()
+        callbacks: list[Callable[[], None]] = []
+        written_for: set[str] = set()
+        _transactions.__dict__.setdefault("stack", []).append((callbacks, written_for))
         try:
             rv = func(conn, *args, **kwargs)
+            wrote = False
+            if PG_REPLICA_DSNS:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT txid_current_if_assigned() IS NOT NULL")  # read-only calls don't need a marker
+                    wrote = cur.fetchone()[0]
         except Exception as e:
             conn.rollback()
             raise e
         else:
             # Can decide to see if you need to commit the transaction or not
             conn.commit()
+            user_ids = _user_ids_of(func_signature, args, kwargs) | written_for if wrote else set()
+            if user_ids:
+                try:
+                    _record_user_writes(conn, user_ids)
+                except psycopg2.Error as e:
+                    conn.rollback()
+                    print(f"Could not record the write of {func.__name__} for read-your-writes:", e)
         finally:
-            conn.close()
+            _transactions.stack.pop()
+            _release_connection(conn)
+        for callback in callbacks:  # only reached once committed
+            try:
+                callback()
+            except Exception as e:
+                print(f"After-commit callback of {func.__name__} failed:", e)
         return rv
 
     return connection
 
 
+def after_commit(callback) -> None:
+    """Run callback once the transaction of the with_connection function running on this thread has committed"""
+    _transactions.stack[-1][0].append(callback)
+
+
+def wrote_for(user_ids) -> None:
+    """Record writes for users that _user_ids_of can't see in the arguments of the running with_connection function"""
+    _transactions.stack[-1][1].update(user_ids)
+
+
+def with_read_connection(func):
+    """
+    Function decorator for passing connections to read-only functions; these may be routed to a replica.
+    Callers about to write based on the result pass on_primary=True.
+    """
+    func_signature = inspect.signature(func)
+
+    def connection(*args, on_primary: bool = False, **kwargs):
+        if on_primary:
+            conn, dsn = _get_connection(), None
+        else:
+            conn, dsn = _connect_for_read(_user_id_of(func_signature, args, kwargs))
+        try:
+            return func(conn, *args, **kwargs)
+        finally:
+            _release_connection(conn, dsn)
+
+    return connection
+
+
+def normalize_tags(tags: Optional[list[str]]) -> Optional[list[str]]:
+    """
+    Lowercase, strip and de-duplicate tags (keeping order) so that they can be matched exactly
+    """
+    if tags is None:
+        return None
+    normalized = []
+    for tag in tags:
+        tag = tag.strip().lower()
+        if tag and tag not in normalized:
+            normalized.append(tag)
+    return normalized
+
+
+def _tag_filter(tags: Optional[list[str]], tag_mode: str) -> str:
+    """SQL clause for filtering on tags; uses the GIN index on image_detail.tags"""
+    if not tags:
+        return ""
+    if tag_mode == "all":
+        return "AND tags @> %(tags)s::text[]"
+    if tag_mode == "any":
+        return "AND tags && %(tags)s::text[]"
+    raise ValueError(f"Unknown tag_mode: {tag_mode}. Expected 'any' or 'all'")
+
+
+def _bbox_filter(bbox: Optional[tuple[float, float, float, float]], column: str = "coordinates") -> str:
+    """
+    SQL clause for a (min_lon, min_lat, max_lon, max_lat) bounding box; uses the GIST index on coordinates.
+    A box crossing the antimeridian (min_lon > max_lon) is split into one envelope on each side of it.
+    Takes min_lon, min_lat, max_lon and max_lat parameters.
+    """
+    if not bbox:
+        return ""
+    if bbox[0] <= bbox[2]:
+        return f"AND {column} && ST_MakeEnvelope(%(min_lon)s, %(min_lat)s, %(max_lon)s, %(max_lat)s, 4326)"
+    return f"""AND ({column} && ST_MakeEnvelope(%(min_lon)s, %(min_lat)s, 180, %(max_lat)s, 4326)
+             OR {column} && ST_MakeEnvelope(-180, %(min_lat)s, %(max_lon)s, %(max_lat)s, 4326))"""
+
+
+def semantic_cte(filters: str, quantization: Optional[str] = None, precomputed: bool = False) -> str:
+    """
+    `semantic` CTE ranking the user's images by inner product with the query embedding.
+
+    precomputed=True keeps the order of %(semantic_candidates)s, uuids already ranked by an
+    in-process vector_search backend.
+
+    quantization="none" walks the full-precision HNSW index (idx_image_detail_embedding).
+    quantization="binary" runs two stages: a hamming-distance candidate pass over the 64 byte
+    binary-quantized index (idx_image_detail_embedding_bits), then an exact rerank of the top
+    RERANK_CANDIDATES candidates with the full vectors.
+    """
+    quantization = quantization or EMBEDDING_QUANTIZATION
+    if precomputed:
+        return f"""semantic AS (
+        SELECT
+            image_detail.uuid,
+            row_number() OVER (ORDER BY candidates.ord) AS rank_ix
+        FROM unnest(%(semantic_candidates)s::uuid[]) WITH ORDINALITY AS candidates(uuid, ord)
+            JOIN image_detail ON image_detail.uuid = candidates.uuid
+        WHERE image_detail.user_id = %(user_id)s
+        {filters}
+        ORDER BY rank_ix
+        LIMIT LEAST(%(match_count)s, 30) * 2
+    )"""
+    if quantization == "none":
+        return f"""semantic AS (
+        SELECT
+            uuid,
+            row_number() OVER (
+                ORDER BY image_detail.embedding_vector <#> %(query_embedding)s::vector
+            ) AS rank_ix
+        FROM image_detail
+        WHERE user_id = %(user_id)s
+        {filters}
+        ORDER BY rank_ix
+        LIMIT LEAST(%(match_count)s, 30) * 2
+    )"""
+    if quantization == "binary":
+        return f"""semantic_candidates AS (
+        SELECT uuid, embedding_vector
+        FROM image_detail
+        WHERE user_id = %(user_id)s
+        {filters}
+        ORDER BY binary_quantize(embedding_vector)::bit({EMBEDDING_DIM}) <~> binary_quantize(%(query_embedding)s::vector)
+        LIMIT %(rerank_candidates)s
+    ),
+    semantic AS (
+        SELECT
+            uuid,
+            row_number() OVER (
+                ORDER BY semantic_candidates.embedding_vector <#> %(query_embedding)s::vector
+            ) AS rank_ix
+        FROM semantic_candidates
+        ORDER BY rank_ix
+        LIMIT LEAST(%(match_count)s, 30) * 2
+    )"""
+    raise ValueError(f"Unknown quantization: {quantization}. Expected 'none' or 'binary'")
+
+
 @with_connection
 def create_tables(conn):
     cur = conn.cursor()
     with open("./DDL.sql", "r") as f:
-        cur.execute(f.read())
+        cur.execute(f.read(), {"hnsw_m": HNSW_M, "hnsw_ef_construction": HNSW_EF_CONSTRUCTION})
     cur.close()
+    if IMAGE_DETAIL_PARTITIONS > 0:
+        _partition_image_detail(conn, IMAGE_DETAIL_PARTITIONS)
+
+
+# image_detail columns that hold data (title_caption_tags_fts_vector is generated)
+IMAGE_DETAIL_COLUMNS = (
+    "uuid, user_id, url, thumbnail_url, title, caption, tags, embedding_vector, coordinates, "
+    "capture_time, extended_meta, season, updated_at, created_at"
+)
+
+
+def _is_image_detail_partitioned(cur) -> bool:
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = 'image_detail'::regclass")
+    return bool(cur.fetchone()[0] == "p")
+
+
+def _partition_image_detail(conn, partitions: int, keep_old: bool = False) -> bool:
+    """
+    Migrate image_detail to a table hash-partitioned by user_id, in the current transaction.
+
+    Every index (GIST, GIN, HNSW, ...) and trigger of the current table is recreated on the partitioned
+    parent, which gives each partition its own local copy, so index maintenance and searches (which
+    always filter on user_id) only touch one partition. The primary key becomes (uuid, user_id) since
+    it has to include the partition key. The old table is dropped, or kept as image_detail_unpartitioned.
+    Returns False if image_detail is already partitioned.
+    """
+    with conn.cursor() as cur:
+        if _is_image_detail_partitioned(cur):
+            return False
+        print(f"Partitioning image_detail into {partitions} partitions ...")
+        cur.execute("LOCK TABLE image_detail IN ACCESS EXCLUSIVE MODE")
+        cur.execute(
+            "SELECT indexname, indexdef FROM pg_indexes WHERE tablename = 'image_detail' AND indexname <> 'image_detail_pkey'"
+        )
+        indexes = cur.fetchall()
+        cur.execute(
+            "SELECT pg_get_triggerdef(oid) FROM pg_trigger WHERE tgrelid = 'image_detail'::regclass AND NOT tgisinternal"
+        )
+        triggers = [x[0] for x in cur.fetchall()]
+
+        cur.execute(
+            """
+            CREATE TABLE image_detail_partitioned (
+                LIKE image_detail INCLUDING DEFAULTS INCLUDING GENERATED INCLUDING CONSTRAINTS
+            ) PARTITION BY HASH (user_id)
+            """
+        )
+        cur.execute("ALTER TABLE image_detail_partitioned ADD PRIMARY KEY (uuid, user_id)")
+        cur.execute(
+            "ALTER TABLE image_detail_partitioned ADD FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE"
+        )
+        for i in range(partitions):
+            cur.execute(
+                f"CREATE TABLE image_detail_p{i} PARTITION OF image_detail_partitioned "
+                f"FOR VALUES WITH (MODULUS {partitions}, REMAINDER {i})"
+            )
+        cur.execute(
+            f"INSERT INTO image_detail_partitioned ({IMAGE_DETAIL_COLUMNS}) SELECT {IMAGE_DETAIL_COLUMNS} FROM image_detail"
+        )
+
+        # indexes are built after the copy, under temporary names until the old ones are gone
+        for index_name, index_def in indexes:
+            cur.execute(
+                re.sub(
+                    r"^CREATE (UNIQUE )?INDEX \S+ ON (\S+\.)?image_detail ",
+                    rf"CREATE \1INDEX {index_name}_p ON image_detail_partitioned ",
+                    index_def,
+                )
+            )
+        for trigger_def in triggers:
+            cur.execute(re.sub(r" ON (\S+\.)?image_detail ", " ON image_detail_partitioned ", trigger_def))
+
+        if keep_old:
+            cur.execute("ALTER TABLE image_detail RENAME TO image_detail_unpartitioned")
+            for index_name, _ in indexes:
+                cur.execute(f"ALTER INDEX {index_name} RENAME TO {index_name}_unpartitioned")
+            for trigger_name in re.findall(r"^CREATE (?:CONSTRAINT )?TRIGGER (\S+)", "\n".join(triggers), re.M):
+                cur.execute(f"DROP TRIGGER {trigger_name} ON image_detail_unpartitioned")
+        else:
+            cur.execute("DROP TABLE image_detail")
+        cur.execute("ALTER TABLE image_detail_partitioned RENAME TO image_detail")
+        for index_name, _ in indexes:
+            cur.execute(f"ALTER INDEX {index_name}_p RENAME TO {index_name}")
+        cur.execute("ANALYZE image_detail")
+    return True
+
+
+@with_connection
+def partition_image_detail(conn, partitions: int = IMAGE_DETAIL_PARTITIONS, keep_old: bool = False) -> bool:
+    return _partition_image_detail(conn, partitions, keep_old)
+
+
+VECTOR_INDEXES = {
+    "none": (
+        "idx_image_detail_embedding",
+        "ON image_detail USING hnsw (embedding_vector vector_ip_ops)",
+    ),
+    "binary": (
+        "idx_image_detail_embedding_bits",
+        f"ON image_detail USING hnsw ((binary_quantize(embedding_vector)::bit({EMBEDDING_DIM})) bit_hamming_ops)",
+    ),
+}
 
 
 @with_connection
+def create_vector_index(
+    conn,
+    quantization: str,
+    drop_others: bool = False,
+    rebuild: bool = False,
+    m: int = HNSW_M,
+    ef_construction: int = HNSW_EF_CONSTRUCTION,
+):
+    """
+    Build the vector index used by the given EMBEDDING_QUANTIZATION mode (without blocking writes).
+    With rebuild, an existing index is replaced by one built with the given m / ef_construction.
+    With drop_others, the indexes of the other modes are dropped, eg. so that only the compact
+    binary index has to stay in memory.
+    """
+    index_name, index_def = VECTOR_INDEXES[quantization]
+    index_def = f"{index_def} WITH (m = {int(m)}, ef_construction = {int(ef_construction)})"
+    conn.autocommit = True  # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    with conn.cursor() as cur:
+        # partitioned tables don't support CONCURRENTLY; their local indexes are built one partition at a time
+        concurrently = "" if _is_image_detail_partitioned(cur) else "CONCURRENTLY"
+        if rebuild:
+            cur.execute(f"DROP INDEX {concurrently} IF EXISTS {index_name}_new")
+            cur.execute(f"CREATE INDEX {concurrently} {index_name}_new {index_def}")
+            cur.execute(f"DROP INDEX {concurrently} IF EXISTS {index_name}")
+            cur.execute(f"ALTER INDEX {index_name}_new RENAME TO {index_name}")
+        else:
+            cur.execute(f"CREATE INDEX {concurrently} IF NOT EXISTS {index_name} {index_def}")
+        if drop_others:
+            for other_name, _ in VECTOR_INDEXES.values():
+                if other_name != index_name:
+                    cur.execute(f"DROP INDEX {concurrently} IF EXISTS {other_name}")
+
+
+def set_hnsw_search_params(cur, ef_search: Optional[int] = None):
+    """SET LOCAL the HNSW scan parameters; they only last for the current transaction"""
+    ef_search = ef_search or HNSW_EF_SEARCH
+    if EMBEDDING_QUANTIZATION == "binary":
+        # the candidate pass can't return more rows than the HNSW search list holds
+        ef_search = max(ef_search, RERANK_CANDIDATES)
+    cur.execute("SET LOCAL hnsw.ef_search = %s", (min(max(ef_search, 1), 1000),))
+    cur.execute("SET LOCAL hnsw.iterative_scan = %s", (HNSW_ITERATIVE_SCAN,))
+
+
+@with_read_connection
 def get_search_query_result(
     conn,
     query_text: str,
@@ -63,18 +582,28 @@ def get_search_query_result(
     full_text_weight: Optional[float] = 1,
     semantic_weight: Optional[float] = 1,
     rrf_k: Optional[int] = 50,
+    tag_mode: str = "any",
+    ef_search: Optional[int] = None,
 ) -> Optional[List[data_models.ImageDetailResult]]:
-    # Build the main SQL query
-    search_query = f"""
-    WITH fts_ranked_title_caption_tags AS (
-        SELECT
-            uuid,
-            row_number() OVER (
-                ORDER BY ts_rank_cd(title_caption_tags_fts_vector, websearch_to_tsquery(%(query_text)s)) DESC
-            ) AS rank_ix
-        FROM image_detail
-        WHERE title_caption_tags_fts_vector @@ websearch_to_tsquery(%(query_text)s)
-        AND user_id = %(user_id)s
+    """
+    Hybrid full-text + semantic search merged with reciprocal rank fusion.
+    ef_search trades speed for recall of the HNSW scan (defaults to HNSW_EF_SEARCH).
+    """
+    tags = normalize_tags(tags)
+
+    # the in-process backend ranks the whole library, so only use it when no filter narrows the result
+    semantic_candidates = None
+    if not (season or tags or coordinates or date_from or date_to):
+        backend = vector_search.get_backend(user_id, lambda: _count_user_images(conn, user_id))
+        semantic_candidates = backend.top_k(
+            user_id,
+            query_embedding,
+            min(match_count, 30) * 2,
+            lambda: _get_embedding_version(conn, user_id),
+            lambda: _iter_user_embeddings(conn, user_id),
+        )
+
+    filters = f"""
         AND COALESCE(season = COALESCE(%(season)s, season), TRUE)
         AND COALESCE((%(longitude)s IS NULL OR %(latitude)s IS NULL OR ST_DWithin(
             coordinates,
@@ -83,28 +612,25 @@ def get_search_query_result(
         )), TRUE)
         AND COALESCE(capture_time >= COALESCE(%(date_from)s, capture_time), TRUE)
         AND COALESCE(capture_time <= COALESCE(%(date_to)s, capture_time), TRUE)
-        ORDER BY rank_ix
-        LIMIT LEAST(%(match_count)s, 30) * 2
-    ),
-    semantic AS (
+        {_tag_filter(tags, tag_mode)}
+    """
+
+    # Build the main SQL query
+    search_query = f"""
+    WITH fts_ranked_title_caption_tags AS (
         SELECT
             uuid,
             row_number() OVER (
-                ORDER BY image_detail.embedding_vector <#> %(query_embedding)s::vector
+                ORDER BY ts_rank_cd(title_caption_tags_fts_vector, websearch_to_tsquery(%(query_text)s)) DESC
             ) AS rank_ix
         FROM image_detail
-        WHERE user_id = %(user_id)s
-        AND COALESCE(season = COALESCE(%(season)s, season), TRUE)
-        AND COALESCE((%(longitude)s IS NULL OR %(latitude)s IS NULL OR ST_DWithin(
-            coordinates,
-            ST_MakePoint(%(longitude)s, %(latitude)s)::geography,
-            %(distance_radius)s
-        )), TRUE)
-        AND COALESCE(capture_time >= COALESCE(%(date_from)s, capture_time), TRUE)
-        AND COALESCE(capture_time <= COALESCE(%(date_to)s, capture_time), TRUE)
+        WHERE title_caption_tags_fts_vector @@ websearch_to_tsquery(%(query_text)s)
+        AND user_id = %(user_id)s
+        {filters}
         ORDER BY rank_ix
         LIMIT LEAST(%(match_count)s, 30) * 2
-    )
+    ),
+    {semantic_cte(filters, precomputed=semantic_candidates is not None)}
     SELECT
         image_detail.url,
         image_detail.user_id,
@@ -122,6 +648,7 @@ def get_search_query_result(
     FROM fts_ranked_title_caption_tags
         FULL OUTER JOIN semantic ON fts_ranked_title_caption_tags.uuid = semantic.uuid
         JOIN image_detail ON COALESCE(fts_ranked_title_caption_tags.uuid, semantic.uuid) = image_detail.uuid
+            AND image_detail.user_id = %(user_id)s
     ORDER BY
         COALESCE(1.0 / (%(rrf_k)s + fts_ranked_title_caption_tags.rank_ix), 0.0) * %(full_text_weight)s +
         COALESCE(1.0 / (%(rrf_k)s + semantic.rank_ix), 0.0) * %(semantic_weight)s DESC
@@ -134,7 +661,7 @@ def get_search_query_result(
         "query_embedding": query_embedding,
         "user_id": user_id,
         "season": season,
-        "tags": ",".join(tags) if tags else None,
+        "tags": tags if tags else None,
         "longitude": coordinates[0] if coordinates else None,
         "latitude": coordinates[1] if coordinates else None,
         "distance_radius": distance_radius,
@@ -144,17 +671,211 @@ def get_search_query_result(
         "full_text_weight": full_text_weight,
         "semantic_weight": semantic_weight,
         "rrf_k": rrf_k,
+        "rerank_candidates": RERANK_CANDIDATES,
+        "semantic_candidates": semantic_candidates,
     }
-    filled_query = search_query % params
-    print("Executing query:", filled_query)
-
     # Execute the query
     with conn.cursor() as cur:
+        if semantic_candidates is None:
+            set_hnsw_search_params(cur, ef_search)
         cur.execute(sql.SQL(search_query), params)
         result = cur.fetchall()
         return [data_models.ImageDetailResult(*x) for x in result] if result else None
 
 
+def _count_user_images(conn, user_id: str) -> int:
+    with conn.cursor() as cur:
+        cur.execute("SELECT count(*) FROM image_detail WHERE user_id = %s", (user_id,))
+        return int(cur.fetchone()[0])
+
+
+def _get_embedding_version(conn, user_id: str) -> int:
+    """Version of the user's embeddings, bumped by a trigger on every insert, delete or re-embedding"""
+    with conn.cursor() as cur:
+        cur.execute("SELECT version FROM image_embedding_version WHERE user_id = %s", (user_id,))
+        row = cur.fetchone()
+        return int(row[0]) if row else 0
+
+
+def _append_to_vector_cache(cur, entries: list[tuple]):
+    """After the commit, add inserted image_detail entries to the vector_search cache of their users"""
+    user_ids = list({entry[7] for entry in entries})
+    # the version rows stay locked by the insert's trigger until commit, so these are the committed versions
+    cur.execute(
+        "SELECT user_id, previous_version, version FROM image_embedding_version WHERE user_id = ANY(%s)",
+        (user_ids,),
+    )
+    for user_id, previous_version, version in cur.fetchall():
+        rows = [(entry[0], entry[6]) for entry in entries if entry[7] == user_id]
+        after_commit(lambda u=user_id, r=rows, p=previous_version, v=version: vector_search.append(u, r, p, v))
+
+
+def _iter_user_embeddings(conn, user_id: str):
+    """Stream (uuid, embedding) for all images of a user with a server-side cursor"""
+    with conn.cursor(name=f"embeddings_{uuid.uuid4().hex}") as cur:
+        cur.itersize = 2000
+        cur.execute(
+            "SELECT uuid, embedding_vector::real[] FROM image_detail WHERE user_id = %s AND embedding_vector IS NOT NULL",
+            (user_id,),
+        )
+        for image_uuid, embedding in cur:
+            yield str(image_uuid), embedding
+
+
+@with_read_connection
+def get_images_by_tags(
+    conn, user_id: str, tags: list[str], tag_mode: str = "any", match_count: int = 50
+) -> Optional[List[data_models.ImageDetailResult]]:
+    """Tag-only lookup (no query text), answered from the GIN index on tags"""
+    tags = normalize_tags(tags)
+    if not tags:
+        return None
+    select_query = f"""
+    SELECT url, user_id, thumbnail_url, title, caption, tags, coordinates, capture_time,
+           extended_meta, season, uuid, updated_at, created_at
+    FROM image_detail
+    WHERE user_id = %(user_id)s
+    {_tag_filter(tags, tag_mode)}
+    ORDER BY created_at DESC
+    LIMIT %(match_count)s
+    """
+    params = {"user_id": user_id, "tags": tags, "match_count": match_count}
+    with conn.cursor() as cur:
+        cur.execute(select_query, params)
+        result = cur.fetchall()
+        return [data_models.ImageDetailResult(*x) for x in result] if result else None
+
+
+# ===
+# Facets
+# ===
+def _group_facets(rows: list[tuple]) -> dict[str, list[tuple[str, int]]]:
+    facets: dict[str, list[tuple[str, int]]] = {"season": [], "year": [], "month": [], "tag": []}
+    for facet, value, count in rows:
+        facets.setdefault(facet, []).append((value, int(count)))
+    return facets
+
+
+@with_read_connection
+def get_facets(conn, user_id: str, tag_limit: int = 50) -> dict[str, list[tuple[str, int]]]:
+    """
+    Facet counts for the whole library, read from the trigger-maintained image_facet table.
+    Cost is O(facets) for the user, not O(images).
+    """
+    select_query = """
+    SELECT facet, value, count FROM (
+        SELECT facet, value, count,
+               row_number() OVER (PARTITION BY facet ORDER BY count DESC, value) AS rn
+        FROM image_facet
+        WHERE user_id = %(user_id)s AND count > 0
+    ) AS f
+    WHERE facet <> 'tag' OR rn <= %(tag_limit)s
+    """
+    with conn.cursor() as cur:
+        cur.execute(select_query, {"user_id": user_id, "tag_limit": tag_limit})
+        return _group_facets(cur.fetchall())
+
+
+@with_read_connection
+def get_facets_for_search(
+    conn,
+    user_id: str,
+    query_text: Optional[str] = None,
+    tags: Optional[list[str]] = None,
+    tag_mode: str = "any",
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    bbox: Optional[tuple[float, float, float, float]] = None,  # (min_lon, min_lat, max_lon, max_lat)
+    tag_limit: int = 50,
+) -> dict[str, list[tuple[str, int]]]:
+    """
+    Facet counts over every image matching an active search: the full-text query, tags, capture date range
+    and bounding box. Aggregated in one query over the whole filtered set, not just the page of results.
+    """
+    tags = normalize_tags(tags)
+    select_query = f"""
+    SELECT facet, value, count FROM (
+        SELECT r.facet, r.value, count(*) AS count,
+               row_number() OVER (PARTITION BY r.facet ORDER BY count(*) DESC, r.value) AS rn
+        FROM image_detail d, image_facet_rows(d.season, d.capture_time, d.tags) r
+        WHERE d.user_id = %(user_id)s
+        AND (%(query_text)s::text IS NULL OR d.title_caption_tags_fts_vector @@ websearch_to_tsquery(%(query_text)s))
+        AND COALESCE(d.capture_time >= COALESCE(%(date_from)s, d.capture_time), TRUE)
+        AND COALESCE(d.capture_time <= COALESCE(%(date_to)s, d.capture_time), TRUE)
+        {_bbox_filter(bbox, "d.coordinates")}
+        {_tag_filter(tags, tag_mode)}
+        GROUP BY r.facet, r.value
+    ) AS f
+    WHERE facet <> 'tag' OR rn <= %(tag_limit)s
+    """
+    params = {
+        "user_id": user_id,
+        "query_text": query_text or None,
+        "tags": tags if tags else None,
+        "date_from": date_from,
+        "date_to": date_to,
+        "tag_limit": tag_limit,
+    }
+    if bbox:
+        params.update(zip(("min_lon", "min_lat", "max_lon", "max_lat"), bbox))
+    with conn.cursor() as cur:
+        cur.execute(select_query, params)
+        return _group_facets(cur.fetchall())
+
+
+# ===
+# Map
+# ===
+@with_read_connection
+def get_map_clusters(
+    conn,
+    user_id: str,
+    min_lon: float,
+    min_lat: float,
+    max_lon: float,
+    max_lat: float,
+    zoom: int,
+) -> List[data_models.MapCluster]:
+    """
+    Snap geotagged images inside the bounding box to a grid whose cell size follows the zoom level
+    and return one row per non-empty cell. The bounding box filter uses idx_image_detail_coordinates,
+    and the number of clusters is bounded by the viewport, not by the size of the library. min_lon > max_lon
+    is a box crossing the antimeridian.
+    """
+    cell_size = 360.0 / (2**zoom * MAP_CELLS_PER_TILE)  # degrees
+    select_query = f"""
+    WITH clusters AS (
+        SELECT
+            ST_SnapToGrid(coordinates, %(cell_size)s) AS cell,
+            count(*) AS count,
+            ST_Centroid(ST_Collect(coordinates)) AS center,
+            min(uuid::text) AS representative
+        FROM image_detail
+        WHERE user_id = %(user_id)s
+        {_bbox_filter((min_lon, min_lat, max_lon, max_lat))}
+        GROUP BY cell
+        ORDER BY count DESC
+        LIMIT %(max_clusters)s
+    )
+    SELECT ST_X(clusters.center), ST_Y(clusters.center), clusters.count, image_detail.uuid, image_detail.thumbnail_url
+    FROM clusters
+        JOIN image_detail ON image_detail.uuid = clusters.representative::uuid AND image_detail.user_id = %(user_id)s
+    ORDER BY clusters.count DESC
+    """
+    params = {
+        "user_id": user_id,
+        "cell_size": cell_size,
+        "min_lon": min_lon,
+        "min_lat": min_lat,
+        "max_lon": max_lon,
+        "max_lat": max_lat,
+        "max_clusters": MAP_MAX_CLUSTERS,
+    }
+    with conn.cursor() as cur:
+        cur.execute(select_query, params)
+        return [data_models.MapCluster(*x) for x in cur.fetchall()]
+
+
 # ===
 # ImageDetail
 # ===
@@ -165,10 +886,10 @@ def insert(
     thumbnail_url: str,
     title: str,
     caption: str,
-    tags: str,
+    tags: Optional[list[str]],
     embedded_vector: list[float],
     user_id: str,
-    coordinates: Optional[list[float]] = None,
+    coordinates: Optional[list[float]] = None,  # [longitude, latitude]
     capture_time: Optional[str] = None,
     extended_meta: Optional[str] = None,
     season: Optional[str] = None,
@@ -179,7 +900,7 @@ def insert(
         thumbnail_url,
         title,
         caption,
-        tags,
+        normalize_tags(tags),
         embedded_vector,
         user_id,
         f"POINT({coordinates[0]} {coordinates[1]})" if coordinates is not None else None,
@@ -190,27 +911,87 @@ def insert(
     insert_query = """
                INSERT INTO image_detail (
                    uuid, url, thumbnail_url, title, caption, tags, embedding_vector, user_id, coordinates, capture_time, extended_meta, season
-               ) VALUES (%s, %s, %s, %s, %s, %s, %s::float8[], %s, ST_GeomFromText(%s), to_timestamp(%s, 'DD/MM/YYYY'), %s::json, %s)
+               ) VALUES (%s, %s, %s, %s, %s, %s, %s::float8[], %s, ST_GeomFromText(%s, 4326), to_timestamp(%s, 'DD/MM/YYYY'), %s::json, %s)
            """
     with conn.cursor() as cur:
         cur.execute(insert_query, entry)
+        _append_to_vector_cache(cur, [entry])
     return entry[0]  # uuid
 
 @with_connection
-def update_with_title_tags_caption(conn, uuid, title, caption, tags):
-    update_query = 'UPDATE image_detail SET title = %s, caption = %s, tags = %s WHERE uuid = %s'
-    with conn.cursor() as cur: cur.execute(update_query, (title, caption, tags, uuid))
+def insert_many(conn, images: list[dict], file_queues: Optional[list[FileQueue]] = None) -> list[str]:
+    """
+    Bulk insert; images are dicts of insert()'s keyword arguments. If given, file_queues[i] is queued for
+    images[i] (image_id filled in) in the same transaction. Returns the uuids in order.
+    """
+    if not images:
+        return []
+    entries = [
+        (
+            str(uuid.uuid4()),
+            x["url"],
+            x["thumbnail_url"],
+            x.get("title"),
+            x.get("caption"),
+            normalize_tags(x.get("tags")),
+            x["embedded_vector"],
+            x["user_id"],
+            f"POINT({x['coordinates'][0]} {x['coordinates'][1]})" if x.get("coordinates") is not None else None,
+            x.get("capture_time"),
+            x.get("extended_meta"),
+            x.get("season"),
+        )
+        for x in images
+    ]
+    insert_query = """
+    INSERT INTO image_detail (
+        uuid, url, thumbnail_url, title, caption, tags, embedding_vector, user_id, coordinates, capture_time, extended_meta, season
+    ) VALUES %s
+    """
+    with conn.cursor() as cur:
+        psycopg2.extras.execute_values(
+            cur,
+            insert_query,
+            entries,
+            template="""(%s, %s, %s, %s, %s, %s::text[], %s::float8[], %s, ST_GeomFromText(%s, 4326),
+                         to_timestamp(%s, 'DD/MM/YYYY'), %s::json, %s)""",
+        )
+        if file_queues:
+            psycopg2.extras.execute_values(
+                cur,
+                """
+                INSERT INTO FileQueue (
+                    tmp_file_loc, tag_list, access_token, user_id, image_id, batch_id,
+                    is_saved_to_db, is_cleaned_from_disk
+                ) VALUES %s
+                """,
+                [
+                    (x.tmp_file_loc, x.tag_list, x.access_token, x.user_id, entry[0], x.batch_id,
+                     x.is_saved_to_db, x.is_cleaned_from_disk)
+                    for x, entry in zip(file_queues, entries)
+                ],
+            )
+        _append_to_vector_cache(cur, entries)
+    return [entry[0] for entry in entries]
+
+
+@with_connection
+def update_with_title_tags_caption(conn, uuid, user_id: str, title, caption, tags: list[str]):
+    update_query = 'UPDATE image_detail SET title = %s, caption = %s, tags = %s WHERE uuid = %s AND user_id = %s'
+    with conn.cursor() as cur: cur.execute(update_query, (title, caption, normalize_tags(tags), uuid, user_id))
 
 @with_connection
-def update_tags(conn, uuid: str, tags: str):
+def update_tags(conn, uuid: str, user_id: str, tags: list[str]) -> bool:
+    """False if the user has no such image"""
     update_query = """
-    UPDATE image_detail SET tags = %s WHERE uuid = %s"""
+    UPDATE image_detail SET tags = %s WHERE uuid = %s AND user_id = %s"""
 
     with conn.cursor() as cur:
-        cur.execute(update_query, (tags, uuid))
+        cur.execute(update_query, (normalize_tags(tags), uuid, user_id))
+        return bool(cur.rowcount > 0)
 
 
-@with_connection
+@with_connection  # a dedup check ahead of an insert, so never against a replica
 def check_image_exists(conn, url: str, user_id: str) -> bool:
     check_query = """
     SELECT EXISTS (
@@ -221,8 +1002,7 @@ def check_image_exists(conn, url: str, user_id: str) -> bool:
     with conn.cursor() as cur:
         cur.execute(check_query, params)
         res = cur.fetchone()
-        print(res)
-        return res[0]
+        return bool(res[0])
 
 
 # ===
@@ -250,12 +1030,10 @@ def create_user(conn, user: User) -> None:
       'cursor': user.cursor,
       'initials': user.initials,
     }
-    filled_query = insert_query % params
-    print("Executing query:", filled_query)
     with conn.cursor() as cur:
         cur.execute(insert_query, params)
 
-@with_connection
+@with_read_connection
 def read_user(conn, user_id: str) -> Optional[User]:
     select_query = """
     SELECT user_id, user_name, email, access_token, refresh_token, template_id, cursor, initials
@@ -296,6 +1074,20 @@ def update_user(conn, user_id: str, user: User):
         cur.execute(update_query, params)
 
 
+@with_connection
+def update_user_cursor(conn, user_id: str, cursor: Optional[str]):
+    """Checkpoint the Dropbox list_folder cursor of a user after each page"""
+    with conn.cursor() as cur:
+        cur.execute("UPDATE users SET cursor = %s WHERE user_id = %s", (cursor, user_id))
+
+
+@with_connection
+def update_access_token(conn, user_id: str, access_token: str):
+    """Only the token, so a refresh can't overwrite a cursor saved meanwhile"""
+    with conn.cursor() as cur:
+        cur.execute("UPDATE users SET access_token = %s WHERE user_id = %s", (access_token, user_id))
+
+
 @with_connection
 def delete_user(conn, user_id: str):
     delete_query = """
@@ -319,25 +1111,227 @@ def get_all_users(conn) -> List[User]:
 
 
 # ===
-# FileQueue
+# Queue events
 # ===
-@with_connection
-def create_file_queue(conn, file_queue: FileQueue):
-    insert_query = """
-    INSERT INTO FileQueue (
-        tmp_file_loc, tag_list, access_token, user_id, image_id, batch_id,
-        is_saved_to_db, is_cleaned_from_disk
-    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+class Listener:
     """
-    with conn.cursor() as cur:
-        cur.execute(
-            insert_query,
-            (
-                file_queue.tmp_file_loc,
-                file_queue.tag_list,
-                file_queue.access_token,
-                file_queue.user_id,
-                file_queue.image_id,
+    Dedicated autocommit connection that LISTENs on NOTIFY channels (see notify_channel() in DDL.sql).
+    wait() blocks until a notification arrives or the timeout passes, so workers react to new work
+    right away and only fall back to a slow safety poll.
+    """
+
+    def __init__(self, *channels: str):
+        self.channels = channels
+        self.conn: Optional[psycopg2.extensions.connection] = None
+
+    def _connect(self):
+        self.conn = _connect_primary()
+        self.conn.autocommit = True
+        with self.conn.cursor() as cur:
+            for channel in self.channels:
+                cur.execute(f"LISTEN {channel}")
+
+    def wait(self, timeout: float) -> list[str]:
+        """Returns the channels that were notified; empty on timeout"""
+        try:
+            if self.conn is None or self.conn.closed:
+                self._connect()
+            self.conn.poll()
+            if not self.conn.notifies and select.select([self.conn], [], [], max(timeout, 0)) != ([], [], []):
+                self.conn.poll()
+            channels = [n.channel for n in self.conn.notifies]
+            self.conn.notifies.clear()
+            return channels
+        except psycopg2.Error as e:
+            # reconnect on the next call; the caller's safety poll covers anything missed meanwhile
+            print("Listener connection lost:", e)
+            if self.conn is not None:
+                self.conn.close()
+            self.conn = None
+            time.sleep(min(max(timeout, 0), 5))
+            return []
+
+
+# ===
+# Fair share
+# ===
+def _fair_claim_query(table: str, keys: str, where: str, order_by: str, returning: str) -> str:
+    """
+    Claim query for a queue shared by users, as weighted fair queuing: every user's waiting rows are numbered
+    oldest first (by order_by), and the n-th row of a user with weight w is served at n / w. A user with a
+    thousand rows waiting thus gets as many rows of a claim as one with a few, not all of them. Users capped
+    in TenantShare get at most that many rows per claim. Only the first limit (or cap) rows of each user are
+    candidates, read from an index on (user_id, order_by), so a claim costs the same however long the backlog.
+    Takes worker_id, lease_secs, limit, default_weight and default_cap parameters; table, keys, where and
+    order_by are SQL, never user input.
+    """
+    return f"""
+    UPDATE {table} SET claimed_by = %(worker_id)s, claimed_until = now() + make_interval(secs => %(lease_secs)s)
+    WHERE ({keys}) IN (
+        SELECT {keys} FROM {table}
+        WHERE ({keys}) IN (
+            SELECT {keys} FROM (
+                SELECT c.*, COALESCE(t.weight, %(default_weight)s) AS weight,
+                       row_number() OVER (PARTITION BY u.user_id ORDER BY c.queued_at) AS user_rank
+                FROM users u
+                LEFT JOIN TenantShare t ON t.user_id = u.user_id
+                CROSS JOIN LATERAL (
+                    SELECT {", ".join(f"q.{k.strip()}" for k in keys.split(","))}, q.{order_by} AS queued_at
+                    FROM {table} q
+                    WHERE q.user_id = u.user_id AND {where}
+                    AND (q.claimed_until IS NULL OR q.claimed_until < now())
+                    ORDER BY q.{order_by}
+                    LIMIT LEAST(%(limit)s, COALESCE(t.max_per_claim, NULLIF(%(default_cap)s, 0), %(limit)s))
+                ) AS c
+            ) AS ranked
+            ORDER BY user_rank / weight, queued_at
+            LIMIT %(limit)s
+        )
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING {returning}
+    """
+
+
+def _fair_claim_params(worker_id: str, limit: int, lease_secs: int) -> dict:
+    return {
+        "worker_id": worker_id,
+        "limit": limit,
+        "lease_secs": lease_secs,
+        "default_weight": FAIR_SHARE_DEFAULT_WEIGHT,
+        "default_cap": FAIR_SHARE_DEFAULT_CAP,
+    }
+
+
+@with_connection
+def get_tenant_share(conn, user_id: str) -> tuple[float, Optional[int]]:
+    """(weight, max rows per claim or None) of the user"""
+    with conn.cursor() as cur:
+        cur.execute("SELECT weight, max_per_claim FROM TenantShare WHERE user_id = %s", (user_id,))
+        row = cur.fetchone()
+    if row is None:
+        return FAIR_SHARE_DEFAULT_WEIGHT, FAIR_SHARE_DEFAULT_CAP or None
+    return row[0], row[1]
+
+
+@with_connection
+def set_tenant_share(conn, user_id: str, weight: float, max_per_claim: Optional[int] = None):
+    upsert_query = """
+    INSERT INTO TenantShare (user_id, weight, max_per_claim) VALUES (%s, %s, %s)
+    ON CONFLICT (user_id) DO UPDATE SET
+        weight = EXCLUDED.weight, max_per_claim = EXCLUDED.max_per_claim, updated_at = now()
+    """
+    with conn.cursor() as cur:
+        cur.execute(upsert_query, (user_id, weight, max_per_claim))
+
+
+# ===
+# Worker leases
+# ===
+@with_connection
+def acquire_lease(conn, name: str, owner: str, lease_secs: int = 600) -> bool:
+    """Take (or extend) the named lease for owner. False if another owner holds an unexpired lease"""
+    upsert_query = """
+    INSERT INTO worker_lease (name, owner, expires_at)
+    VALUES (%(name)s, %(owner)s, now() + make_interval(secs => %(lease_secs)s))
+    ON CONFLICT (name) DO UPDATE SET owner = EXCLUDED.owner, expires_at = EXCLUDED.expires_at
+    WHERE worker_lease.owner = EXCLUDED.owner OR worker_lease.expires_at < now()
+    RETURNING name
+    """
+    with conn.cursor() as cur:
+        cur.execute(upsert_query, {"name": name, "owner": owner, "lease_secs": lease_secs})
+        return cur.fetchone() is not None
+
+
+@with_connection
+def release_lease(conn, name: str, owner: str):
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM worker_lease WHERE name = %s AND owner = %s", (name, owner))
+
+
+@with_connection
+def renew_leases(conn, owner: str, lease_secs: int = 600) -> list[str]:
+    """
+    Heartbeat: push back the expiry of every lease and queue claim owner still holds, so long-running
+    work isn't taken over by another worker. Anything already expired stays lost. Returns the lease names held.
+    """
+    params = {"owner": owner, "lease_secs": lease_secs}
+    with conn.cursor() as cur:
+        # submitted files keep their claim until it lapses; only files still waiting for a batch need it
+        cur.execute(
+            """
+            UPDATE FileQueue SET claimed_until = now() + make_interval(secs => %(lease_secs)s)
+            WHERE claimed_by = %(owner)s AND claimed_until >= now() AND batch_id IS NULL
+            """,
+            params,
+        )
+        cur.execute(
+            """
+            UPDATE BatchQueue SET claimed_until = now() + make_interval(secs => %(lease_secs)s)
+            WHERE claimed_by = %(owner)s AND claimed_until >= now()
+            """,
+            params,
+        )
+        cur.execute(
+            """
+            UPDATE DropboxWriteback SET claimed_until = now() + make_interval(secs => %(lease_secs)s)
+            WHERE claimed_by = %(owner)s AND claimed_until >= now()
+            """,
+            params,
+        )
+        cur.execute(
+            """
+            UPDATE IngestJobFile SET claimed_until = now() + make_interval(secs => %(lease_secs)s)
+            WHERE claimed_by = %(owner)s AND claimed_until >= now()
+            """,
+            params,
+        )
+        cur.execute(
+            """
+            UPDATE worker_lease SET expires_at = now() + make_interval(secs => %(lease_secs)s)
+            WHERE owner = %(owner)s AND expires_at >= now()
+            RETURNING name
+            """,
+            params,
+        )
+        return [row[0] for row in cur.fetchall()]
+
+
+@with_connection
+def release_all_leases(conn, owner: str):
+    """Hand back everything owner holds, on clean shutdown"""
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM worker_lease WHERE owner = %s", (owner,))
+        cur.execute("UPDATE FileQueue SET claimed_by = NULL, claimed_until = NULL WHERE claimed_by = %s", (owner,))
+        cur.execute("UPDATE BatchQueue SET claimed_by = NULL, claimed_until = NULL WHERE claimed_by = %s", (owner,))
+        cur.execute(
+            "UPDATE DropboxWriteback SET claimed_by = NULL, claimed_until = NULL WHERE claimed_by = %s", (owner,)
+        )
+        cur.execute(
+            "UPDATE IngestJobFile SET claimed_by = NULL, claimed_until = NULL WHERE claimed_by = %s", (owner,)
+        )
+
+
+# ===
+# FileQueue
+# ===
+@with_connection
+def create_file_queue(conn, file_queue: FileQueue):
+    insert_query = """
+    INSERT INTO FileQueue (
+        tmp_file_loc, tag_list, access_token, user_id, image_id, batch_id,
+        is_saved_to_db, is_cleaned_from_disk
+    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            insert_query,
+            (
+                file_queue.tmp_file_loc,
+                file_queue.tag_list,
+                file_queue.access_token,
+                file_queue.user_id,
+                file_queue.image_id,
                 file_queue.batch_id,
                 file_queue.is_saved_to_db,
                 file_queue.is_cleaned_from_disk,
@@ -409,6 +1403,107 @@ def get_unbatched_files(conn) -> list[FileQueue] | None:
         return [FileQueue(*result) for result in results] if results else None
 
 
+@with_connection
+def get_unbatched_files_stats(conn, limit: int = 50) -> tuple[int, Optional[datetime]]:
+    """(number of unclaimed unbatched files, capped at limit; created_at of the oldest one)"""
+    select_query = """
+    SELECT count(*), min(created_at) FROM (
+        SELECT created_at FROM FileQueue
+        WHERE batch_id IS NULL AND is_saved_to_db = FALSE
+        AND (claimed_until IS NULL OR claimed_until < now())
+        ORDER BY created_at
+        LIMIT %s
+    ) AS unbatched
+    """
+    with conn.cursor() as cur:
+        cur.execute(select_query, (limit,))
+        count, oldest = cur.fetchone()
+        return count, oldest
+
+
+@with_connection
+def claim_unbatched_files(conn, worker_id: str, limit: int = 50, lease_secs: int = 600) -> list[FileQueue]:
+    """
+    Claim up to limit unbatched files for worker_id, shared fairly among users (see _fair_claim_query),
+    oldest first within a user. Rows locked or claimed by another worker are skipped; a claim lapses after
+    lease_secs if the worker dies.
+    """
+    claim_query = _fair_claim_query(
+        "FileQueue",
+        "tmp_file_loc",
+        "q.batch_id IS NULL AND q.is_saved_to_db = FALSE",
+        "created_at",
+        """tmp_file_loc, tag_list, access_token, user_id, image_id, batch_id,
+              is_saved_to_db, is_cleaned_from_disk, created_at, updated_at""",
+    )
+    with conn.cursor() as cur:
+        cur.execute(claim_query, _fair_claim_params(worker_id, limit, lease_secs))
+        results = [FileQueue(*result) for result in cur.fetchall()]
+        return sorted(results, key=lambda x: x.created_at)
+
+
+@with_connection
+def release_file_claims(conn, worker_id: str, tmp_file_locs: list[str]):
+    update_query = """
+    UPDATE FileQueue SET claimed_by = NULL, claimed_until = NULL
+    WHERE claimed_by = %s AND tmp_file_loc = ANY(%s)
+    """
+    with conn.cursor() as cur:
+        cur.execute(update_query, (worker_id, tmp_file_locs))
+
+
+@with_connection
+def set_files_batch(conn, worker_id: str, tmp_file_locs: list[str], batch_queue: BatchQueue):
+    """
+    Record a submitted batch and mark the claimed files as part of it, in one transaction, so files are
+    never in a batch nobody polls. Hands back the files' claims.
+    """
+    update_query = """
+    UPDATE FileQueue SET batch_id = %s, claimed_by = NULL, claimed_until = NULL
+    WHERE claimed_by = %s AND tmp_file_loc = ANY(%s)
+    """
+    with conn.cursor() as cur:
+        _insert_batch_queue(cur, batch_queue)
+        cur.execute(update_query, (batch_queue.batch_id, worker_id, tmp_file_locs))
+
+
+# batch_id of files that can't be put in a batch (dead-lettered); db.requeue_file puts them back in line
+UNBATCHABLE_BATCH_ID = "unbatchable"
+
+
+@with_connection
+def requeue_batch_files(conn, batch_id: str, max_attempts: int) -> list[tuple[str, str, int, bool]]:
+    """
+    Count a failed attempt for every unsaved file of a batch that ended without output (failed, expired,
+    cancelled) and put it back in line for the next batch; files that reached max_attempts are parked as
+    unbatchable instead. Returns (tmp_file_loc, user_id, attempts, parked) per file. Running it again for the
+    same batch finds no files.
+    """
+    update_query = """
+    UPDATE FileQueue SET
+        batch_attempts = batch_attempts + 1,
+        batch_id = CASE WHEN batch_attempts + 1 < %(max_attempts)s THEN NULL ELSE %(unbatchable)s END,
+        claimed_by = NULL,
+        claimed_until = NULL
+    WHERE batch_id = %(batch_id)s AND is_saved_to_db = FALSE
+    RETURNING tmp_file_loc, user_id, batch_attempts, batch_id IS NOT NULL
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            update_query, {"batch_id": batch_id, "max_attempts": max_attempts, "unbatchable": UNBATCHABLE_BATCH_ID}
+        )
+        return [tuple(row) for row in cur.fetchall()]
+
+
+@with_connection
+def park_unbatchable_file(conn, tmp_file_loc: str):
+    update_query = """
+    UPDATE FileQueue SET batch_id = %s, claimed_by = NULL, claimed_until = NULL WHERE tmp_file_loc = %s
+    """
+    with conn.cursor() as cur:
+        cur.execute(update_query, (UNBATCHABLE_BATCH_ID, tmp_file_loc))
+
+
 @with_connection
 def get_uncleaned_files(conn) -> list[FileQueue] | None:
     """
@@ -436,6 +1531,95 @@ def mark_file_as_saved(conn, tmp_file_loc: str):
         cur.execute(update_query, (tmp_file_loc,))
 
 
+@with_connection
+def get_saved_files(conn, tmp_file_locs: list[str]) -> set[str]:
+    """The subset of tmp_file_locs already marked as saved"""
+    select_query = """
+    SELECT tmp_file_loc FROM FileQueue WHERE tmp_file_loc = ANY(%s) AND is_saved_to_db = TRUE
+    """
+    with conn.cursor() as cur:
+        cur.execute(select_query, (tmp_file_locs,))
+        return {row[0] for row in cur.fetchall()}
+
+
+@with_connection
+def get_live_files(conn, tmp_file_locs: list[str]) -> set[str]:
+    """
+    The subset of tmp_file_locs still needed on disk: files not cleaned yet, uploads not ingested yet and
+    dead-lettered uploads, which a redrive may need
+    """
+    select_query = """
+    SELECT tmp_file_loc FROM FileQueue WHERE tmp_file_loc = ANY(%s) AND is_cleaned_from_disk = FALSE
+    UNION
+    SELECT tmp_file_loc FROM IngestJobFile WHERE tmp_file_loc = ANY(%s) AND status = 'stored'
+    UNION
+    SELECT key FROM DeadLetter WHERE kind = 'upload' AND key = ANY(%s)
+    """
+    with conn.cursor() as cur:
+        cur.execute(select_query, (tmp_file_locs, tmp_file_locs, tmp_file_locs))
+        return {row[0] for row in cur.fetchall()}
+
+
+@with_connection
+def get_known_files(conn, user_id: str, urls: list[str], tmp_file_locs: list[str]) -> set[str]:
+    """
+    The urls (paired with tmp_file_locs) already in image_detail for the user or already queued in FileQueue,
+    for a whole Dropbox listing page in one query.
+    """
+    select_query = """
+    SELECT f.url FROM unnest(%s::text[], %s::text[]) AS f(url, tmp_file_loc)
+    WHERE EXISTS (SELECT 1 FROM image_detail d WHERE d.user_id = %s AND d.url = f.url)
+       OR EXISTS (SELECT 1 FROM FileQueue q WHERE q.tmp_file_loc = f.tmp_file_loc)
+    """
+    with conn.cursor() as cur:
+        cur.execute(select_query, (urls, tmp_file_locs, user_id))
+        return {row[0] for row in cur.fetchall()}
+
+
+@with_connection
+def save_captions(
+    conn,
+    rows: list[tuple[str, str, str, str, str, list[str]]],
+    writebacks: Optional[list[DropboxWriteback]] = None,
+    merge_tags: bool = False,
+):
+    """
+    rows of (tmp_file_loc, image uuid, user_id, title, caption, tags). Updates the images, queues their Dropbox
+    writebacks and marks their files as saved in one transaction, so a crashed finalization resumes after
+    the last saved chunk. The tags replace the image's current (zero-shot) tags, or with merge_tags come
+    before them.
+    """
+    if not rows:
+        return
+    if merge_tags:
+        tags = """ARRAY(
+            SELECT t FROM unnest(v.tags || COALESCE(d.tags, '{}')) WITH ORDINALITY AS u (t, i) GROUP BY t ORDER BY min(i)
+        )"""
+    else:
+        tags = "v.tags"
+    update_query = f"""
+    UPDATE image_detail AS d SET title = v.title, caption = v.caption, tags = {tags}
+    FROM (VALUES %s) AS v (uuid, user_id, title, caption, tags)
+    WHERE d.uuid = v.uuid AND d.user_id = v.user_id
+    """
+    with conn.cursor() as cur:
+        psycopg2.extras.execute_values(
+            cur,
+            update_query,
+            [
+                (uuid, user_id, title, caption, normalize_tags(tags))
+                for _, uuid, user_id, title, caption, tags in rows
+            ],
+            template="(%s::uuid, %s, %s, %s, %s::text[])",
+        )
+        cur.execute(
+            "UPDATE FileQueue SET is_saved_to_db = TRUE WHERE tmp_file_loc = ANY(%s)", ([row[0] for row in rows],)
+        )
+        wrote_for(row[2] for row in rows)
+        if writebacks:
+            _enqueue_dropbox_writebacks(cur, writebacks)
+
+
 @with_connection
 def get_files_by_batch_id(conn, batch_id: str) -> Optional[List[FileQueue]]:
     select_query = """
@@ -458,14 +1642,13 @@ def is_file_saved_to_db(conn, tmp_file_loc: str) -> bool:
     with conn.cursor() as cur:
         cur.execute(select_query, (tmp_file_loc,))
         result = cur.fetchone()
-        return result[0] if result else False
+        return bool(result[0]) if result else False
 
 
 # ===
 # BatchQueue
 # ===
-@with_connection
-def create_batch_queue(conn, batch_queue: BatchQueue):
+def _insert_batch_queue(cur, batch_queue: BatchQueue):
     insert_query = """
     INSERT INTO BatchQueue (
         batch_id, input_file_id, batch_jsonl_filepath, batch_metadata_filepath, status,
@@ -473,21 +1656,26 @@ def create_batch_queue(conn, batch_queue: BatchQueue):
         are_files_deleted_from_oai_storage, is_cleaned_from_disk
     ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
     """
+    cur.execute(
+        insert_query,
+        (
+            batch_queue.batch_id,
+            batch_queue.input_file_id,
+            batch_queue.batch_jsonl_filepath,
+            batch_queue.batch_metadata_filepath,
+            batch_queue.status,
+            batch_queue.output_file_id,
+            batch_queue.are_all_files_updated_in_db,
+            batch_queue.are_files_deleted_from_oai_storage,
+            batch_queue.is_cleaned_from_disk,
+        ),
+    )
+
+
+@with_connection
+def create_batch_queue(conn, batch_queue: BatchQueue):
     with conn.cursor() as cur:
-        cur.execute(
-            insert_query,
-            (
-                batch_queue.batch_id,
-                batch_queue.input_file_id,
-                batch_queue.batch_jsonl_filepath,
-                batch_queue.batch_metadata_filepath,
-                batch_queue.status,
-                batch_queue.output_file_id,
-                batch_queue.are_all_files_updated_in_db,
-                batch_queue.are_files_deleted_from_oai_storage,
-                batch_queue.is_cleaned_from_disk,
-            ),
-        )
+        _insert_batch_queue(cur, batch_queue)
 
 
 @with_connection
@@ -557,6 +1745,94 @@ def get_running_batch_jobs(conn) -> list[BatchQueue] | None:
         return [BatchQueue(*result) for result in results] if results else None
 
 
+# OpenAI batch statuses after which a batch is never polled again
+TERMINAL_BATCH_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+@with_connection
+def claim_running_batch_jobs(conn, worker_id: str, lease_secs: int = 600, limit: int = 100) -> list[BatchQueue]:
+    """
+    Claim running batch jobs that are due for a status check (next_check_at passed) and that no other
+    worker is polling (see claim_unbatched_files)
+    """
+    claim_query = """
+    UPDATE BatchQueue SET claimed_by = %(worker_id)s, claimed_until = now() + make_interval(secs => %(lease_secs)s)
+    WHERE batch_id IN (
+        SELECT batch_id FROM BatchQueue
+        WHERE status NOT IN %(terminal)s
+        AND (next_check_at IS NULL OR next_check_at <= now())
+        AND (claimed_until IS NULL OR claimed_until < now())
+        ORDER BY next_check_at NULLS FIRST
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING batch_id, input_file_id, batch_jsonl_filepath, batch_metadata_filepath, status,
+              output_file_id, are_all_files_updated_in_db, are_files_deleted_from_oai_storage,
+              is_cleaned_from_disk, created_at, updated_at
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            claim_query,
+            {"worker_id": worker_id, "lease_secs": lease_secs, "limit": limit, "terminal": TERMINAL_BATCH_STATUSES},
+        )
+        results = [BatchQueue(*result) for result in cur.fetchall()]
+        return sorted(results, key=lambda x: x.created_at)
+
+
+@with_connection
+def claim_completed_batch_jobs(conn, worker_id: str, limit: int, lease_secs: int = 600) -> list[BatchQueue]:
+    """Claim up to limit completed batch jobs whose results haven't been written to image_detail yet"""
+    claim_query = """
+    UPDATE BatchQueue SET claimed_by = %(worker_id)s, claimed_until = now() + make_interval(secs => %(lease_secs)s)
+    WHERE batch_id IN (
+        SELECT batch_id FROM BatchQueue
+        WHERE status = 'completed' AND are_all_files_updated_in_db = FALSE
+        AND (claimed_until IS NULL OR claimed_until < now())
+        ORDER BY created_at
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING batch_id, input_file_id, batch_jsonl_filepath, batch_metadata_filepath, status,
+              output_file_id, are_all_files_updated_in_db, are_files_deleted_from_oai_storage,
+              is_cleaned_from_disk, created_at, updated_at
+    """
+    with conn.cursor() as cur:
+        cur.execute(claim_query, {"worker_id": worker_id, "limit": limit, "lease_secs": lease_secs})
+        results = [BatchQueue(*result) for result in cur.fetchall()]
+        return sorted(results, key=lambda x: x.created_at)
+
+
+@with_connection
+def schedule_batch_check(conn, batch_id: str, delay_secs: float):
+    with conn.cursor() as cur:
+        cur.execute(
+            "UPDATE BatchQueue SET next_check_at = now() + make_interval(secs => %s) WHERE batch_id = %s",
+            (delay_secs, batch_id),
+        )
+
+
+@with_connection
+def get_secs_until_next_batch_check(conn) -> Optional[float]:
+    """Seconds until the earliest running batch is due for a status check (<= 0 if overdue), None if none run"""
+    select_query = """
+    SELECT EXTRACT(EPOCH FROM MIN(COALESCE(next_check_at, now())) - now())
+    FROM BatchQueue WHERE status NOT IN %s
+    """
+    with conn.cursor() as cur:
+        cur.execute(select_query, (TERMINAL_BATCH_STATUSES,))
+        secs = cur.fetchone()[0]
+        return float(secs) if secs is not None else None
+
+
+@with_connection
+def release_batch_claims(conn, worker_id: str, batch_ids: list[str]):
+    update_query = """
+    UPDATE BatchQueue SET claimed_by = NULL, claimed_until = NULL WHERE claimed_by = %s AND batch_id = ANY(%s)
+    """
+    with conn.cursor() as cur:
+        cur.execute(update_query, (worker_id, batch_ids))
+
+
 @with_connection
 def get_completed_jobs_but_not_cleaned(conn) -> list[BatchQueue] | None:
     select_query = """
@@ -573,6 +1849,331 @@ def get_completed_jobs_but_not_cleaned(conn) -> list[BatchQueue] | None:
         return [BatchQueue(*result) for result in results] if results else None
 
 
+# ===
+# DropboxWriteback
+# ===
+def _enqueue_dropbox_writebacks(cur, writebacks: list[DropboxWriteback]):
+    """Queue writebacks, merging each into the pending one for the same file (new tags added, title/caption replaced)"""
+    upsert_query = """
+    INSERT INTO DropboxWriteback (user_id, path, title, caption, tags) VALUES %s
+    ON CONFLICT (user_id, path) DO UPDATE SET
+        title = COALESCE(EXCLUDED.title, DropboxWriteback.title),
+        caption = COALESCE(EXCLUDED.caption, DropboxWriteback.caption),
+        tags = ARRAY(
+            SELECT t FROM unnest(DropboxWriteback.tags || EXCLUDED.tags) WITH ORDINALITY AS u (t, i)
+            GROUP BY t ORDER BY min(i)
+        ),
+        version = DropboxWriteback.version + 1,
+        attempts = 0,
+        next_attempt_at = now()
+    """
+    psycopg2.extras.execute_values(
+        cur,
+        upsert_query,
+        [(x.user_id, x.path, x.title, x.caption, x.tags) for x in writebacks],
+        template="(%s, %s, %s, %s, %s::text[])",
+    )
+
+
+@with_connection
+def enqueue_dropbox_writebacks(conn, writebacks: list[DropboxWriteback]):
+    if writebacks:
+        with conn.cursor() as cur:
+            _enqueue_dropbox_writebacks(cur, writebacks)
+
+
+@with_connection
+def claim_dropbox_writebacks(conn, worker_id: str, limit: int, lease_secs: int = 600) -> list[DropboxWriteback]:
+    """Claim up to limit due writebacks, shared fairly among users (see claim_unbatched_files)"""
+    claim_query = _fair_claim_query(
+        "DropboxWriteback",
+        "user_id, path",
+        "q.next_attempt_at <= now()",
+        "next_attempt_at",
+        "user_id, path, title, caption, tags, version, attempts",
+    )
+    with conn.cursor() as cur:
+        cur.execute(claim_query, _fair_claim_params(worker_id, limit, lease_secs))
+        return [DropboxWriteback(*result) for result in cur.fetchall()]
+
+
+@with_connection
+def complete_dropbox_writeback(conn, worker_id: str, writeback: DropboxWriteback):
+    """Drop the writeback, unless it was updated while in flight; then it's released to be sent again"""
+    with conn.cursor() as cur:
+        cur.execute(
+            "DELETE FROM DropboxWriteback WHERE user_id = %s AND path = %s AND version = %s",
+            (writeback.user_id, writeback.path, writeback.version),
+        )
+        cur.execute(
+            """
+            UPDATE DropboxWriteback SET claimed_by = NULL, claimed_until = NULL
+            WHERE user_id = %s AND path = %s AND claimed_by = %s
+            """,
+            (writeback.user_id, writeback.path, worker_id),
+        )
+
+
+@with_connection
+def retry_dropbox_writeback(conn, worker_id: str, writeback: DropboxWriteback, delay_secs: float, error: str):
+    update_query = """
+    UPDATE DropboxWriteback SET
+        attempts = attempts + 1, last_error = %s, next_attempt_at = now() + make_interval(secs => %s),
+        claimed_by = NULL, claimed_until = NULL
+    WHERE user_id = %s AND path = %s AND claimed_by = %s
+    """
+    with conn.cursor() as cur:
+        cur.execute(update_query, (error, delay_secs, writeback.user_id, writeback.path, worker_id))
+
+
+@with_connection
+def get_secs_until_next_dropbox_writeback(conn) -> Optional[float]:
+    with conn.cursor() as cur:
+        cur.execute("SELECT EXTRACT(EPOCH FROM MIN(next_attempt_at) - now()) FROM DropboxWriteback")
+        secs = cur.fetchone()[0]
+        return float(secs) if secs is not None else None
+
+
+# ===
+# IngestJob
+# ===
+@with_connection
+def create_ingest_job(conn, job_id: str, user_id: str, files: list[IngestJobFile]):
+    with conn.cursor() as cur:
+        cur.execute("INSERT INTO IngestJob (job_id, user_id) VALUES (%s, %s)", (job_id, user_id))
+        psycopg2.extras.execute_values(
+            cur,
+            """
+            INSERT INTO IngestJobFile (job_id, file_id, user_id, name, tmp_file_loc, tags, status, upload_session, content_hash)
+            VALUES %s
+            """,
+            [
+                (
+                    job_id, f.file_id, user_id, f.name, f.tmp_file_loc, f.tags, f.status,
+                    psycopg2.extras.Json(f.upload_session) if f.upload_session is not None else None, f.content_hash,
+                )
+                for f in files
+            ],
+        )
+
+
+@with_read_connection
+def get_ingest_job(conn, job_id: str, user_id: str) -> Optional[list[IngestJobFile]]:
+    """
+    The files of the user's job, None if there's no such job. A file is captioned once its FileQueue row
+    is saved, so batch finalization needn't know about jobs.
+    """
+    select_query = """
+    SELECT f.job_id, f.file_id, f.user_id, f.name, f.tmp_file_loc, f.tags,
+           CASE WHEN q.is_saved_to_db THEN 'captioned' ELSE f.status END,
+           f.image_id, f.error, f.attempts, f.upload_session, f.content_hash
+    FROM IngestJob j
+    JOIN IngestJobFile f ON f.job_id = j.job_id
+    LEFT JOIN FileQueue q ON q.tmp_file_loc = f.tmp_file_loc
+    WHERE j.job_id = %s AND j.user_id = %s
+    ORDER BY f.created_at, f.file_id
+    """
+    with conn.cursor() as cur:
+        cur.execute(select_query, (job_id, user_id))
+        rows = cur.fetchall()
+        return [IngestJobFile(*row) for row in rows] if rows else None
+
+
+@with_connection
+def claim_ingest_job_files(conn, worker_id: str, limit: int, lease_secs: int = 600) -> list[IngestJobFile]:
+    """Claim up to limit uploaded files waiting to be processed, shared fairly among users (see claim_unbatched_files)"""
+    claim_query = _fair_claim_query(
+        "IngestJobFile",
+        "job_id, file_id",
+        "q.status = 'stored'",
+        "created_at",
+        "job_id, file_id, user_id, name, tmp_file_loc, tags, status, image_id, error, attempts, upload_session, content_hash",
+    )
+    with conn.cursor() as cur:
+        cur.execute(claim_query, _fair_claim_params(worker_id, limit, lease_secs))
+        return [IngestJobFile(*result) for result in cur.fetchall()]
+
+
+@with_connection
+def set_ingest_job_files_committed(conn, job_files: list[IngestJobFile]):
+    """The files' upload sessions are committed to Dropbox; a retry must fetch them from there instead"""
+    update_query = """
+    UPDATE IngestJobFile SET upload_session = NULL, updated_at = now()
+    WHERE (job_id, file_id) IN (SELECT job_id, file_id FROM unnest(%s::text[], %s::text[]) AS u (job_id, file_id))
+    """
+    with conn.cursor() as cur:
+        cur.execute(update_query, ([f.job_id for f in job_files], [f.file_id for f in job_files]))
+
+
+@with_connection
+def update_ingest_job_file(conn, job_file: IngestJobFile, retry_in_secs: Optional[float] = None):
+    """
+    Save the file's progress and release its claim. retry_in_secs keeps it from being claimed again until then.
+    """
+    update_query = """
+    UPDATE IngestJobFile SET
+        status = %s, image_id = %s, error = %s, attempts = %s, claimed_by = NULL,
+        claimed_until = CASE WHEN %s::float8 IS NULL THEN NULL ELSE now() + make_interval(secs => %s::float8) END,
+        updated_at = now()
+    WHERE job_id = %s AND file_id = %s
+    """
+    params = (
+        job_file.status, job_file.image_id, job_file.error, job_file.attempts, retry_in_secs, retry_in_secs,
+        job_file.job_id, job_file.file_id,
+    )
+    with conn.cursor() as cur:
+        cur.execute(update_query, params)
+
+
+@with_connection
+def get_secs_until_next_ingest_job_file(conn) -> Optional[float]:
+    """Until a file held back for a retry can be claimed; None if none is waiting"""
+    select_query = """
+    SELECT EXTRACT(EPOCH FROM MIN(claimed_until) - now()) FROM IngestJobFile
+    WHERE status = 'stored' AND claimed_by IS NULL AND claimed_until IS NOT NULL
+    """
+    with conn.cursor() as cur:
+        cur.execute(select_query)
+        secs = cur.fetchone()[0]
+        return float(secs) if secs is not None else None
+
+
+# ===
+# IngestFailure
+# ===
+@with_connection
+def get_blocked_files(conn, user_id: str, paths: list[str], content_hashes: list[str]) -> set[str]:
+    """The paths (paired with content_hashes) that failed to ingest before and aren't due for a retry yet"""
+    select_query = """
+    SELECT f.path FROM unnest(%s::text[], %s::text[]) AS f(path, content_hash)
+    JOIN IngestFailure i ON i.user_id = %s AND i.path = f.path AND i.content_hash = f.content_hash
+    WHERE i.next_retry_at > now()
+    """
+    with conn.cursor() as cur:
+        cur.execute(select_query, (paths, content_hashes, user_id))
+        return {row[0] for row in cur.fetchall()}
+
+
+@with_connection
+def record_ingest_failure(
+    conn, user_id: str, path: str, content_hash: str, reason: str, base_delay_secs: float, max_delay_secs: float
+) -> int:
+    """
+    Note a failed ingest of the file; it is skipped for base_delay_secs, doubling with every further failure
+    up to max_delay_secs. Returns the number of attempts so far.
+    """
+    upsert_query = """
+    INSERT INTO IngestFailure (user_id, path, content_hash, reason, attempts, next_retry_at)
+    VALUES (%(user_id)s, %(path)s, %(content_hash)s, %(reason)s, 1, now() + make_interval(secs => %(base)s))
+    ON CONFLICT (user_id, path, content_hash) DO UPDATE SET
+        reason = EXCLUDED.reason,
+        attempts = IngestFailure.attempts + 1,
+        next_retry_at = now() + make_interval(
+            secs => LEAST(%(base)s * power(2, IngestFailure.attempts), %(max)s)
+        ),
+        updated_at = now()
+    RETURNING attempts
+    """
+    params = dict(
+        user_id=user_id, path=path, content_hash=content_hash, reason=reason, base=base_delay_secs, max=max_delay_secs
+    )
+    with conn.cursor() as cur:
+        cur.execute(upsert_query, params)
+        return int(cur.fetchone()[0])
+
+
+@with_connection
+def get_due_ingest_failures(conn, user_id: str, limit: int = 100) -> list[str]:
+    """Paths of the user's failed files whose retry time has come, oldest first"""
+    select_query = """
+    SELECT path FROM IngestFailure WHERE user_id = %s AND next_retry_at <= now()
+    ORDER BY next_retry_at LIMIT %s
+    """
+    with conn.cursor() as cur:
+        cur.execute(select_query, (user_id, limit))
+        return [row[0] for row in cur.fetchall()]
+
+
+@with_connection
+def clear_ingest_failures(conn, user_id: str, paths: list[str]):
+    """Forget the failures of files that got ingested or are gone, whatever their content hash"""
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM IngestFailure WHERE user_id = %s AND path = ANY(%s)", (user_id, paths))
+
+
+@with_connection
+def park_ingest_failure(conn, user_id: str, path: str, content_hash: str):
+    """Stop retrying the file (it went to the dead letters); a new version of it is still tried"""
+    update_query = """
+    UPDATE IngestFailure SET next_retry_at = 'infinity', updated_at = now()
+    WHERE user_id = %s AND path = %s AND content_hash = %s
+    """
+    with conn.cursor() as cur:
+        cur.execute(update_query, (user_id, path, content_hash))
+
+
+@with_connection
+def reset_ingest_failure(conn, user_id: str, path: str):
+    """Make the file due for a retry right away, with a fresh count of attempts"""
+    update_query = """
+    UPDATE IngestFailure SET attempts = 0, next_retry_at = now(), updated_at = now()
+    WHERE user_id = %s AND path = %s
+    """
+    with conn.cursor() as cur:
+        cur.execute(update_query, (user_id, path))
+
+
+# ===
+# DeadLetter
+# ===
+@with_connection
+def dead_letter(conn, kind: str, key: str, payload: dict, error: str, attempts: int, user_id: Optional[str] = None):
+    """Park work that failed for good; a later failure of the same work replaces the row"""
+    upsert_query = """
+    INSERT INTO DeadLetter (kind, key, user_id, payload, error, attempts)
+    VALUES (%s, %s, %s, %s, %s, %s)
+    ON CONFLICT (kind, key) DO UPDATE SET
+        user_id = EXCLUDED.user_id, payload = EXCLUDED.payload, error = EXCLUDED.error,
+        attempts = EXCLUDED.attempts, updated_at = now()
+    """
+    with conn.cursor() as cur:
+        cur.execute(upsert_query, (kind, key, user_id, psycopg2.extras.Json(payload), error, attempts))
+
+
+@with_connection
+def get_dead_letters(
+    conn, kind: Optional[str] = None, ids: Optional[list[int]] = None, limit: int = 100
+) -> list[DeadLetter]:
+    select_query = """
+    SELECT id, kind, key, user_id, payload, error, attempts, created_at, updated_at
+    FROM DeadLetter
+    WHERE (%(kind)s::text IS NULL OR kind = %(kind)s) AND (%(ids)s::int[] IS NULL OR id = ANY(%(ids)s::int[]))
+    ORDER BY id
+    LIMIT %(limit)s
+    """
+    with conn.cursor() as cur:
+        cur.execute(select_query, {"kind": kind, "ids": ids, "limit": limit})
+        return [DeadLetter(*result) for result in cur.fetchall()]
+
+
+@with_connection
+def delete_dead_letter(conn, dead_letter_id: int):
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM DeadLetter WHERE id = %s", (dead_letter_id,))
+
+
+@with_connection
+def requeue_file(conn, tmp_file_loc: str) -> bool:
+    """Put an unsaved file back in line for the next OpenAI batch, attempts reset. False if it's saved or unknown"""
+    update_query = """
+    UPDATE FileQueue SET batch_id = NULL, claimed_by = NULL, claimed_until = NULL, batch_attempts = 0
+    WHERE tmp_file_loc = %s AND is_saved_to_db = FALSE
+    """
+    with conn.cursor() as cur:
+        cur.execute(update_query, (tmp_file_loc,))
+        return bool(cur.rowcount > 0)
+
+
 from psycopg2.errors import UndefinedTable
 
 @with_connection
@@ -588,4 +2189,37 @@ def check_and_create_tables(conn):
             break
 
 if __name__ == "__main__":
-    create_tables()
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    vector_index_parser = subparsers.add_parser("vector-index", help="build the vector index for a quantization mode")
+    vector_index_parser.add_argument("quantization", choices=list(VECTOR_INDEXES))
+    vector_index_parser.add_argument("--drop-others", action="store_true")
+    vector_index_parser.add_argument("--rebuild", action="store_true", help="replace an existing index")
+    vector_index_parser.add_argument("--m", type=int, default=HNSW_M)
+    vector_index_parser.add_argument("--ef-construction", type=int, default=HNSW_EF_CONSTRUCTION)
+    partition_parser = subparsers.add_parser("partition", help="hash-partition image_detail by user_id")
+    partition_parser.add_argument("--partitions", type=int, default=IMAGE_DETAIL_PARTITIONS or 16)
+    partition_parser.add_argument("--keep-old", action="store_true", help="keep image_detail_unpartitioned")
+    share_parser = subparsers.add_parser("tenant-share", help="set a user's share of the background queues")
+    share_parser.add_argument("user_id")
+    share_parser.add_argument("--weight", type=float, default=1.0, help="relative to users without a share (1)")
+    share_parser.add_argument("--max-per-claim", type=int, help="cap on the user's rows in one queue claim")
+    args = parser.parse_args()
+
+    if args.command == "tenant-share":
+        set_tenant_share(args.user_id, args.weight, args.max_per_claim)
+    elif args.command == "partition":
+        if not partition_image_detail(args.partitions, keep_old=args.keep_old):
+            print("image_detail is already partitioned")
+    elif args.command == "vector-index":
+        create_vector_index(
+            args.quantization,
+            drop_others=args.drop_others,
+            rebuild=args.rebuild,
+            m=args.m,
+            ef_construction=args.ef_construction,
+        )
+    else:
+        create_tables()
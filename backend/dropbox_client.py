@@ -0,0 +1,260 @@
+"""
+Single entry point for Dropbox HTTP calls.
+
+All calls go through one pooled keep-alive session with connect/read timeouts and share one rate limit.
+Access tokens are cached per user with their expiry and refreshed shortly before they run out; on a 401
+only one thread per user refreshes while the others wait for its token (single flight). 429 and 5xx
+answers are retried with backoff, honoring Retry-After.
+"""
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from typing import Optional, cast
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import db
+import ratelimit
+
+API_URL = "https://api.dropboxapi.com/2"
+CONTENT_URL = "https://content.dropboxapi.com/2"
+NOTIFY_URL = "https://notify.dropboxapi.com/2"
+TOKEN_URI = "https://api.dropboxapi.com/oauth2/token"
+
+CONNECT_TIMEOUT_SECS = float(os.environ.get("DROPBOX_CONNECT_TIMEOUT_SECS", 5))
+READ_TIMEOUT_SECS = float(os.environ.get("DROPBOX_READ_TIMEOUT_SECS", 60))
+MAX_RETRIES = int(os.environ.get("DROPBOX_MAX_RETRIES", 4))
+POOL_SIZE = int(os.environ.get("DROPBOX_POOL_SIZE", 32))
+DROPBOX_REQUESTS_PER_SEC = float(os.environ.get("DROPBOX_REQUESTS_PER_SEC", 10))
+# refresh this long before the token expires rather than waiting for a 401
+REFRESH_MARGIN_SECS = 300
+CONTENT_HASH_BLOCK_BYTES = 4 << 20  # Dropbox's content_hash hashes the file in 4 MiB blocks
+
+
+class DropboxError(Exception):
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class DropboxRetryLater(DropboxError):
+    """Dropbox is rate limiting or failing; retry_after is its Retry-After, if it sent one"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message, status_code)
+        self.retry_after = retry_after
+
+
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE))
+rate_limit = ratelimit.TokenBucket(DROPBOX_REQUESTS_PER_SEC, DROPBOX_REQUESTS_PER_SEC)
+
+_tokens: dict[str, tuple[str, Optional[float]]] = {}  # user_id -> (access token, monotonic expiry if known)
+_token_locks: dict[str, threading.Lock] = {}
+_token_locks_lock = threading.Lock()
+
+
+def _token_lock(user_id: str) -> threading.Lock:
+    with _token_locks_lock:
+        return _token_locks.setdefault(user_id, threading.Lock())
+
+
+def remember_token(user_id: str, access_token: str, expires_in: Optional[float] = None) -> None:
+    """Cache a token obtained outside the client (eg. the OAuth callback)"""
+    with _token_lock(user_id):
+        _tokens[user_id] = (access_token, time.monotonic() + expires_in if expires_in else None)
+
+
+def exchange_code(code: str, redirect_uri: str) -> dict:
+    """OAuth authorization code -> token response (access_token, refresh_token, expires_in, ...)"""
+    token_data = {
+        "code": code,
+        "grant_type": "authorization_code",
+        "client_id": os.environ["DROPBOX_CLIENT_ID"],
+        "client_secret": os.environ["DROPBOX_CLIENT_SECRET"],
+        "redirect_uri": redirect_uri,
+    }
+    response = session.post(TOKEN_URI, data=token_data, timeout=(CONNECT_TIMEOUT_SECS, READ_TIMEOUT_SECS))
+    if response.status_code != 200:
+        raise DropboxError(f"Error exchanging code: {response.status_code} - {response.text}", response.status_code)
+    return cast(dict, response.json())
+
+
+def refresh_access_token(refresh_token: str) -> tuple[str, Optional[float]]:
+    """New access token and its lifetime in seconds"""
+    data = {
+        "grant_type": "refresh_token",
+        "refresh_token": refresh_token,
+        "client_id": os.environ["DROPBOX_CLIENT_ID"],
+        "client_secret": os.environ["DROPBOX_CLIENT_SECRET"],
+    }
+    response = session.post(TOKEN_URI, data=data, timeout=(CONNECT_TIMEOUT_SECS, READ_TIMEOUT_SECS))
+    if response.status_code != 200:
+        raise DropboxError(f"Error refreshing token: {response.status_code} - {response.text}", response.status_code)
+    new_tokens = response.json()
+    return new_tokens["access_token"], new_tokens.get("expires_in")
+
+
+def get_access_token(user_id: str, rejected_token: Optional[str] = None) -> str:
+    """
+    A usable access token for the user. rejected_token is one that just got a 401; it won't be returned again.
+    Refreshes under a per-user lock, so concurrent callers share one refresh. Tokens refreshed by another
+    process are picked up from the users table instead of refreshing again.
+    """
+    with _token_lock(user_id):
+        cached = _tokens.get(user_id)
+        if cached is not None and cached[0] != rejected_token:
+            token, expires_at = cached
+            if expires_at is None or expires_at - REFRESH_MARGIN_SECS > time.monotonic():
+                return token
+
+        user = db.read_user(user_id, on_primary=True)  # a replica may still hold a refresh token that was rotated
+        if user is None:
+            raise DropboxError(f"Unknown user: {user_id}", 401)
+        expiring = cached is not None and cached[0] == user.access_token
+        if user.access_token and user.access_token != rejected_token and not expiring:
+            _tokens[user_id] = (user.access_token, None)
+            return cast(str, user.access_token)
+
+        token, expires_in = refresh_access_token(user.refresh_token)
+        db.update_access_token(user_id, token)
+        _tokens[user_id] = (token, time.monotonic() + expires_in if expires_in else None)
+        return token
+
+
+def _retry_delay(attempt: int, response: Optional[requests.Response]) -> float:
+    if response is not None and response.headers.get("Retry-After"):
+        try:
+            return float(response.headers["Retry-After"])
+        except ValueError:
+            pass
+    return min(2.0**attempt, 30) * (0.5 + random.random())
+
+
+def request(
+    url: str,
+    user_id: Optional[str] = None,
+    access_token: Optional[str] = None,
+    payload: Optional[dict] = None,
+    arg: Optional[dict] = None,
+    data=None,
+    stream: bool = False,
+    read_timeout: float = READ_TIMEOUT_SECS,
+    retries: int = MAX_RETRIES,
+    headers: Optional[dict] = None,
+) -> requests.Response:
+    """
+    POST to a Dropbox endpoint as user_id (or with a fixed access_token, which is never refreshed).
+    payload is sent as the JSON body (RPC endpoints), arg as the Dropbox-API-Arg header with data as the
+    body (content endpoints); headers are sent as well (eg. Range for a download). Any response other than
+    401/429/5xx is returned as is; 429/5xx still failing after the retries raise DropboxRetryLater.
+    """
+    headers = dict(headers or {})
+    if arg is not None:
+        headers["Dropbox-API-Arg"] = json.dumps(arg)
+        if data is not None:
+            headers["Content-Type"] = "application/octet-stream"
+    token = access_token or get_access_token(user_id)
+    refreshed = False
+    attempt = 0
+    while True:
+        headers["Authorization"] = f"Bearer {token}"
+        if hasattr(data, "seek"):
+            data.seek(0)
+        rate_limit.acquire()
+        response = None
+        try:
+            response = session.post(
+                url,
+                headers=headers,
+                json=payload,
+                data=data,
+                stream=stream,
+                timeout=(CONNECT_TIMEOUT_SECS, read_timeout),
+            )
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= retries:
+                raise DropboxRetryLater(f"{url}: {e}") from e
+        else:
+            if response.status_code == 401 and user_id is not None and access_token is None and not refreshed:
+                response.close()  # a streamed response holds its connection until closed
+                token = get_access_token(user_id, rejected_token=token)
+                refreshed = True
+                continue
+            if response.status_code != 429 and response.status_code < 500:
+                return response
+            if response.status_code == 429:
+                rate_limit.pause(_retry_delay(attempt, response))  # every caller slows down, not just this one
+            if attempt >= retries:
+                retry_after = response.headers.get("Retry-After")
+                message = f"{response.status_code}: {response.text}"
+                response.close()
+                raise DropboxRetryLater(
+                    message,
+                    response.status_code,
+                    float(retry_after) if retry_after and retry_after.isdigit() else None,
+                )
+            response.close()
+        time.sleep(_retry_delay(attempt, response))
+        attempt += 1
+
+
+def rpc(
+    route: str,
+    payload: Optional[dict] = None,
+    user_id: Optional[str] = None,
+    access_token: Optional[str] = None,
+    **kwargs,
+) -> dict:
+    """Call an RPC endpoint (eg. "files/list_folder") and return its JSON, raising DropboxError unless it's a 200"""
+    response = request(f"{API_URL}/{route}", user_id=user_id, access_token=access_token, payload=payload, **kwargs)
+    if response.status_code != 200:
+        raise DropboxError(f"{route}: {response.status_code} - {response.text}", response.status_code)
+    return cast(dict, response.json())
+
+
+def longpoll(cursor: str, timeout: int = 480) -> dict:
+    """
+    Block until something changes under the folder of a list_folder cursor, or timeout (30-480) secs pass.
+    Returns {"changes": bool, "backoff": secs to wait before the next longpoll, if Dropbox asks}. Needs no token.
+    """
+    try:
+        # Dropbox adds up to 90 secs of jitter to the timeout
+        response = session.post(
+            f"{NOTIFY_URL}/files/list_folder/longpoll",
+            json={"cursor": cursor, "timeout": timeout},
+            timeout=(CONNECT_TIMEOUT_SECS, timeout + 90),
+        )
+    except (requests.ConnectionError, requests.Timeout) as e:
+        raise DropboxRetryLater(f"longpoll: {e}") from e
+    if response.status_code == 429 or response.status_code >= 500:
+        raise DropboxRetryLater(f"longpoll: {response.status_code} - {response.text}", response.status_code)
+    if response.status_code != 200:
+        raise DropboxError(f"longpoll: {response.status_code} - {response.text}", response.status_code)
+    return cast(dict, response.json())
+
+
+def content_hash(file_path: str) -> str:
+    """Dropbox's content_hash of a local file: SHA-256 of the concatenated SHA-256s of its 4 MiB blocks"""
+    block_hashes = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while block := f.read(CONTENT_HASH_BLOCK_BYTES):
+            block_hashes.update(hashlib.sha256(block).digest())
+    return block_hashes.hexdigest()
+
+
+def download(path: str, file_path: str, user_id: str, chunk_bytes: int = 1 << 20) -> None:
+    """Streams a Dropbox file to disk chunk_bytes at a time; the .part file is only renamed once complete"""
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    response = request(f"{CONTENT_URL}/files/download", user_id=user_id, arg={"path": path}, stream=True)
+    with response:
+        if response.status_code != 200:
+            raise DropboxError(f"files/download: {response.status_code} - {response.text}", response.status_code)
+        with open(file_path + ".part", "wb") as f:
+            for chunk in response.iter_content(chunk_size=chunk_bytes):
+                f.write(chunk)
+    os.replace(file_path + ".part", file_path)
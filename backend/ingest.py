@@ -0,0 +1,271 @@
+"""
+Ingest helpers shared by the API (uploads) and the background worker (Dropbox sync).
+"""
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+from typing import BinaryIO, cast
+
+import PIL
+
+import db
+import dropbox_client
+import process as image_processor
+import retry
+import zero_shot
+
+# CLIP failing on a file is usually the file; a couple of quick retries cover a transient failure
+EMBEDDING_RETRY = retry.RetryPolicy(
+    max_attempts=3, base_delay_secs=0.5, max_delay_secs=5, fatal=(PIL.UnidentifiedImageError, FileNotFoundError)
+)
+
+
+# batched Dropbox uploads: bytes per upload session request (a multiple of Dropbox's 4 MiB hash block) and
+# commit status polling
+UPLOAD_SESSION_CHUNK_BYTES = 8 << 20
+FINISH_BATCH_MAX_ENTRIES = 1000  # Dropbox's limit per finish_batch
+FINISH_BATCH_CHECK_SECS = 1
+# overall time commit_upload_sessions waits for its commits; well within the claim lease of the files, whose
+# retry (UPLOAD_RETRY in the worker) takes over after that
+FINISH_BATCH_MAX_WAIT_SECS = int(os.environ.get("DROPBOX_FINISH_BATCH_MAX_WAIT_SECS", 120))
+
+DROPBOX_IMAGES_PATH = "/Apps/PixQuery/images"
+
+
+class IngestError(Exception):
+    pass
+
+
+def dropbox_path_of(file_location: str) -> str:
+    return f"{DROPBOX_IMAGES_PATH}/{os.path.basename(file_location)}"
+
+
+def is_in_dropbox(dropbox_path: str, content_hash: str, user_id: str) -> bool:
+    """
+    Whether dropbox_path holds the file with content_hash (Dropbox's hash, see dropbox_client.content_hash).
+    Raises IngestError if another file has the path.
+    """
+    try:
+        existing = dropbox_client.rpc("files/get_metadata", {"path": dropbox_path}, user_id=user_id)
+    except dropbox_client.DropboxError as e:
+        if e.status_code == 409:  # path/not_found
+            return False
+        raise
+    if existing.get("content_hash") != content_hash:
+        raise IngestError(f"{dropbox_path} already exists in Dropbox with other content")
+    return True
+
+
+def upload_to_dropbox(file_path, dropbox_path, user_id) -> dict:
+    """Uploads the file in one request and returns its Dropbox metadata; raises DropboxError if that failed"""
+    # Open the local file in binary mode to send it in the request
+    with open(file_path, "rb") as file:
+        response = dropbox_client.request(
+            f"{dropbox_client.CONTENT_URL}/files/upload",
+            user_id=user_id,
+            arg={"path": dropbox_path, "mode": "add", "autorename": False, "mute": False, "strict_conflict": False},
+            data=file,
+        )
+    if response.status_code == 409:
+        reason = response.json().get("error", {}).get("reason", {})
+        # the same file, uploaded before (eg. by an attempt whose commit outlived its wait), counts as uploaded
+        if reason.get(".tag") == "conflict" and is_in_dropbox(
+            dropbox_path, dropbox_client.content_hash(file_path), user_id
+        ):
+            return dropbox_client.rpc("files/get_metadata", {"path": dropbox_path}, user_id=user_id)
+    if response.status_code != 200:
+        raise dropbox_client.DropboxError(
+            f"files/upload: {response.status_code} - {response.text}", response.status_code
+        )
+    return cast(dict, response.json())
+
+
+def upload_session(file: BinaryIO, user_id: str) -> tuple[dict, str]:
+    """
+    Sends a file object through an upload session, UPLOAD_SESSION_CHUNK_BYTES at a time, and closes the session.
+    Nothing is stored on the local disk: until commit_upload_sessions, the bytes wait in Dropbox, reachable
+    from any node. Returns the session's cursor and the file's Dropbox content_hash.
+    """
+    block_hashes = hashlib.sha256()
+
+    def hash_blocks(chunk: bytes):
+        for i in range(0, len(chunk), dropbox_client.CONTENT_HASH_BLOCK_BYTES):
+            block_hashes.update(hashlib.sha256(chunk[i : i + dropbox_client.CONTENT_HASH_BLOCK_BYTES]).digest())
+
+    chunk = file.read(UPLOAD_SESSION_CHUNK_BYTES)
+    next_chunk = file.read(UPLOAD_SESSION_CHUNK_BYTES)
+    response = dropbox_client.request(
+        f"{dropbox_client.CONTENT_URL}/files/upload_session/start",
+        user_id=user_id,
+        arg={"close": not next_chunk},
+        data=chunk,
+    )
+    if response.status_code != 200:
+        raise dropbox_client.DropboxError(
+            f"upload_session/start: {response.status_code} - {response.text}", response.status_code
+        )
+    hash_blocks(chunk)
+    cursor = {"session_id": response.json()["session_id"], "offset": len(chunk)}
+    while next_chunk:
+        chunk, next_chunk = next_chunk, file.read(UPLOAD_SESSION_CHUNK_BYTES)
+        response = dropbox_client.request(
+            f"{dropbox_client.CONTENT_URL}/files/upload_session/append_v2",
+            user_id=user_id,
+            arg={"cursor": cursor, "close": not next_chunk},
+            data=chunk,
+        )
+        if response.status_code != 200:
+            raise dropbox_client.DropboxError(
+                f"upload_session/append_v2: {response.status_code} - {response.text}", response.status_code
+            )
+        hash_blocks(chunk)
+        cursor["offset"] += len(chunk)
+    return cursor, block_hashes.hexdigest()
+
+
+def finish_upload_batch(user_id: str, entries: list[dict], deadline: float) -> list[dict]:
+    """
+    Commit closed upload sessions; returns the result entry of each, in order. Raises DropboxRetryLater if the
+    commit isn't done by deadline (time.monotonic()), leaving the retry to the caller.
+    """
+    if time.monotonic() >= deadline:
+        raise dropbox_client.DropboxRetryLater("upload_session/finish_batch: out of time before the commit")
+    result = dropbox_client.rpc("files/upload_session/finish_batch_v2", {"entries": entries}, user_id=user_id)
+    if "entries" in result:
+        return cast(list[dict], result["entries"])
+    # answered as an async job: poll until the commit completes
+    while time.monotonic() + FINISH_BATCH_CHECK_SECS < deadline:
+        time.sleep(FINISH_BATCH_CHECK_SECS)
+        status = dropbox_client.rpc(
+            "files/upload_session/finish_batch/check", {"async_job_id": result["async_job_id"]}, user_id=user_id
+        )
+        if status[".tag"] == "complete":
+            return cast(list[dict], status["entries"])
+        if status[".tag"] == "failed":
+            raise dropbox_client.DropboxError(f"upload_session/finish_batch: {status}")
+    raise dropbox_client.DropboxRetryLater("upload_session/finish_batch: no result in time")
+
+
+def commit_upload_sessions(user_id: str, sessions: dict[str, tuple[dict, str]]) -> dict[str, Exception | None]:
+    """
+    Commits upload sessions of upload_session, {file location: (cursor, content_hash)}, to the PixQuery folder:
+    up to FINISH_BATCH_MAX_ENTRIES with one finish_batch_v2, waiting FINISH_BATCH_MAX_WAIT_SECS at most for all
+    of them. Returns the error of each file, None for the ones that made it. A commit that fails because the
+    path is taken, or the session is gone, still counts if the file is in Dropbox already (see is_in_dropbox):
+    an earlier attempt committed it.
+    """
+    errors: dict[str, Exception | None] = {}
+    file_paths = list(sessions)
+    deadline = time.monotonic() + FINISH_BATCH_MAX_WAIT_SECS
+    for i in range(0, len(file_paths), FINISH_BATCH_MAX_ENTRIES):
+        batch = file_paths[i : i + FINISH_BATCH_MAX_ENTRIES]
+        entries = [
+            {
+                "cursor": sessions[file_path][0],
+                "commit": {"path": dropbox_path_of(file_path), "mode": "add", "autorename": False, "mute": False},
+            }
+            for file_path in batch
+        ]
+        try:
+            results = finish_upload_batch(user_id, entries, deadline)
+        except Exception as e:
+            errors.update({file_path: e for file_path in batch})
+            continue
+        for file_path, result in zip(batch, results):
+            if result[".tag"] == "success":
+                errors[file_path] = None
+                continue
+            try:
+                if is_in_dropbox(dropbox_path_of(file_path), sessions[file_path][1], user_id):
+                    errors[file_path] = None
+                else:
+                    errors[file_path] = dropbox_client.DropboxError(f"upload_session/finish_batch: {result}", 409)
+            except Exception as e:
+                errors[file_path] = e
+    print(f"Committed {sum(e is None for e in errors.values())}/{len(file_paths)} uploads to Dropbox")
+    return errors
+
+
+def analyze_image(file_location: str, img_metadata: dict | None = None) -> dict:
+    """
+    Thumbnail and EXIF derived columns of image_detail for a local image. img_metadata, when already known
+    (eg. from Dropbox media_info for a thumbnail rendition, which carries no EXIF), is used instead of the file's.
+    """
+    thumbnail_url = image_processor.get_thumbnail(file_location)
+    if img_metadata is None:
+        # extract metadata
+        print("Extracting metadata from image ...")
+        img_metadata = image_processor.extract_image_metadata(file_location)
+    coords = None
+    capture_time_str = None
+    season = None
+    if img_metadata:
+        lat = img_metadata.get("latitude", None)
+        long = img_metadata.get("longitude", None)
+        if lat is not None and long is not None:
+            coords = [long, lat]  # POINT(x y) is (longitude latitude)
+
+        capture_time = img_metadata["capture_date"]
+        if capture_time is not None:
+            capture_time = datetime.strptime(capture_time, "%Y:%m:%d %H:%M:%S")
+            capture_time_str = capture_time.strftime("%d/%m/%Y")
+            # based on month get season as either summer, fall, winter, spring
+            month = capture_time.month
+            if month in [12, 1, 2]:
+                season = "winter"
+            elif month in [3, 4, 5]:
+                season = "spring"
+            elif month in [6, 7, 8]:
+                season = "summer"
+            else:
+                season = "fall"
+    return dict(
+        thumbnail_url=thumbnail_url,
+        coordinates=coords,
+        capture_time=capture_time_str,
+        extended_meta=json.dumps(img_metadata) if img_metadata else None,
+        season=season,
+    )
+
+
+def embed_image(file_location: str) -> list[float]:
+    if not os.path.exists(file_location):
+        raise FileNotFoundError(file_location)
+    embedding_vector = image_processor.get_image_embedding(file_location)
+    if embedding_vector is None:
+        raise IngestError("get image embedding returned None")
+    return embedding_vector
+
+
+def prepare_image(file_location: str, account_id: str, upload: bool = True) -> dict:
+    """
+    Uploads the file to Dropbox (unless the caller did, eg. with commit_upload_sessions) and returns its
+    image_detail row, as keyword arguments of db.insert
+    """
+    if upload:
+        upload_to_dropbox(file_location, dropbox_path_of(file_location), account_id)
+    url = f"https://www.dropbox.com/home{DROPBOX_IMAGES_PATH}?preview={os.path.basename(file_location)}"
+    image_columns = analyze_image(file_location)
+    # embed image
+    print("Getting image embeddings ...")
+    try:
+        embedding_vector = EMBEDDING_RETRY.call(embed_image, file_location)
+    except Exception as e:
+        raise IngestError(f"Could not embed {os.path.basename(file_location)}: {type(e).__name__}: {e}") from e
+    return dict(
+        url=url,
+        title=None,
+        caption=None,
+        tags=zero_shot.tags_for([embedding_vector])[0],  # until the LLM tags arrive
+        embedded_vector=embedding_vector,
+        user_id=account_id,
+        **image_columns,
+    )
+
+
+def insert_image_details_in_db(file_location: str, account_id: str) -> str:
+    # save to db
+    iid: str = db.insert(**prepare_image(file_location, account_id))
+    return iid  # image uuid in db
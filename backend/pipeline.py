@@ -0,0 +1,143 @@
+"""
+Small staged pipeline: stages connected by bounded queues, each with its own number of threads.
+
+A stage function takes one item and returns the item for the next stage, or None to drop it. Batched
+stages take a list of up to batch_size items (whatever is queued, they don't wait to fill a batch) and
+return a list of the same length, where an Exception marks that item as failed. Items are submitted in
+groups; Group.wait() returns once every item of the group has left the pipeline, which lets callers
+checkpoint after a group is fully processed. Failed items are handed to on_error; if it returns True the
+failure is taken care of (eg. recorded for a later retry) and doesn't count in Group.failed.
+"""
+import queue
+import threading
+import traceback
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+_STOP = object()
+
+
+@dataclass
+class Stage:
+    name: str
+    fn: Callable
+    concurrency: int = 1
+    batch_size: int = 0  # > 0 hands fn lists of up to batch_size items
+
+
+class Group:
+    def __init__(self, size: int):
+        self.pending = size
+        self.failed = 0
+        self._cond = threading.Condition()
+
+    def done(self, failed: bool = False):
+        with self._cond:
+            self.pending -= 1
+            self.failed += failed
+            if self.pending <= 0:
+                self._cond.notify_all()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: self.pending <= 0, timeout)
+
+
+class Pipeline:
+    def __init__(
+        self,
+        stages: list[Stage],
+        queue_size: int = 64,
+        on_error: Optional[Callable[[Stage, Any, Exception], bool]] = None,
+    ):
+        self.stages = stages
+        self.on_error = on_error
+        self.queues: list[queue.Queue] = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.threads: list[list[threading.Thread]] = []
+        for i, stage in enumerate(stages):
+            threads = [
+                threading.Thread(target=self._run, args=(i,), name=f"{stage.name}-{n}", daemon=True)
+                for n in range(stage.concurrency)
+            ]
+            for thread in threads:
+                thread.start()
+            self.threads.append(threads)
+
+    def submit(self, items: list) -> Group:
+        """Queue items into the first stage, blocking while it is full"""
+        group = Group(len(items))
+        for item in items:
+            self.queues[0].put((item, group))
+        return group
+
+    def close(self):
+        """Let queued items drain, then stop every stage"""
+        for i, threads in enumerate(self.threads):
+            for _ in threads:
+                self.queues[i].put(_STOP)
+            for thread in threads:
+                thread.join()
+
+    def _take(self, i: int) -> list:
+        batch_size = self.stages[i].batch_size
+        first = self.queues[i].get()
+        if first is _STOP or not batch_size:
+            return [first]
+        taken = [first]
+        while len(taken) < batch_size:
+            try:
+                item = self.queues[i].get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                self.queues[i].put(_STOP)  # for the next thread of this stage, after this batch
+                break
+            taken.append(item)
+        return taken
+
+    def _fail(self, stage: Stage, item, group: Group, e: Exception):
+        handled = False
+        if self.on_error is not None:
+            try:
+                handled = bool(self.on_error(stage, item, e))
+            except Exception as error_handler_error:
+                print(f"Pipeline error handler failed for stage {stage.name}:", error_handler_error)
+        else:
+            print(f"Pipeline stage {stage.name} failed:", e)
+            print(traceback.format_exc())
+        group.done(failed=not handled)
+
+    def _forward(self, i: int, item, group: Group):
+        if item is None:
+            group.done()
+        elif i + 1 < len(self.stages):
+            self.queues[i + 1].put((item, group))
+        else:
+            group.done()
+
+    def _run(self, i: int):
+        stage = self.stages[i]
+        while True:
+            taken = self._take(i)
+            if taken[0] is _STOP:
+                return
+            if stage.batch_size:
+                try:
+                    results = stage.fn([item for item, _ in taken])
+                except Exception as e:
+                    for item, group in taken:
+                        self._fail(stage, item, group, e)
+                    continue
+                for (item, group), result in zip(taken, results):
+                    if isinstance(result, Exception):
+                        self._fail(stage, item, group, result)
+                    else:
+                        self._forward(i, result, group)
+            else:
+                item, group = taken[0]
+                try:
+                    result = stage.fn(item)
+                except Exception as e:
+                    self._fail(stage, item, group, e)
+                    continue
+                self._forward(i, result, group)
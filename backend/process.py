@@ -48,54 +48,90 @@ class ImageData(BaseModel):
     )
 
 
+# input tokens OpenAI counts for an image sent with detail "low", whatever its size
+LOW_DETAIL_IMAGE_TOKENS = 85
+
+
+def build_batch_request(x: tuple) -> tuple[str, dict, int]:
+    """
+    For a file (path, tags, access_token, account_id, image_id): its line of the batch input JSONL, its
+    entry of the batch metadata, and an estimate of the request's input tokens.
+    """
+    image_path = x[0]
+    size = 1024
+    image = Image.open(image_path)
+    resized_image = image.resize((size, size))
+    img_format = image_path.split(".")[-1].upper()
+    if img_format == "JPG":
+        img_format = "JPEG"
+    output = io.BytesIO()
+    resized_image.save(output, format=img_format)
+    output.seek(0)
+    image_url = f"data:image/{img_format};base64,{base64.b64encode(output.getvalue()).decode('utf-8')}"
+
+    suffix = f"\n---\n\n{structured_llm_output.generate_response_prompt(ImageData)}---\n"
+    prompt = f"Analyze the image and provide a detailed, factual description. Ensure that the tags are short, specific, and relevant for search queries. Avoid redundancy and prioritize the most salient aspects of the image.\n{suffix}"
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": prompt,
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {"url": image_url, "detail": "low"},
+                },
+            ],
+        }
+    ]
+    line = json.dumps(
+        {
+            "custom_id": image_path,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {"model": "gpt-4o-mini", "messages": messages, "max_tokens": 1024},
+        }
+    )
+    metadata = {
+        "image_path": image_path,
+        "tags": x[1],
+        "access_token": x[2],
+        "account_id": x[3],
+        "image_id": x[4],
+    }
+    # ~4 characters per token for English text
+    return line, metadata, len(prompt) // 4 + LOW_DETAIL_IMAGE_TOKENS
+
+
+def submit_batch(batch_jsonl: str) -> tuple[str, str]:
+    """Upload a batch input file and start the batch job; returns (batch id, input file id)"""
+    client = openai.OpenAI()
+    # Upload the batch file
+    with open(batch_jsonl, "rb") as f:
+        batch_input_file = client.files.create(file=f, purpose="batch")
+    # Create the batch job
+    batch = client.batches.create(
+        input_file_id=batch_input_file.id,
+        completion_window="24h",
+        endpoint="/v1/chat/completions",
+    )
+    return batch.id, batch_input_file.id
+
+
+def cancel_batch(batch_id: str):
+    """Cancel a batch job that won't be tracked (its files go back in the queue)"""
+    client = openai.OpenAI()
+    client.batches.cancel(batch_id)
+
+
 def process_batch(files_list: list[tuple]) -> tuple[str, str, str, str]:
     batch_oai, batch_metadata = [], dict()
     for x in files_list:
-        image_path = x[0]
-        size = 1024
-        image = Image.open(image_path)
-        resized_image = image.resize((size, size))
-        img_format = image_path.split(".")[-1].upper()
-        if img_format == "JPG":
-            img_format = "JPEG"
-        output = io.BytesIO()
-        resized_image.save(output, format=img_format)
-        output.seek(0)
-        image_url = f"data:image/{img_format};base64,{base64.b64encode(output.getvalue()).decode('utf-8')}"
-
-        suffix = f"\n---\n\n{structured_llm_output.generate_response_prompt(ImageData)}---\n"
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": f"Analyze the image and provide a detailed, factual description. Ensure that the tags are short, specific, and relevant for search queries. Avoid redundancy and prioritize the most salient aspects of the image.\n{suffix}",
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": image_url, "detail": "low"},
-                    },
-                ],
-            }
-        ]
-        batch_oai.append(
-            json.dumps(
-                {
-                    "custom_id": image_path,
-                    "method": "POST",
-                    "url": "/v1/chat/completions",
-                    "body": {"model": "gpt-4o-mini", "messages": messages, "max_tokens": 1024},
-                }
-            )
-        )
-        batch_metadata[image_path] = {
-            "image_path": image_path,
-            "tags": x[1],
-            "access_token": x[2],
-            "account_id": x[3],
-            "image_id": x[4],
-        }
+        line, metadata, _ = build_batch_request(x)
+        batch_oai.append(line)
+        batch_metadata[x[0]] = metadata
 
     batch_uid = uuid.uuid4()
     batch_jsonl = f"/tmp/{batch_uid}.jsonl"
@@ -105,16 +141,8 @@ def process_batch(files_list: list[tuple]) -> tuple[str, str, str, str]:
     with open(batch_metadata_json, "w") as f:
         json.dump(batch_metadata, f)
 
-    client = openai.OpenAI()
-    # Upload the batch file
-    batch_input_file = client.files.create(file=open(batch_jsonl, "rb"), purpose="batch")
-    # Create the batch job
-    batch = client.batches.create(
-        input_file_id=batch_input_file.id,
-        completion_window="24h",
-        endpoint="/v1/chat/completions",
-    )
-    return batch.id, batch_input_file.id, batch_jsonl, batch_metadata_json
+    batch_id, input_file_id = submit_batch(batch_jsonl)
+    return batch_id, input_file_id, batch_jsonl, batch_metadata_json
 
 
 def get_image_captioning(image_path: str) -> dict | None:
@@ -264,6 +292,7 @@ def extract_image_metadata(image_path: str):
         # Include all remaining EXIF data excluding GPSInfo and DateTimeOriginal
         for key, value in exif_data.items():
             img_metadata[key] = value
+        return img_metadata
 
     except FileNotFoundError:
         logging.error(f"File not found: {image_path}")
@@ -300,6 +329,26 @@ def get_image_embedding(image_path: str) -> list[float] | None:
         print(e)
 
 
+def get_image_embeddings(image_paths: list[str]) -> list[list[float] | None]:
+    """Embeddings of several images in one forward pass; None for images that can't be read"""
+    images, loaded = [], []
+    for i, image_path in enumerate(image_paths):
+        try:
+            images.append(Image.open(image_path).convert("RGB"))
+            loaded.append(i)
+        except Exception as e:
+            print(e)
+    embeddings: list[list[float] | None] = [None] * len(image_paths)
+    if not images:
+        return embeddings
+    with torch.no_grad():
+        inputs = processor(images=images, return_tensors="pt")
+        outputs = model.get_image_features(**inputs)
+    for i, embedding in zip(loaded, outputs.tolist()):
+        embeddings[i] = embedding
+    return embeddings
+
+
 def get_text_embedding(text: str) -> list[float] | None:
     try:
         inputs = processor(text=[text], return_tensors="pt")
@@ -0,0 +1,46 @@
+"""
+Token bucket shared by all threads of a process that talk to the same API.
+"""
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Allows `rate` requests per second on average with bursts of up to `capacity`. pause() stops everyone
+    for a while, for when the API answers 429 with a Retry-After.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _wait_time(self) -> float:
+        """Seconds until a token is available, taking it if there is one. Call with the lock held"""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def acquire(self) -> None:
+        """Block until a request may be sent"""
+        while True:
+            with self._lock:
+                wait = self._wait_time()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def pause(self, secs: float) -> None:
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + secs)
+            self._tokens = 0
@@ -0,0 +1,50 @@
+"""
+Retry policy shared by the ingestion steps: a bounded number of attempts, exponential backoff with jitter,
+and a split of errors into retryable and fatal ones.
+
+Work that fails fatally or runs out of attempts goes to the DeadLetter table (db.dead_letter) instead of
+being retried forever or dropped; `python worker.py redrive` puts it back in the pipeline.
+"""
+import random
+import time
+from dataclasses import dataclass
+from typing import Callable, TypeVar
+
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    max_attempts: int = 3
+    base_delay_secs: float = 1.0
+    max_delay_secs: float = 60.0
+    jitter: float = 0.5  # each delay is scaled by a random factor in [1 - jitter, 1 + jitter]
+    retryable: tuple[type[BaseException], ...] = ()  # retried even if also an instance of one of fatal
+    fatal: tuple[type[BaseException], ...] = ()  # never retried
+
+    def is_retryable(self, e: BaseException) -> bool:
+        return isinstance(e, self.retryable) or not isinstance(e, self.fatal)
+
+    def should_retry(self, e: BaseException, attempts: int) -> bool:
+        """attempts is the number of failed attempts so far, including the one that raised e"""
+        return attempts < self.max_attempts and self.is_retryable(e)
+
+    def delay(self, attempts: int) -> float:
+        """Seconds to wait after the given number of failed attempts"""
+        delay = min(self.base_delay_secs * 2.0 ** (attempts - 1), self.max_delay_secs)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def call(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """Call fn until it returns, sleeping between attempts; re-raises the last error once out of attempts"""
+        attempts = 0
+        while True:
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                attempts += 1
+                if not self.should_retry(e, attempts):
+                    raise
+                delay = self.delay(attempts)
+                name = getattr(fn, "__name__", fn)
+                print(f"Attempt {attempts}/{self.max_attempts} of {name} failed, retrying in {delay:.1f}s:", e)
+                time.sleep(delay)
@@ -0,0 +1,217 @@
+"""
+Pluggable backends for the semantic (vector) part of search.
+
+The pgvector backend leaves ranking to the HNSW index inside the search query. The NumPy backend keeps a
+memory-mapped float32 matrix of every embedding of a user on local disk and answers top-k with one
+matrix-vector product + argpartition; the search query then only joins the returned uuids. For libraries
+of up to ~50k images that is exact, sub-millisecond, and takes the vector work off Postgres.
+
+The cache is only a copy: it is tagged with the user's embedding version from the database
+(image_embedding_version, bumped by triggers whenever the user's images are inserted, deleted or
+re-embedded, by any process), and rebuilt when that version moved on.
+"""
+import abc
+import fcntl
+import os
+import re
+import threading
+import time
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+
+EMBEDDING_DIM = 512
+# "auto" picks by library size, "pgvector" / "numpy" force a backend
+VECTOR_BACKEND = os.environ.get("VECTOR_BACKEND", "auto")
+VECTOR_CACHE_DIR = os.environ.get("VECTOR_CACHE_DIR", "/tmp/vector_cache")
+NUMPY_BACKEND_MAX_IMAGES = int(os.environ.get("NUMPY_BACKEND_MAX_IMAGES", 50_000))
+LIBRARY_SIZE_TTL_SECS = int(os.environ.get("LIBRARY_SIZE_TTL_SECS", 600))
+
+
+class VectorSearchBackend(abc.ABC):
+    name = "base"
+
+    @abc.abstractmethod
+    def top_k(
+        self,
+        user_id: str,
+        query_embedding: list[float],
+        k: int,
+        version: Callable[[], int],
+        loader: Callable[[], Iterable[tuple[str, list[float]]]],
+    ) -> Optional[list[str]]:
+        """
+        uuids of the k images closest (max inner product) to the query, best first.
+        None means ranking is left to the database. version returns the user's current embedding version in
+        the database; state built at another version is stale. loader yields (uuid, embedding) for all images
+        of the user and is only called when the backend has to build its state from scratch.
+        """
+
+    def append(
+        self, user_id: str, rows: list[tuple[str, list[float]]], previous_version: Optional[int], version: int
+    ) -> None:
+        """Called after a commit inserted rows of (uuid, embedding), moving the user from previous_version to version"""
+
+    def size(self, user_id: str) -> Optional[int]:
+        """Number of images known to the backend, if it knows"""
+        return None
+
+
+class PgVectorBackend(VectorSearchBackend):
+    name = "pgvector"
+
+    def top_k(self, user_id, query_embedding, k, version, loader):
+        return None
+
+
+class NumpyBackend(VectorSearchBackend):
+    """
+    Per user, three files in cache_dir:
+      <user>.f32      row-major float32 matrix, one row per image
+      <user>.ids      one uuid per line, in row order
+      <user>.version  embedding version of the database the two match; missing while they are rewritten
+    Appends and rebuilds take an flock on <user>.ids.lock, so several processes can share the cache.
+    """
+
+    name = "numpy"
+
+    def __init__(self, cache_dir: str = VECTOR_CACHE_DIR, dim: int = EMBEDDING_DIM):
+        self.cache_dir = cache_dir
+        self.dim = dim
+        self._lock = threading.Lock()
+        # user_id -> (version, file size, matrix, ids)
+        self._loaded: dict[str, tuple[int, int, np.ndarray, list[str]]] = {}
+
+    def _paths(self, user_id: str) -> tuple[str, str, str]:
+        name = re.sub(r"[^A-Za-z0-9_-]", "_", user_id)
+        base = os.path.join(self.cache_dir, name)
+        return f"{base}.f32", f"{base}.ids", f"{base}.version"
+
+    def _row_bytes(self) -> int:
+        return self.dim * np.dtype(np.float32).itemsize
+
+    @staticmethod
+    def _read_version(version_path: str) -> Optional[int]:
+        try:
+            with open(version_path) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    @staticmethod
+    def _write_version(version_path: str, version: int) -> None:
+        with open(version_path + ".tmp", "w") as f:
+            f.write(str(version))
+        os.replace(version_path + ".tmp", version_path)
+
+    def _build(self, user_id: str, version: int, rows: Iterable[tuple[str, list[float]]]) -> None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        matrix_path, ids_path, version_path = self._paths(user_id)
+        with open(ids_path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with open(matrix_path + ".tmp", "wb") as matrix_file, open(ids_path + ".tmp", "w") as ids_file:
+                for uuid, embedding in rows:
+                    matrix_file.write(np.asarray(embedding, dtype=np.float32).tobytes())
+                    ids_file.write(f"{uuid}\n")
+            # without a version file the cache is stale, so a crash between the two renames can't be used
+            if os.path.exists(version_path):
+                os.remove(version_path)
+            os.replace(matrix_path + ".tmp", matrix_path)
+            os.replace(ids_path + ".tmp", ids_path)
+            self._write_version(version_path, version)
+
+    def _load(self, user_id: str) -> Optional[tuple[int, np.ndarray, list[str]]]:
+        matrix_path, ids_path, version_path = self._paths(user_id)
+        version = self._read_version(version_path)
+        if version is None or not (os.path.exists(matrix_path) and os.path.exists(ids_path)):
+            return None
+        file_size = os.path.getsize(matrix_path)
+        with self._lock:
+            cached = self._loaded.get(user_id)
+            if cached is not None and cached[:2] == (version, file_size):
+                return version, cached[2], cached[3]
+        with open(ids_path) as f:
+            ids = f.read().split()
+        # a crash between the two writes of an append can leave one extra row; ids are authoritative
+        n = min(len(ids), file_size // self._row_bytes())
+        if n == 0:
+            matrix = np.zeros((0, self.dim), dtype=np.float32)
+        else:
+            matrix = np.memmap(matrix_path, dtype=np.float32, mode="r", shape=(n, self.dim))
+        ids = ids[:n]
+        with self._lock:
+            self._loaded[user_id] = (version, file_size, matrix, ids)
+        return version, matrix, ids
+
+    def top_k(self, user_id, query_embedding, k, version, loader):
+        current_version = version()
+        loaded = self._load(user_id)
+        if loaded is None or loaded[0] != current_version:
+            # the version is read before the rows, so a change in between only costs another rebuild
+            self._build(user_id, current_version, loader())
+            loaded = self._load(user_id)
+        _, matrix, ids = loaded
+        if len(ids) == 0:
+            return []
+        scores = matrix @ np.asarray(query_embedding, dtype=np.float32)
+        if k < len(ids):
+            top = np.argpartition(-scores, k)[:k]
+        else:
+            top = np.arange(len(ids))
+        top = top[np.argsort(-scores[top])]
+        return [ids[i] for i in top]
+
+    def append(self, user_id, rows, previous_version, version):
+        matrix_path, ids_path, version_path = self._paths(user_id)
+        if not os.path.exists(ids_path):
+            return  # built from the database on first search
+        with open(ids_path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if previous_version is None or self._read_version(version_path) != previous_version:
+                return  # missed another change; the next search rebuilds from the database
+            with open(ids_path) as f:
+                ids = f.read().split()
+            known = set(ids)  # a rebuild racing the insert may already have the rows
+            rows = [(uuid, embedding) for uuid, embedding in rows if uuid not in known]
+            os.remove(version_path)
+            with open(matrix_path, "r+b") as matrix_file:
+                matrix_file.truncate(len(ids) * self._row_bytes())  # drop a row left over by an interrupted append
+                matrix_file.seek(0, os.SEEK_END)
+                for _, embedding in rows:
+                    matrix_file.write(np.asarray(embedding, dtype=np.float32).tobytes())
+            with open(ids_path, "a") as ids_file:
+                ids_file.writelines(f"{uuid}\n" for uuid, _ in rows)
+            self._write_version(version_path, version)
+
+    def size(self, user_id):
+        loaded = self._load(user_id)
+        return len(loaded[2]) if loaded is not None else None
+
+
+pgvector_backend = PgVectorBackend()
+numpy_backend = NumpyBackend()
+_library_sizes: dict[str, tuple[int, float]] = {}  # user_id -> (image count, monotonic time it was read)
+
+
+def get_backend(user_id: str, count_images: Callable[[], int]) -> VectorSearchBackend:
+    """
+    Pick the backend for a user by library size. count_images is only called when the size
+    isn't known to the NumPy cache and the last count is older than LIBRARY_SIZE_TTL_SECS.
+    """
+    if VECTOR_BACKEND == "pgvector":
+        return pgvector_backend
+    if VECTOR_BACKEND == "numpy":
+        return numpy_backend
+
+    size = numpy_backend.size(user_id)
+    if size is None:
+        cached = _library_sizes.get(user_id)
+        if cached is None or time.monotonic() - cached[1] > LIBRARY_SIZE_TTL_SECS:
+            cached = (count_images(), time.monotonic())
+            _library_sizes[user_id] = cached
+        size = cached[0]
+    return numpy_backend if size <= NUMPY_BACKEND_MAX_IMAGES else pgvector_backend
+
+
+def append(user_id: str, rows: list[tuple[str, list[float]]], previous_version: Optional[int], version: int) -> None:
+    numpy_backend.append(user_id, rows, previous_version, version)
@@ -0,0 +1,1323 @@
+"""
+Background processing: batching files for OpenAI, polling batch jobs, garbage collection and Dropbox sync.
+
+Run it as its own process, as many copies on as many nodes as needed:
+
+    python worker.py [--only file_processor job_processor ...]
+
+Queue rows are claimed with FOR UPDATE SKIP LOCKED, singleton jobs (garbage collection, the Dropbox poll
+of one user) take a named lease in worker_lease. A heartbeat thread extends everything this worker holds;
+if the worker dies its claims and leases expire after CLAIM_LEASE_SECS and another worker picks them up.
+
+Work that failed for good is kept in DeadLetter; `python worker.py redrive [--kind K] [--id N ...] [--list]`
+runs it again.
+"""
+import argparse
+import base64
+import collections
+import dataclasses
+import json
+import os
+import signal
+import socket
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import openai
+import PIL
+import psycopg2
+
+import data_models
+import db
+import dropbox_client
+import ingest
+import pipeline
+import process as image_processor
+import retry
+import structured_llm_output
+import zero_shot
+
+# the oldest waiting file goes out in a batch after this long, even if fewer than BATCH_MIN_FILES wait
+BATCH_WINDOW_TIME_SECS = int(os.environ.get("BATCH_WINDOW_TIME_SECS", 4 * 3600))
+BATCH_MIN_FILES = int(os.environ.get("BATCH_MIN_FILES", 50))
+# OpenAI batch limits: 50,000 requests and a 200 MB input file per batch; the token cap keeps a batch within
+# the organization's enqueued token limit (depends on the usage tier)
+BATCH_MAX_REQUESTS = int(os.environ.get("BATCH_MAX_REQUESTS", 50_000))
+BATCH_MAX_BYTES = int(os.environ.get("BATCH_MAX_BYTES", 190_000_000))
+BATCH_MAX_TOKENS = int(os.environ.get("BATCH_MAX_TOKENS", 2_000_000))
+BATCH_MAX_SUBMITS_PER_TICK = int(os.environ.get("BATCH_MAX_SUBMITS_PER_TICK", 10))
+# batches a file may be in that fail, expire or get cancelled before it is dead-lettered
+BATCH_MAX_ATTEMPTS = int(os.environ.get("BATCH_MAX_ATTEMPTS", 3))
+# how often a worker looks for Dropbox users nobody watches; changes themselves arrive through longpoll
+POLL_WINDOW_TIME_SECS = int(os.environ.get("POLL_WINDOW_TIME_SECS", 60))
+GARBAGE_COLLECTION_TIME_SECS = int(os.environ.get("GARBAGE_COLLECTION_TIME_SECS", 4 * 3600))
+# local copies under /tmp/<account id>/ that no queue refers to anymore (a worker died mid-download, ...) are
+# removed by the garbage collector once they are this old
+ORPHANED_FILE_MIN_AGE_SECS = int(os.environ.get("ORPHANED_FILE_MIN_AGE_SECS", 24 * 3600))
+# workers wake on NOTIFY; this is only the fallback poll in case a notification was missed
+QUEUE_SAFETY_POLL_SECS = int(os.environ.get("QUEUE_SAFETY_POLL_SECS", 300))
+CLAIM_LEASE_SECS = int(os.environ.get("CLAIM_LEASE_SECS", 600))
+# (batch age below, seconds between status checks): poll young batches often, long-running ones rarely
+BATCH_POLL_INTERVALS = [(10 * 60, 30), (3600, 120), (6 * 3600, 300), (24 * 3600, 900)]
+BATCH_POLL_CONCURRENCY = int(os.environ.get("BATCH_POLL_CONCURRENCY", 8))
+BATCH_FINALIZE_CONCURRENCY = int(os.environ.get("BATCH_FINALIZE_CONCURRENCY", 2))
+BATCH_FINALIZE_RECHECK_SECS = 5
+# records of a batch output saved to the DB per write
+FINALIZE_CHUNK_SIZE = int(os.environ.get("FINALIZE_CHUNK_SIZE", 50))
+# Dropbox metadata sync: parallel writebacks per worker (the request rate is limited in dropbox_client)
+DROPBOX_WRITEBACK_CONCURRENCY = int(os.environ.get("DROPBOX_WRITEBACK_CONCURRENCY", 4))
+DROPBOX_WRITEBACK_MAX_DELAY_SECS = 6 * 3600
+DROPBOX_WRITEBACK_MAX_ATTEMPTS = int(os.environ.get("DROPBOX_WRITEBACK_MAX_ATTEMPTS", 12))
+# Dropbox sync: users in a sync turn / waiting in longpoll at once, and users watched per worker
+DROPBOX_SYNC_CONCURRENCY = int(os.environ.get("DROPBOX_SYNC_CONCURRENCY", 4))
+DROPBOX_LONGPOLL_CONCURRENCY = int(os.environ.get("DROPBOX_LONGPOLL_CONCURRENCY", 200))
+DROPBOX_MAX_USERS_PER_WORKER = int(os.environ.get("DROPBOX_MAX_USERS_PER_WORKER", 200))
+# pages of a sync turn for a user of FAIR_SHARE_DEFAULT_WEIGHT; scaled by the user's TenantShare weight
+DROPBOX_SYNC_PAGES_PER_TURN = int(os.environ.get("DROPBOX_SYNC_PAGES_PER_TURN", 5))
+# entries per list_folder page (Dropbox allows up to 2000), at most the user's TenantShare max_per_claim
+DROPBOX_LIST_PAGE_SIZE = int(os.environ.get("DROPBOX_LIST_PAGE_SIZE", 500))
+DROPBOX_LONGPOLL_TIMEOUT_SECS = 480
+DROPBOX_SYNC_RETRY_SECS = 60
+# ingest pipeline for polled files: threads per stage, batch sizes and the bound of each stage's queue
+INGEST_DOWNLOAD_CONCURRENCY = int(os.environ.get("INGEST_DOWNLOAD_CONCURRENCY", 8))
+INGEST_ANALYZE_CONCURRENCY = int(os.environ.get("INGEST_ANALYZE_CONCURRENCY", 2))
+INGEST_EMBED_BATCH_SIZE = int(os.environ.get("INGEST_EMBED_BATCH_SIZE", 16))
+INGEST_INSERT_BATCH_SIZE = int(os.environ.get("INGEST_INSERT_BATCH_SIZE", 50))
+INGEST_QUEUE_SIZE = int(os.environ.get("INGEST_QUEUE_SIZE", 32))
+DOWNLOAD_CHUNK_BYTES = 1 << 20
+# files uploaded through the API processed at once (Dropbox upload, thumbnail, EXIF, embedding)
+UPLOAD_PROCESSOR_CONCURRENCY = int(os.environ.get("UPLOAD_PROCESSOR_CONCURRENCY", 2))
+# uploaded files claimed at once; each user's share of them goes to Dropbox as one batched commit
+UPLOAD_CLAIM_BATCH_SIZE = int(os.environ.get("UPLOAD_CLAIM_BATCH_SIZE", 50))
+# a file that fails to ingest is skipped for INGEST_FAILURE_RETRY_SECS, doubling per failure up to the max
+INGEST_FAILURE_RETRY_SECS = int(os.environ.get("INGEST_FAILURE_RETRY_SECS", 3600))
+INGEST_FAILURE_MAX_RETRY_SECS = int(os.environ.get("INGEST_FAILURE_MAX_RETRY_SECS", 30 * 24 * 3600))
+INGEST_FAILURE_MAX_ATTEMPTS = int(os.environ.get("INGEST_FAILURE_MAX_ATTEMPTS", 6))
+# "thumbnail" fetches server-side renditions (files/get_thumbnail_batch) of polled photos instead of the
+# originals, with EXIF taken from the listing's media_info; "original" downloads every file in full
+INGEST_SOURCE = os.environ.get("INGEST_SOURCE", "original")
+DROPBOX_THUMBNAIL_SIZE = os.environ.get("DROPBOX_THUMBNAIL_SIZE", "w1024h768")
+DROPBOX_THUMBNAIL_BATCH_SIZE = 25  # most entries get_thumbnail_batch takes per call
+# a JPEG keeps its EXIF in an APP1 segment of at most 64 KiB near the start of the file
+EXIF_HEAD_BYTES = int(os.environ.get("EXIF_HEAD_BYTES", 128 * 1024))
+HEARTBEAT_SECS = int(os.environ.get("HEARTBEAT_SECS", max(CLAIM_LEASE_SECS // 3, 1)))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# Dropbox rate limiting or failing is retried; any other Dropbox error (path gone, ...) is the request's fault
+WRITEBACK_RETRY = retry.RetryPolicy(
+    max_attempts=DROPBOX_WRITEBACK_MAX_ATTEMPTS,
+    base_delay_secs=30,
+    max_delay_secs=DROPBOX_WRITEBACK_MAX_DELAY_SECS,
+    retryable=(dropbox_client.DropboxRetryLater,),
+    fatal=(dropbox_client.DropboxError,),
+)
+# uploads are retried unless the file itself can't be processed
+# files of a batch that ended without output go in the next batch; the delay is the next batch window
+BATCH_RETRY = retry.RetryPolicy(max_attempts=BATCH_MAX_ATTEMPTS)
+UPLOAD_RETRY = retry.RetryPolicy(max_attempts=5, base_delay_secs=10, max_delay_secs=600, fatal=(ingest.IngestError,))
+# polled files that fail are retried on later polls (see IngestFailure); PIL not reading a file won't change
+INGEST_RETRY = retry.RetryPolicy(
+    max_attempts=INGEST_FAILURE_MAX_ATTEMPTS,
+    base_delay_secs=INGEST_FAILURE_RETRY_SECS,
+    max_delay_secs=INGEST_FAILURE_MAX_RETRY_SECS,
+    fatal=(PIL.UnidentifiedImageError,),
+)
+
+
+def heartbeat():
+    while True:
+        try:
+            db.renew_leases(WORKER_ID, CLAIM_LEASE_SECS)
+        except Exception as e:
+            print("Error in heartbeat:", e)
+        time.sleep(HEARTBEAT_SECS)
+
+
+# ===
+# Submit Batch Job to OAI
+# ===
+class AdaptiveBatcher:
+    """
+    Packs waiting files into OpenAI batches as large as the batch API allows: each batch stops at
+    BATCH_MAX_REQUESTS requests, BATCH_MAX_BYTES of input file or BATCH_MAX_TOKENS estimated input tokens,
+    whichever comes first. How many files to claim for a batch comes from the average request size (bytes
+    and tokens) of the batches built so far, so a backlog goes out in a few full batches rather than many of
+    50. Files claimed beyond a limit are released for the next batch.
+    """
+
+    def __init__(self):
+        self.avg_request_bytes = 250_000.0  # a 1024x1024 JPEG, base64 encoded; refined by every batch
+        self.avg_request_tokens = 400.0
+
+    def claim_size(self) -> int:
+        fits = min(
+            BATCH_MAX_REQUESTS,
+            BATCH_MAX_BYTES / self.avg_request_bytes,
+            BATCH_MAX_TOKENS / self.avg_request_tokens,
+        )
+        return max(int(fits * 1.1), 1)  # a few extra, in case the files are smaller than average
+
+    def learn(self, requests: int, size_bytes: int, tokens: int):
+        self.avg_request_bytes = 0.7 * self.avg_request_bytes + 0.3 * size_bytes / requests
+        self.avg_request_tokens = 0.7 * self.avg_request_tokens + 0.3 * tokens / requests
+
+    def submit(self) -> int:
+        """Claim the oldest unbatched files and submit as many as fit as one batch. Returns the files submitted"""
+        unbatched_files = db.claim_unbatched_files(WORKER_ID, self.claim_size(), CLAIM_LEASE_SECS)
+        if not unbatched_files:
+            return 0
+        batch_uid = uuid.uuid4()
+        batch_jsonl = f"/tmp/{batch_uid}.jsonl"
+        batch_metadata_json = f"/tmp/{batch_uid}_metadata.json"
+        batched: list[data_models.FileQueue] = []
+        batch_metadata: dict[str, dict] = {}
+        size_bytes = tokens = 0
+        batch_id, submitted = None, False
+        try:
+            with open(batch_jsonl, "w") as f:
+                for x in unbatched_files:
+                    tags = [y.strip() for y in x.tag_list.split(",") if y.strip()]
+                    try:
+                        line, metadata, request_tokens = image_processor.build_batch_request(
+                            (x.tmp_file_loc, tags, x.access_token, x.user_id, x.image_id)
+                        )
+                    except Exception as e:
+                        print(f"Could not build the batch request of {x.tmp_file_loc}:", e)
+                        db.dead_letter(
+                            "batch_record",
+                            x.tmp_file_loc,
+                            {"tmp_file_loc": x.tmp_file_loc},
+                            f"{type(e).__name__}: {e}",
+                            1,
+                            user_id=x.user_id,
+                        )
+                        db.park_unbatchable_file(x.tmp_file_loc)
+                        continue
+                    line_bytes = len(line.encode()) + 1
+                    if batched and (
+                        len(batched) >= BATCH_MAX_REQUESTS
+                        or size_bytes + line_bytes > BATCH_MAX_BYTES
+                        or tokens + request_tokens > BATCH_MAX_TOKENS
+                    ):
+                        break
+                    f.write(("\n" if batched else "") + line)
+                    batched.append(x)
+                    batch_metadata[x.tmp_file_loc] = metadata
+                    size_bytes += line_bytes
+                    tokens += request_tokens
+            if not batched:
+                os.remove(batch_jsonl)
+                return 0
+            self.learn(len(batched), size_bytes, tokens)
+            with open(batch_metadata_json, "w") as f:
+                json.dump(batch_metadata, f)
+
+            batch_id, input_file_id = image_processor.submit_batch(batch_jsonl)
+            db.set_files_batch(
+                WORKER_ID,
+                [x.tmp_file_loc for x in batched],
+                data_models.BatchQueue(batch_id, input_file_id, batch_jsonl, batch_metadata_json),
+            )
+            submitted = True
+            print(
+                f"Submitted job with id: {batch_id} to OpenAI: {len(batched)} files, "
+                f"{size_bytes / 1e6:.1f} MB, ~{tokens} input tokens"
+            )
+            return len(batched)
+        except Exception as e:
+            print(e)
+            if batch_id is not None and not submitted:
+                # submitted but not recorded: nobody would poll it, and its files go back in the queue
+                try:
+                    image_processor.cancel_batch(batch_id)
+                except Exception as cancel_error:
+                    print(f"Could not cancel untracked batch {batch_id}:", cancel_error)
+            for path in (batch_jsonl, batch_metadata_json):
+                if os.path.exists(path):
+                    os.remove(path)
+            return 0
+        finally:
+            # files left over, parked or not submitted go back in the queue; submitted ones are no longer claimed
+            try:
+                db.release_file_claims(WORKER_ID, [x.tmp_file_loc for x in unbatched_files])
+            except Exception as e:
+                print("Could not release claimed files, their claims will lapse:", e)
+
+
+def is_batch_due() -> tuple[bool, float | None]:
+    """(whether to submit a batch now; else secs until the oldest waiting file reaches the batch window)"""
+    count, oldest_created_at = db.get_unbatched_files_stats(BATCH_MIN_FILES)
+    if not count:
+        return False, None
+    age = (datetime.utcnow() - oldest_created_at).total_seconds()
+    if count >= BATCH_MIN_FILES or age > BATCH_WINDOW_TIME_SECS:
+        return True, None
+    return False, BATCH_WINDOW_TIME_SECS - age
+
+
+def file_processor():
+    """
+    Submits batches while enough files wait (BATCH_MIN_FILES) or the oldest has waited BATCH_WINDOW_TIME_SECS,
+    up to BATCH_MAX_SUBMITS_PER_TICK per wake-up, so a backlog drains in one go.
+    """
+    batcher = AdaptiveBatcher()
+    listener = db.Listener("filequeue_new")
+    while True:
+        timeout: float = QUEUE_SAFETY_POLL_SECS
+        try:
+            for _ in range(BATCH_MAX_SUBMITS_PER_TICK):
+                due, wait = is_batch_due()
+                if not due:
+                    if wait is not None:
+                        # wake up when the oldest file reaches the batch window, unless more files arrive first
+                        timeout = min(timeout, wait)
+                    break
+                if not batcher.submit():
+                    break
+            else:
+                timeout = 0  # there may be more waiting
+        except Exception as e:
+            print("Error in file_processor:", e)
+            print(traceback.format_exc())
+        finally:
+            listener.wait(timeout)
+
+
+# ===
+# Uploads
+# ===
+def process_upload(job_file: data_models.IngestJobFile):
+    """
+    Ingest one file of an /upload job, already in Dropbox: fetched from there, thumbnail, EXIF and embedding,
+    then queue it for captioning
+    """
+    try:
+        queued = db.read_file_queue(job_file.tmp_file_loc)
+        if queued is not None:
+            job_file.image_id = queued.image_id  # done before, the worker died before saving the progress
+        else:
+            dropbox_path = ingest.dropbox_path_of(job_file.tmp_file_loc)
+            if job_file.upload_session is None and job_file.content_hash is None:
+                # staged on local disk by an API from before upload sessions
+                ingest.upload_to_dropbox(job_file.tmp_file_loc, dropbox_path, job_file.user_id)
+            elif not os.path.exists(job_file.tmp_file_loc):
+                dropbox_client.download(dropbox_path, job_file.tmp_file_loc, job_file.user_id, DOWNLOAD_CHUNK_BYTES)
+            image = ingest.prepare_image(job_file.tmp_file_loc, job_file.user_id, upload=False)
+            access_token = dropbox_client.get_access_token(job_file.user_id)
+            file_queue = data_models.FileQueue(
+                job_file.tmp_file_loc, job_file.tags, access_token, job_file.user_id, None
+            )
+            job_file.image_id = db.insert_many([image], [file_queue])[0]
+        job_file.status = "embedded"
+        job_file.error = None
+        db.update_ingest_job_file(job_file)
+        print(f"Ingested upload {job_file.name} of job {job_file.job_id}")
+    except Exception as e:
+        fail_upload(job_file, e)
+
+
+def remove_local_copy(file_location: str):
+    """Remove a downloaded file and whatever is left of its partial download"""
+    for path in (file_location, file_location + ".part"):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def fail_upload(job_file: data_models.IngestJobFile, e: Exception):
+    """Retry the file later, or dead-letter it once UPLOAD_RETRY gives up"""
+    print(f"Ingest of upload {job_file.name} of job {job_file.job_id} failed:", e)
+    try:
+        job_file.attempts += 1
+        job_file.error = f"{type(e).__name__}: {e}"
+        if UPLOAD_RETRY.should_retry(e, job_file.attempts):
+            db.update_ingest_job_file(job_file, retry_in_secs=UPLOAD_RETRY.delay(job_file.attempts))
+            return
+        job_file.status = "failed"
+        db.update_ingest_job_file(job_file)
+        payload = {"job_id": job_file.job_id, "file_id": job_file.file_id, "file_location": job_file.tmp_file_loc}
+        db.dead_letter("upload", job_file.tmp_file_loc, payload, job_file.error, job_file.attempts, job_file.user_id)
+        # the file is in Dropbox (or its upload session), a redrive downloads it again; a legacy local one stays
+        if job_file.content_hash is not None and db.read_file_queue(job_file.tmp_file_loc) is None:
+            remove_local_copy(job_file.tmp_file_loc)
+    except Exception as error:
+        print(f"Could not record the failure of upload {job_file.name}:", error)  # the claim lapses, it's retried
+
+
+def process_uploads(job_files: list[data_models.IngestJobFile], pool: ThreadPoolExecutor):
+    """
+    Commits the upload sessions the API staged the claimed files in, with one batched commit per user, then
+    ingests the ones that made it. Files committed by an earlier attempt are in Dropbox already.
+    """
+    uploaded = []
+    for user_id in {f.user_id for f in job_files}:
+        user_files = [f for f in job_files if f.user_id == user_id]
+        staged = {f.tmp_file_loc: (f.upload_session, f.content_hash) for f in user_files if f.upload_session}
+        errors = ingest.commit_upload_sessions(user_id, staged) if staged else {}
+        committed = []
+        for job_file in user_files:
+            if errors.get(job_file.tmp_file_loc) is not None:
+                fail_upload(job_file, errors[job_file.tmp_file_loc])
+                continue
+            if job_file.upload_session:
+                committed.append(job_file)
+            uploaded.append(job_file)
+        if committed:
+            db.set_ingest_job_files_committed(committed)
+    list(pool.map(process_upload, uploaded))
+
+
+def upload_processor():
+    """Processes files accepted by /upload on UPLOAD_PROCESSOR_CONCURRENCY threads, woken by ingestjobfile_new"""
+    listener = db.Listener("ingestjobfile_new")
+    pool = ThreadPoolExecutor(UPLOAD_PROCESSOR_CONCURRENCY, thread_name_prefix="upload_processor")
+    while True:
+        timeout = QUEUE_SAFETY_POLL_SECS
+        try:
+            job_files = db.claim_ingest_job_files(WORKER_ID, UPLOAD_CLAIM_BATCH_SIZE, CLAIM_LEASE_SECS)
+            if job_files:
+                process_uploads(job_files, pool)
+                timeout = 0  # there may be more waiting
+            else:
+                next_retry = db.get_secs_until_next_ingest_job_file()
+                if next_retry is not None:
+                    timeout = min(timeout, max(next_retry, 1))
+        except Exception as e:
+            print("Error in upload_processor:", e)
+            print(traceback.format_exc())
+        finally:
+            listener.wait(timeout)
+
+
+# ===
+# Image Processing
+# ===
+def process_file(
+    file_path: str,
+    tags_list: list[str],
+    access_token: str,
+    img_details: image_processor.ImageData,
+    account_id: str,
+    image_id: str,
+) -> tuple[tuple[str, str, str, str, str, list[str]], data_models.DropboxWriteback]:
+    """The row to save with db.save_captions, and the writeback that syncs it to Dropbox later"""
+    dropbox_destination_path = "/Apps/PixQuery/images/" + os.path.basename(file_path)
+    print("Getting title, caption, and tags ...")
+    title = img_details.title
+    caption = img_details.image_description
+    final_tags_list = db.normalize_tags(tags_list + img_details.tags)
+    writeback = data_models.DropboxWriteback(account_id, dropbox_destination_path, title, caption, final_tags_list)
+    print(f"Processed file: {file_path}")
+    return (file_path, image_id, account_id, title, caption, final_tags_list), writeback
+
+
+# process
+def iter_batch_output(output_file_id: str):
+    """Records of a batch output file, streamed line by line instead of loaded whole"""
+    client = openai.OpenAI()
+    with client.files.with_streaming_response.content(output_file_id) as response:
+        for line in response.iter_lines():
+            if line.strip():
+                yield json.loads(line)
+
+
+def chunked(iterable, size: int):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def finalize_record(json_record: dict, batch_metadata: dict):
+    """Raises ValueError for a record without a usable caption (failed request, unparsable answer)"""
+    if json_record.get("error"):
+        raise ValueError(f"batch request failed: {json_record['error']}")
+    choices = (json_record.get("response") or {}).get("body", {}).get("choices", [])
+    response = choices[0].get("message", {}).get("content") if choices else None
+    img_details = structured_llm_output.parse_llm_response(image_processor.ImageData, response) if response else None
+    if img_details is None:
+        raise ValueError("get_image_captioning returned None")
+    image_path = json_record.get("custom_id")
+    return process_file(
+        image_path,
+        batch_metadata[image_path]["tags"],
+        batch_metadata[image_path]["access_token"],
+        img_details,
+        batch_metadata[image_path]["account_id"],
+        batch_metadata[image_path]["image_id"],
+    )
+
+
+def compute_embeddings_and_metadata_and_push_to_db(
+    batch_id, input_file_id, batch_jsonl_fp, batch_metadata_fp, output_file_id
+):
+    """
+    Streams the batch output in chunks of FINALIZE_CHUNK_SIZE records. Each chunk is saved with one DB write,
+    together with its Dropbox writebacks (sent later by dropbox_writer), which also checkpoints it: after a
+    crash, records whose files are already marked saved are skipped. Records that fail go to the dead
+    letters, from where `worker.py redrive` puts their files in a new batch.
+    """
+    with open(batch_metadata_fp, "r") as f:
+        batch_metadata = json.load(f)
+
+    print("\nbatch processing results:", batch_id)
+    for chunk in chunked(iter_batch_output(output_file_id), FINALIZE_CHUNK_SIZE):
+        saved = db.get_saved_files([x.get("custom_id") for x in chunk])
+        rows, writebacks = [], []
+        for json_record in chunk:
+            if json_record.get("custom_id") in saved:
+                continue
+            try:
+                result = finalize_record(json_record, batch_metadata)
+            except Exception as e:
+                print("Error finalizing record:", e)
+                tmp_file_loc = json_record.get("custom_id")
+                db.dead_letter(
+                    "batch_record",
+                    tmp_file_loc,
+                    {"tmp_file_loc": tmp_file_loc, "batch_id": batch_id},
+                    f"{type(e).__name__}: {e}",
+                    1,
+                    user_id=batch_metadata.get(tmp_file_loc, {}).get("account_id"),
+                )
+                continue
+            rows.append(result[0])
+            writebacks.append(result[1])
+        db.save_captions(rows, writebacks, merge_tags=zero_shot.ZERO_SHOT_TAGS_MODE == "merge")
+        for row in rows:
+            try:
+                os.remove(row[0])
+                print(f"removed file: {row[0]} sucessfully")
+            except Exception as e:
+                print("file removal unsuccessful. got error:", e)
+
+
+def batch_poll_interval(age_secs: float) -> int:
+    """Seconds until the next status check of a batch that has been running for age_secs"""
+    for max_age, interval in BATCH_POLL_INTERVALS:
+        if age_secs < max_age:
+            return interval
+    return BATCH_POLL_INTERVALS[-1][1]
+
+
+def requeue_batch_files(batch_id: str, status: str):
+    """Files of a batch that failed, expired or was cancelled go in a later batch, or to the dead letters"""
+    files = db.requeue_batch_files(batch_id, BATCH_RETRY.max_attempts)
+    parked = [(tmp_file_loc, user_id, attempts) for tmp_file_loc, user_id, attempts, is_parked in files if is_parked]
+    print(f"Batch {batch_id} {status}: {len(files) - len(parked)} files requeued, {len(parked)} dead-lettered")
+    for tmp_file_loc, user_id, attempts in parked:
+        db.dead_letter(
+            "batch_record",
+            tmp_file_loc,
+            {"tmp_file_loc": tmp_file_loc, "batch_id": batch_id},
+            f"batch {status} {attempts} times",
+            attempts,
+            user_id=user_id,
+        )
+
+
+def poll_batch(client: openai.OpenAI, batch_item: data_models.BatchQueue):
+    try:
+        batch_object = client.batches.retrieve(batch_item.batch_id)
+        batch_item.status = batch_object.status
+        if batch_object.status == "completed":
+            print("Caption and Tag Generation (batch job) complete:", batch_item.batch_id)
+            batch_item.output_file_id = batch_object.output_file_id
+        elif batch_object.status in db.TERMINAL_BATCH_STATUSES:
+            print(f"batch job failed with status: {batch_object.status}")
+            requeue_batch_files(batch_item.batch_id, batch_object.status)
+        else:
+            print(f"Batch Object status:", batch_object.status)
+        db.update_batch_queue(batch_item.batch_id, batch_item)
+        # a batch not read back from the DB has no created_at yet: it was just submitted
+        age_secs = (datetime.utcnow() - batch_item.created_at).total_seconds() if batch_item.created_at else 0
+        db.schedule_batch_check(batch_item.batch_id, batch_poll_interval(age_secs))
+    except Exception as e:
+        print(f"Error polling batch {batch_item.batch_id}:", e)
+        db.schedule_batch_check(batch_item.batch_id, BATCH_POLL_INTERVALS[0][1])
+    finally:
+        db.release_batch_claims(WORKER_ID, [batch_item.batch_id])
+
+
+def finalize_batch(batch_item: data_models.BatchQueue):
+    try:
+        compute_embeddings_and_metadata_and_push_to_db(
+            batch_item.batch_id,
+            batch_item.input_file_id,
+            batch_item.batch_jsonl_filepath,
+            batch_item.batch_metadata_filepath,
+            batch_item.output_file_id,
+        )
+        batch_item.are_all_files_updated_in_db = True
+        db.update_batch_queue(batch_item.batch_id, batch_item)
+    except Exception as e:
+        print(f"Error finalizing batch {batch_item.batch_id}:", e)
+        print(traceback.format_exc())
+    finally:
+        db.release_batch_claims(WORKER_ID, [batch_item.batch_id])
+
+
+def job_processor():
+    """
+    Status checks of running batches go to a pool of BATCH_POLL_CONCURRENCY threads, each batch on its own
+    schedule (see BATCH_POLL_INTERVALS). Completed batches go to a separate pool of BATCH_FINALIZE_CONCURRENCY
+    threads, so a large batch being written to the DB doesn't hold up polling or other finalizations.
+    """
+    client = openai.OpenAI()
+    listener = db.Listener("batchqueue_new")
+    poll_pool = ThreadPoolExecutor(BATCH_POLL_CONCURRENCY, thread_name_prefix="batch_poll")
+    finalize_pool = ThreadPoolExecutor(BATCH_FINALIZE_CONCURRENCY, thread_name_prefix="batch_finalize")
+    finalizing: set[Future] = set()
+    while True:
+        timeout = QUEUE_SAFETY_POLL_SECS
+        try:
+            running_batch_jobs = db.claim_running_batch_jobs(WORKER_ID, CLAIM_LEASE_SECS, BATCH_POLL_CONCURRENCY * 4)
+            list(poll_pool.map(lambda x: poll_batch(client, x), running_batch_jobs))
+
+            finalizing = {f for f in finalizing if not f.done()}
+            free_slots = BATCH_FINALIZE_CONCURRENCY - len(finalizing)
+            if free_slots > 0:
+                completed = db.claim_completed_batch_jobs(WORKER_ID, free_slots, CLAIM_LEASE_SECS)
+                finalizing |= {finalize_pool.submit(finalize_batch, x) for x in completed}
+            if finalizing:
+                # come back when a slot frees up, there may be more completed batches waiting
+                timeout = min(timeout, BATCH_FINALIZE_RECHECK_SECS)
+
+            # OpenAI can't notify us, so sleep until the next running batch is due
+            next_check = db.get_secs_until_next_batch_check()
+            if next_check is not None:
+                timeout = min(timeout, max(next_check, 1))
+        except Exception as e:
+            print("Error in job_processor:", e)
+            print(traceback.format_exc())
+        finally:
+            listener.wait(timeout)
+
+
+def remove_orphaned_files():
+    """
+    Remove the local copies under /tmp/<account id>/ older than ORPHANED_FILE_MIN_AGE_SECS that no queue row
+    needs: partial downloads of a worker that died, files of uploads or polled files that failed for good.
+    Emptied per-file folders go too.
+    """
+    cutoff = time.time() - ORPHANED_FILE_MIN_AGE_SECS
+    for user_dir in os.scandir("/tmp"):
+        if not (user_dir.is_dir(follow_symlinks=False) and user_dir.name.startswith("dbid:")):
+            continue
+        partial: list[str] = []
+        finished: list[str] = []
+        for root, _, names in os.walk(user_dir.path):
+            for name in names:
+                path = os.path.join(root, name)
+                if os.path.getmtime(path) >= cutoff:
+                    continue
+                (partial if name.endswith((".part", ".head")) else finished).append(path)
+        live = db.get_live_files(finished) if finished else set()
+        for path in partial + [p for p in finished if p not in live]:
+            try:
+                os.remove(path)
+                print("Removed orphaned file:", path)
+            except FileNotFoundError:
+                pass
+        for root, _, _ in os.walk(user_dir.path, topdown=False):
+            if root != user_dir.path and os.path.getmtime(root) < cutoff and not os.listdir(root):
+                try:
+                    os.rmdir(root)
+                except OSError:
+                    pass  # a download started in it meanwhile
+
+
+def garbage_collector():
+    # clean up files from disk and oai storage and everywhere else it needs to be cleaned from
+    client = openai.OpenAI()
+    listener = db.Listener("batchqueue_finalized")
+    while True:
+        try:
+            # one collector at a time across all workers
+            if not db.acquire_lease("garbage_collector", WORKER_ID, CLAIM_LEASE_SECS):
+                continue
+            # remove files
+            uncleaned_files = db.get_uncleaned_files()
+            if uncleaned_files is not None:
+                for file_item in uncleaned_files:
+                    try:
+                        os.remove(file_item.tmp_file_loc)
+                        file_item.is_cleaned_from_disk = True
+                        db.update_file_queue(file_item.tmp_file_loc, file_item)
+                    except FileNotFoundError:
+                        file_item.is_cleaned_from_disk = True
+                        db.update_file_queue(file_item.tmp_file_loc, file_item)
+                    except Exception as e:
+                        print("File cleaning broke because of error:", e)
+
+            # remove batch files
+            completed_batches = db.get_completed_jobs_but_not_cleaned()
+            if completed_batches is not None:
+                for batch_item in completed_batches:
+                    # check if all files from that batch are done, if yes continue else skip next steps
+                    still_in_process = False
+                    if not batch_item.are_all_files_updated_in_db:
+                        batch_files = db.get_files_by_batch_id(batch_item.batch_id)
+                        if batch_files is not None:
+                            for f in batch_files:
+                                if not f.is_saved_to_db:
+                                    still_in_process = True
+                                    break
+                    if still_in_process:
+                        continue
+                    try:
+                        if not batch_item.are_files_deleted_from_oai_storage:
+                            client.files.delete(batch_item.input_file_id)
+                            client.files.delete(batch_item.output_file_id)
+                            batch_item.are_files_deleted_from_oai_storage = True
+                        if not batch_item.is_cleaned_from_disk:
+                            os.remove(batch_item.batch_jsonl_filepath)
+                            os.remove(batch_item.batch_metadata_filepath)
+                            batch_item.is_cleaned_from_disk = True
+                        print("Clean up and everything done for batch:", batch_item.batch_id)
+                    except Exception as e:
+                        print("Clean up messed up with err:", e)
+                    finally:
+                        db.update_batch_queue(batch_item.batch_id, batch_item)
+
+            remove_orphaned_files()
+
+        except Exception as e:
+            print("Error in garbage_collector:", e)
+            print(traceback.format_exc())
+        finally:
+            listener.wait(GARBAGE_COLLECTION_TIME_SECS)  # right after a batch is finalized, else once in a while
+
+
+# ===
+# Dropbox writeback
+# ===
+def write_back(writeback: data_models.DropboxWriteback, user: data_models.User):
+    for tag in writeback.tags:
+        response = dropbox_client.request(
+            f"{dropbox_client.API_URL}/files/tags/add",
+            user_id=user.user_id,
+            payload={"path": writeback.path, "tag_text": tag.replace(" ", "_")},
+        )
+        if response.status_code not in (200, 409):
+            raise dropbox_client.DropboxError(
+                f"files/tags/add: {response.status_code} - {response.text}", response.status_code
+            )
+    if writeback.title is not None or writeback.caption is not None:
+        # overwrite, not add, so a coalesced update replaces the title and caption sent earlier
+        payload = {
+            "path": writeback.path,
+            "property_groups": [
+                {
+                    "fields": [
+                        {"name": "Title", "value": writeback.title or ""},
+                        {"name": "Caption", "value": writeback.caption or ""},
+                    ],
+                    "template_id": user.template_id,
+                }
+            ],
+        }
+        dropbox_client.rpc("file_properties/properties/overwrite", payload, user_id=user.user_id)
+
+
+def run_writeback(writeback: data_models.DropboxWriteback, user: data_models.User | None):
+    try:
+        if user is not None:
+            write_back(writeback, user)
+        db.complete_dropbox_writeback(WORKER_ID, writeback)
+        print(f"Synced metadata to Dropbox: {writeback.path}")
+    except Exception as e:
+        print(f"Dropbox writeback failed for {writeback.path}:", e)
+        attempts = writeback.attempts + 1
+        if WRITEBACK_RETRY.should_retry(e, attempts):
+            delay = getattr(e, "retry_after", None) or WRITEBACK_RETRY.delay(attempts)
+            db.retry_dropbox_writeback(WORKER_ID, writeback, delay, str(e))
+            return
+        db.dead_letter(
+            "dropbox_writeback",
+            f"{writeback.user_id}:{writeback.path}",
+            dataclasses.asdict(writeback),
+            f"{type(e).__name__}: {e}",
+            attempts,
+            user_id=writeback.user_id,
+        )
+        db.complete_dropbox_writeback(WORKER_ID, writeback)
+
+
+def dropbox_writer():
+    """
+    Sends queued titles, captions and tags to Dropbox on DROPBOX_WRITEBACK_CONCURRENCY threads, all sharing
+    the rate limit of dropbox_client. Failed writebacks back off exponentially, or as long as Dropbox's Retry-After says.
+    """
+    listener = db.Listener("dropboxwriteback_new")
+    pool = ThreadPoolExecutor(DROPBOX_WRITEBACK_CONCURRENCY, thread_name_prefix="dropbox_writer")
+    while True:
+        timeout = QUEUE_SAFETY_POLL_SECS
+        try:
+            writebacks = db.claim_dropbox_writebacks(WORKER_ID, DROPBOX_WRITEBACK_CONCURRENCY * 4, CLAIM_LEASE_SECS)
+            if writebacks:
+                # for the template_id; tokens come from dropbox_client
+                users = {user_id: db.read_user(user_id) for user_id in {x.user_id for x in writebacks}}
+                list(pool.map(lambda x: run_writeback(x, users[x.user_id]), writebacks))
+                timeout = 0  # there may be more waiting
+            else:
+                next_attempt = db.get_secs_until_next_dropbox_writeback()
+                if next_attempt is not None:
+                    timeout = min(timeout, max(next_attempt, 1))
+        except Exception as e:
+            print("Error in dropbox_writer:", e)
+            print(traceback.format_exc())
+        finally:
+            listener.wait(timeout)
+
+
+# ===
+# Poller
+# ===
+def list_dropbox_folder(
+    user_id: str, filepath: str, cursor: str | None = None, limit: int = DROPBOX_LIST_PAGE_SIZE
+) -> dict:
+    """One page of the folder listing; limit only applies when starting a listing, a cursor keeps its own"""
+    if cursor is None:
+        data: dict = {
+            "limit": limit,
+            "include_deleted": False,
+            "include_has_explicit_shared_members": True,
+            "include_media_info": True,
+            "include_mounted_folders": True,
+            "include_non_downloadable_files": False,
+            "path": filepath,
+            "recursive": True,
+        }
+        return dropbox_client.rpc("files/list_folder", data, user_id=user_id)
+    return dropbox_client.rpc("files/list_folder/continue", {"cursor": cursor}, user_id=user_id)
+
+
+class DropboxSync:
+    """
+    Keeps the Dropbox folder of every user this worker holds the dropbox_poll lease for in sync.
+
+    A user is either waiting in files/list_folder/longpoll (up to DROPBOX_LONGPOLL_CONCURRENCY at once) or
+    queued for a sync turn (DROPBOX_SYNC_CONCURRENCY at once). A turn handles at most DROPBOX_SYNC_PAGES_PER_TURN
+    pages, checkpointing the cursor after each, and then goes to the back of the queue, so a large initial
+    listing doesn't starve the other users. The entries of a page go through the ingest pipeline, shared by
+    all users, and the cursor is saved once they are all in.
+
+    Turns are weighted by TenantShare like the queues: a user's turn has DROPBOX_SYNC_PAGES_PER_TURN pages
+    scaled by their weight, so pages of equal size (DROPBOX_LIST_PAGE_SIZE) reach the pipeline in proportion to
+    the weights of the users waiting for a turn.
+    """
+
+    ROOT_PATH = "/Apps/PixQuery/images"
+
+    def __init__(self, ingest: pipeline.Pipeline):
+        self.ingest = ingest
+        self.watched: set[str] = set()
+        self.lock = threading.Lock()
+        self.sync_pool = ThreadPoolExecutor(DROPBOX_SYNC_CONCURRENCY, thread_name_prefix="dropbox_sync")
+        self.longpoll_pool = ThreadPoolExecutor(DROPBOX_LONGPOLL_CONCURRENCY, thread_name_prefix="dropbox_longpoll")
+
+    def lease_name(self, user_id: str) -> str:
+        return f"dropbox_poll:{user_id}"
+
+    def adopt_users(self):
+        """Start watching users no live worker is watching, up to DROPBOX_MAX_USERS_PER_WORKER"""
+        for user in db.get_all_users():
+            with self.lock:
+                if user.user_id in self.watched or len(self.watched) >= DROPBOX_MAX_USERS_PER_WORKER:
+                    continue
+            if db.acquire_lease(self.lease_name(user.user_id), WORKER_ID, CLAIM_LEASE_SECS):
+                print(f"Watching Dropbox of user: {user.user_name}")
+                with self.lock:
+                    self.watched.add(user.user_id)
+                self.sync_pool.submit(self.sync, user.user_id)
+
+    def drop(self, user_id: str):
+        with self.lock:
+            self.watched.discard(user_id)
+        db.release_lease(self.lease_name(user_id), WORKER_ID)
+
+    def retry_later(self, user_id: str):
+        timer = threading.Timer(DROPBOX_SYNC_RETRY_SECS, self.sync_pool.submit, (self.sync, user_id))
+        timer.daemon = True
+        timer.start()
+
+    def sync(self, user_id: str):
+        try:
+            if not db.acquire_lease(self.lease_name(user_id), WORKER_ID, CLAIM_LEASE_SECS):
+                with self.lock:
+                    self.watched.discard(user_id)  # lease lapsed and another worker took over
+                return
+            user = db.read_user(user_id, on_primary=True)  # the cursor must be the last one saved
+            if user is None:
+                self.drop(user_id)
+                return
+            cursor = user.cursor
+            weight, cap = db.get_tenant_share(user_id)
+            pages = max(round(DROPBOX_SYNC_PAGES_PER_TURN * weight / db.FAIR_SHARE_DEFAULT_WEIGHT), 1)
+            page_size = min(DROPBOX_LIST_PAGE_SIZE, cap) if cap else DROPBOX_LIST_PAGE_SIZE
+            for _ in range(pages):
+                res = list_dropbox_folder(user_id, self.ROOT_PATH, cursor, page_size)
+                files = new_polled_files(user_id, res["entries"])
+                print(f"Dropbox of user {user_id}: {len(files)} new of {len(res['entries'])} entries")
+                group = self.ingest.submit(files)
+                group.wait()
+                if group.failed:
+                    # keep the cursor before this page; entries that made it are skipped on the retry
+                    raise RuntimeError(f"{group.failed} files of the page failed to ingest")
+                cursor = res["cursor"]
+                db.update_user_cursor(user_id, cursor)
+                if not res["has_more"]:
+                    self.retry_failed_files(user_id)
+                    self.longpoll_pool.submit(self.longpoll, user_id, cursor)
+                    return
+            self.sync_pool.submit(self.sync, user_id)
+        except dropbox_client.DropboxError as e:
+            if e.status_code == 409 and "reset" in str(e):
+                # the cursor is no longer valid, list from scratch
+                db.update_user_cursor(user_id, None)
+                self.sync_pool.submit(self.sync, user_id)
+                return
+            print(f"Error syncing Dropbox of user {user_id}:", e)
+            self.retry_later(user_id)
+        except Exception as e:
+            print(f"Error syncing Dropbox of user {user_id}:", e)
+            print(traceback.format_exc())
+            self.retry_later(user_id)
+
+    def retry_failed_files(self, user_id: str):
+        """Put files whose ingest failed and whose retry time has come through the pipeline again"""
+        entries = []
+        gone = []
+        for path in db.get_due_ingest_failures(user_id):
+            try:
+                entries.append(
+                    dropbox_client.rpc(
+                        "files/get_metadata", {"path": path, "include_media_info": True}, user_id=user_id
+                    )
+                )
+            except dropbox_client.DropboxError as e:
+                if e.status_code != 409:  # 409 is path/not_found
+                    raise
+                gone.append(path)
+        files = new_polled_files(user_id, entries)
+        retried = {x.ent["path_display"] for x in files}
+        gone += [ent["path_display"] for ent in entries if ent["path_display"] not in retried]  # ingested meanwhile
+        if gone:
+            db.clear_ingest_failures(user_id, gone)
+        if files:
+            print(f"Retrying {len(files)} failed files of user {user_id}")
+            self.ingest.submit(files).wait()
+
+    def longpoll(self, user_id: str, cursor: str):
+        try:
+            res = dropbox_client.longpoll(cursor, DROPBOX_LONGPOLL_TIMEOUT_SECS)
+            if res.get("backoff"):
+                time.sleep(res["backoff"])
+            with self.lock:
+                if user_id not in self.watched:
+                    return
+            if res.get("changes"):
+                self.sync_pool.submit(self.sync, user_id)
+            else:
+                self.retry_failed_files(user_id)  # the folder being quiet shouldn't hold them back
+                self.longpoll_pool.submit(self.longpoll, user_id, cursor)
+        except Exception as e:
+            print(f"Error in Dropbox longpoll of user {user_id}:", e)
+            self.retry_later(user_id)
+
+
+def dropbox_sync():
+    sync = DropboxSync(make_ingest_pipeline())
+    listener = db.Listener("users_new")
+    while True:
+        try:
+            sync.adopt_users()
+        except Exception as e:
+            print(traceback.format_exc())
+            print("Error in dropbox_sync:", e)
+        finally:
+            # right away for a new user, else regularly to take over users of workers that died
+            listener.wait(POLL_WINDOW_TIME_SECS)
+
+
+# ===
+# Ingest pipeline for polled files
+# ===
+@dataclasses.dataclass
+class PolledFile:
+    ent: dict  # list_folder entry
+    user_id: str
+    file_path: str = ""  # local copy
+    url: str = ""
+    img_metadata: dict | None = None  # from the entry's media_info, when ingesting a thumbnail
+    image_columns: dict | None = None  # from ingest.analyze_image
+    embedding: list[float] | None = None
+    tags: list[str] | None = None  # zero-shot, until the LLM tags arrive
+
+
+def new_polled_files(user_id: str, entries: list[dict]) -> list[PolledFile]:
+    """The images of a list_folder page that are neither ingested nor queued yet, checked in one query"""
+    files = []
+    for ent in entries:
+        if ent[".tag"] != "file":
+            continue
+        if not (ent["name"].lower().endswith((".jpg", ".jpeg", ".png"))):
+            continue
+        x = PolledFile(ent, user_id)
+        x.url = f"https://www.dropbox.com/home{os.path.dirname(ent['path_display'])}?preview={ent['name']}"
+        # one folder per Dropbox file id: names repeat across folders, the basename is the writeback's file name
+        x.file_path = os.path.join("/tmp", user_id, ent["id"].removeprefix("id:"), ent["name"])
+        if INGEST_SOURCE == "thumbnail":
+            x.img_metadata = media_info_metadata(ent)
+        files.append(x)
+    if not files:
+        return []
+    known = db.get_known_files(user_id, [x.url for x in files], [x.file_path for x in files])
+    files = [x for x in files if x.url not in known]
+    if not files:
+        return []
+    blocked = db.get_blocked_files(
+        user_id, [x.ent["path_display"] for x in files], [x.ent.get("content_hash", "") for x in files]
+    )
+    for x in files:
+        if x.ent["path_display"] in blocked:
+            print("Ignoring file at:", x.ent["path_display"])
+    return [x for x in files if x.ent["path_display"] not in blocked]
+
+
+def media_info_metadata(ent: dict) -> dict | None:
+    """
+    The EXIF fields image_detail uses (capture date, GPS) from a list_folder entry's media_info, in the shape
+    of process.extract_image_metadata. None if Dropbox hasn't indexed the photo yet.
+    """
+    media_info = ent.get("media_info") or {}
+    if media_info.get(".tag") != "metadata":
+        return None
+    meta = media_info.get("metadata", {})
+    img_metadata: dict = {"capture_date": None}
+    if meta.get("time_taken"):
+        time_taken = datetime.strptime(meta["time_taken"], "%Y-%m-%dT%H:%M:%SZ")
+        img_metadata["capture_date"] = time_taken.strftime("%Y:%m:%d %H:%M:%S")
+    if meta.get("location"):
+        img_metadata["latitude"] = meta["location"]["latitude"]
+        img_metadata["longitude"] = meta["location"]["longitude"]
+    if meta.get("dimensions"):
+        img_metadata["ExifImageWidth"] = meta["dimensions"]["width"]
+        img_metadata["ExifImageHeight"] = meta["dimensions"]["height"]
+    return img_metadata
+
+
+def download_polled_file(x: PolledFile) -> PolledFile:
+    dropbox_client.download(x.ent["path_display"], x.file_path, x.user_id, DOWNLOAD_CHUNK_BYTES)
+    print(f" Downloaded: {x.ent['name']} to {x.file_path}")
+    return x
+
+
+# how thumbnail ingest got the EXIF of files whose listing had no media_info, and how many fell back to the
+# original; logged by fetch_polled_thumbnails
+_thumbnail_fallbacks: collections.Counter = collections.Counter()
+_thumbnail_fallbacks_lock = threading.Lock()
+
+
+def _count_thumbnail_fallback(kind: str):
+    with _thumbnail_fallbacks_lock:
+        _thumbnail_fallbacks[kind] += 1
+
+
+def fetch_polled_metadata(x: PolledFile) -> dict | None:
+    """
+    EXIF fields of a file whose list_folder entry had no media_info: from files/get_metadata (Dropbox may have
+    indexed the photo since the listing), else read from the first EXIF_HEAD_BYTES of the file.
+    None if neither works, and the original has to be downloaded.
+    """
+    ent = dropbox_client.rpc(
+        "files/get_metadata", {"path": x.ent["path_display"], "include_media_info": True}, user_id=x.user_id
+    )
+    img_metadata = media_info_metadata(ent)
+    if img_metadata is not None:
+        _count_thumbnail_fallback("get_metadata")
+        return img_metadata
+
+    response = dropbox_client.request(
+        f"{dropbox_client.CONTENT_URL}/files/download",
+        user_id=x.user_id,
+        arg={"path": x.ent["path_display"]},
+        headers={"Range": f"bytes=0-{EXIF_HEAD_BYTES - 1}"},
+    )
+    if response.status_code not in (200, 206):
+        return None
+    os.makedirs(os.path.dirname(x.file_path), exist_ok=True)
+    head_path = x.file_path + ".head"
+    try:
+        with open(head_path, "wb") as f:
+            f.write(response.content[:EXIF_HEAD_BYTES])
+        img_metadata = image_processor.extract_image_metadata(head_path)
+    finally:
+        os.remove(head_path)
+    if img_metadata is None:
+        return None
+    _count_thumbnail_fallback("exif_head")
+    return img_metadata
+
+
+def fetch_polled_thumbnails(xs: list[PolledFile]) -> list[PolledFile | Exception]:
+    """
+    Fetches renditions of up to DROPBOX_THUMBNAIL_BATCH_SIZE files per call; they feed the thumbnail, the
+    embedding and the LLM, none of which needs more than DROPBOX_THUMBNAIL_SIZE. EXIF comes from media_info,
+    fetched again or read from the head of the file when the listing had none (see fetch_polled_metadata).
+    Only files that Dropbox can't render, or whose EXIF can't be had that way, are downloaded in full.
+    """
+    results: dict[int, PolledFile | Exception] = {}
+    by_user: dict[str, list[int]] = {}
+    for i, x in enumerate(xs):
+        if x.img_metadata is None:
+            try:
+                x.img_metadata = fetch_polled_metadata(x)
+            except dropbox_client.DropboxRetryLater:
+                raise
+            except Exception as e:
+                print(f"Could not get the metadata of {x.ent['path_display']}:", e)
+            if x.img_metadata is None:
+                _count_thumbnail_fallback("original_no_metadata")
+                continue
+        by_user.setdefault(x.user_id, []).append(i)
+    for user_id, indexes in by_user.items():
+        entries = []
+        for i in indexes:
+            fmt = "png" if xs[i].file_path.lower().endswith(".png") else "jpeg"  # keep the name matching the bytes
+            entries.append({"path": xs[i].ent["path_display"], "format": fmt, "size": DROPBOX_THUMBNAIL_SIZE})
+        response = dropbox_client.request(
+            f"{dropbox_client.CONTENT_URL}/files/get_thumbnail_batch",
+            user_id=user_id,
+            payload={"entries": entries},
+        )
+        if response.status_code != 200:
+            raise dropbox_client.DropboxError(
+                f"get_thumbnail_batch: {response.status_code} - {response.text}", response.status_code
+            )
+        for i, entry in zip(indexes, response.json()["entries"]):
+            if entry[".tag"] != "success":
+                _count_thumbnail_fallback("original_not_rendered")
+                continue  # falls back to the original below
+            x = xs[i]
+            os.makedirs(os.path.dirname(x.file_path), exist_ok=True)
+            with open(x.file_path + ".part", "wb") as f:
+                f.write(base64.b64decode(entry["thumbnail"]))
+            os.replace(x.file_path + ".part", x.file_path)
+            results[i] = x
+    for i, x in enumerate(xs):
+        if i in results:
+            continue
+        x.img_metadata = None
+        try:
+            results[i] = download_polled_file(x)
+        except Exception as e:
+            results[i] = e
+    with _thumbnail_fallbacks_lock:
+        fallbacks = dict(_thumbnail_fallbacks)
+    print(
+        f" Fetched {len(xs)} files, {sum(x.img_metadata is not None for x in xs)} as thumbnails; "
+        f"metadata fallbacks so far: {fallbacks}"
+    )
+    return [results[i] for i in range(len(xs))]
+
+
+def analyze_polled_file(x: PolledFile) -> PolledFile:
+    x.image_columns = ingest.analyze_image(x.file_path, x.img_metadata)
+    return x
+
+
+def embed_polled_files(xs: list[PolledFile]) -> list[PolledFile | Exception]:
+    embeddings = image_processor.get_image_embeddings([x.file_path for x in xs])
+    for x, embedding, tags in zip(xs, embeddings, zero_shot.tags_for(embeddings)):
+        x.embedding = embedding
+        x.tags = tags
+    return [x if x.embedding is not None else ValueError(f"Could not embed {x.file_path}") for x in xs]
+
+
+def insert_polled_files(xs: list[PolledFile]) -> list[None | Exception]:
+    """
+    One bulk insert; if the database rejects it, the files are inserted one by one so that only the bad ones
+    fail. The database being unreachable fails the whole batch.
+    """
+    images = [
+        dict(url=x.url, embedded_vector=x.embedding, user_id=x.user_id, tags=x.tags, **x.image_columns) for x in xs
+    ]
+    file_queues = [
+        data_models.FileQueue(x.file_path, "", dropbox_client.get_access_token(x.user_id), x.user_id, None) for x in xs
+    ]
+    results: list[None | Exception] = [None] * len(xs)
+    try:
+        db.insert_many(images, file_queues)
+    except psycopg2.OperationalError:
+        raise
+    except psycopg2.Error as e:
+        print(f"Bulk insert of {len(xs)} files failed, inserting them one by one:", e)
+        for i in range(len(xs)):
+            try:
+                db.insert_many(images[i : i + 1], file_queues[i : i + 1])
+            except psycopg2.OperationalError:
+                raise
+            except psycopg2.Error as row_error:
+                results[i] = row_error
+    inserted = [x for x, result in zip(xs, results) if result is None]
+    for user_id in {x.user_id for x in inserted}:
+        db.clear_ingest_failures(user_id, [x.ent["path_display"] for x in inserted if x.user_id == user_id])
+    return results
+
+
+def on_ingest_error(stage: pipeline.Stage, x: PolledFile, e: Exception) -> bool:
+    """
+    Records the file in IngestFailure so polls skip it until its retry time, instead of downloading and
+    failing it again every cycle. Dropbox being unavailable isn't the file's fault: those failures are left to
+    fail the page, which is retried soon with the cursor held back.
+    """
+    if isinstance(e, dropbox_client.DropboxRetryLater):
+        print(f"Ingest of {x.ent['path_display']} failed in {stage.name}, retrying the page:", e)
+        return False
+    if isinstance(e, PIL.UnidentifiedImageError):
+        print("PIL is unable to identify image type")
+    path, content_hash = x.ent["path_display"], x.ent.get("content_hash", "")
+    reason = f"{stage.name}: {type(e).__name__}: {e}"
+    attempts = db.record_ingest_failure(
+        x.user_id, path, content_hash, reason, INGEST_RETRY.base_delay_secs, INGEST_RETRY.max_delay_secs
+    )
+    print(f"Ingest of {path} failed ({attempts} attempts so far), {reason}")
+    if x.file_path:
+        remove_local_copy(x.file_path)  # downloaded again when it's retried
+    if not INGEST_RETRY.should_retry(e, attempts):
+        db.park_ingest_failure(x.user_id, path, content_hash)
+        payload = {"user_id": x.user_id, "path": path, "content_hash": content_hash}
+        db.dead_letter("polled_file", f"{x.user_id}:{path}", payload, reason, attempts, user_id=x.user_id)
+    return True
+
+
+def make_ingest_pipeline() -> pipeline.Pipeline:
+    """new list_folder entries -> download -> thumbnail/EXIF -> batched embedding -> bulk insert"""
+    if INGEST_SOURCE == "thumbnail":
+        fetch = pipeline.Stage(
+            "download", fetch_polled_thumbnails, INGEST_DOWNLOAD_CONCURRENCY, DROPBOX_THUMBNAIL_BATCH_SIZE
+        )
+    else:
+        fetch = pipeline.Stage("download", download_polled_file, INGEST_DOWNLOAD_CONCURRENCY)
+    return pipeline.Pipeline(
+        [
+            fetch,
+            pipeline.Stage("analyze", analyze_polled_file, INGEST_ANALYZE_CONCURRENCY),
+            pipeline.Stage("embed", embed_polled_files, 1, INGEST_EMBED_BATCH_SIZE),
+            pipeline.Stage("insert", insert_polled_files, 1, INGEST_INSERT_BATCH_SIZE),
+        ],
+        queue_size=INGEST_QUEUE_SIZE,
+        on_error=on_ingest_error,
+    )
+
+
+# ===
+# Dead letters
+# ===
+def redrive(dead_letter: data_models.DeadLetter):
+    """Run dead-lettered work again, or put it back in its queue; the dead letter goes once that worked"""
+    payload = dead_letter.payload
+    if dead_letter.kind == "upload" and "job_id" in payload:
+        job_files = db.get_ingest_job(payload["job_id"], dead_letter.user_id, on_primary=True) or []
+        job_files = [f for f in job_files if f.file_id == payload["file_id"]]
+        if not job_files:
+            raise ValueError(f"Upload job {payload['job_id']} is gone")
+        job_file = job_files[0]
+        job_file.status, job_file.attempts = "stored", 0
+        db.update_ingest_job_file(job_file)  # upload_processor picks it up again
+    elif dead_letter.kind == "upload":
+        # dead-lettered by the API before upload jobs: queued as a job of its own, the file is still on local disk
+        file_location = payload["file_location"]
+        if not os.path.exists(file_location):
+            raise ValueError(f"{file_location} is gone from this node's disk, the upload has to be sent again")
+        job_id, file_id = str(uuid.uuid4()), str(uuid.uuid4())
+        job_file = data_models.IngestJobFile(
+            job_id, file_id, payload["account_id"], os.path.basename(file_location), file_location, payload["tags"]
+        )
+        db.create_ingest_job(job_id, payload["account_id"], [job_file])  # upload_processor picks it up
+    elif dead_letter.kind == "polled_file":
+        # due right away; DropboxSync retries it on its next turn for the user
+        db.reset_ingest_failure(payload["user_id"], payload["path"])
+    elif dead_letter.kind == "batch_record":
+        if not db.requeue_file(payload["tmp_file_loc"]):
+            raise ValueError(f"{payload['tmp_file_loc']} is not in FileQueue anymore, or already saved")
+    elif dead_letter.kind == "dropbox_writeback":
+        writeback = data_models.DropboxWriteback(
+            payload["user_id"], payload["path"], payload["title"], payload["caption"], payload["tags"]
+        )
+        db.enqueue_dropbox_writebacks([writeback])
+    else:
+        raise ValueError(f"Unknown dead letter kind: {dead_letter.kind}")
+    db.delete_dead_letter(dead_letter.id)
+
+
+def redrive_dead_letters(kind: str | None = None, ids: list[int] | None = None, list_only: bool = False):
+    dead_letters = db.get_dead_letters(kind, ids, limit=10_000)
+    for dead_letter in dead_letters:
+        print(
+            f"[{dead_letter.id}] {dead_letter.kind} {dead_letter.key} ({dead_letter.attempts} attempts): {dead_letter.error}"
+        )
+        if list_only:
+            continue
+        try:
+            redrive(dead_letter)
+            print("  redriven")
+        except Exception as e:
+            print("  redrive failed:", e)
+    print(f"{len(dead_letters)} dead letters")
+
+
+LOOPS = {
+    "upload_processor": upload_processor,
+    "file_processor": file_processor,
+    "job_processor": job_processor,
+    "garbage_collector": garbage_collector,
+    "dropbox_sync": dropbox_sync,
+    "dropbox_writer": dropbox_writer,
+}
+
+
+def start(loops: list[str] | None = None) -> list[threading.Thread]:
+    """Start the heartbeat and the given background loops (all by default) as daemon threads"""
+    threads = [threading.Thread(target=heartbeat, daemon=True)]
+    threads += [threading.Thread(target=LOOPS[name], name=name, daemon=True) for name in loops or LOOPS]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", nargs="?", choices=["run", "redrive"], default="run")
+    parser.add_argument("--only", nargs="+", choices=list(LOOPS), help="run only these loops")
+    parser.add_argument("--kind", help="redrive: only dead letters of this kind")
+    parser.add_argument("--id", nargs="+", type=int, help="redrive: only these dead letters")
+    parser.add_argument("--list", action="store_true", help="redrive: only list the dead letters")
+    args = parser.parse_args()
+
+    if args.command == "redrive":
+        redrive_dead_letters(args.kind, args.id, args.list)
+        raise SystemExit(0)
+
+    def shutdown(signum, frame):
+        print(f"Worker {WORKER_ID} shutting down, releasing claims")
+        db.release_all_leases(WORKER_ID)
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    db.check_and_create_tables()
+    print(f"Worker {WORKER_ID} starting: {', '.join(args.only or LOOPS)}")
+    for thread in start(args.only):
+        thread.join()
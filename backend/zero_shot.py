@@ -0,0 +1,103 @@
+"""
+Zero-shot tags from CLIP, so a new image can be found by its tags right away instead of once its LLM
+caption comes back from the OpenAI batch.
+
+The text embeddings of the tag vocabulary (ZERO_SHOT_VOCAB_PATH, one tag per line) are computed once and
+kept as a normalized NumPy matrix in ZERO_SHOT_MATRIX_DIR; tagging a batch of images is then a single
+matrix multiply of their embeddings against it. Run `python zero_shot.py` to build the matrix ahead of time.
+"""
+import hashlib
+import os
+import threading
+
+import numpy as np
+import torch
+
+import process as image_processor
+
+ZERO_SHOT_TAGS = os.environ.get("ZERO_SHOT_TAGS", "1") == "1"
+ZERO_SHOT_VOCAB_PATH = os.environ.get(
+    "ZERO_SHOT_VOCAB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "zero_shot_vocab.txt")
+)
+ZERO_SHOT_MATRIX_DIR = os.environ.get("ZERO_SHOT_MATRIX_DIR", "/tmp")
+ZERO_SHOT_TOP_K = int(os.environ.get("ZERO_SHOT_TOP_K", 5))
+# cosine similarity a tag needs; CLIP ViT-B/32 puts matching image/text pairs at about 0.25-0.35
+ZERO_SHOT_MIN_SCORE = float(os.environ.get("ZERO_SHOT_MIN_SCORE", 0.24))
+# once the LLM caption arrives: "merge" keeps the zero-shot tags after the LLM's, "replace" drops them
+ZERO_SHOT_TAGS_MODE = os.environ.get("ZERO_SHOT_TAGS_MODE", "replace")
+PROMPT_TEMPLATE = "a photo of {}"
+TEXT_BATCH_SIZE = 256
+
+_vocabulary: list[str] | None = None
+_matrix: np.ndarray | None = None  # (embedding dim, vocabulary size), columns normalized
+_lock = threading.Lock()
+
+
+def load_vocabulary(path: str = ZERO_SHOT_VOCAB_PATH) -> list[str]:
+    with open(path, "r") as f:
+        return list(dict.fromkeys(line.strip().lower() for line in f if line.strip()))
+
+
+def matrix_path(vocabulary: list[str]) -> str:
+    """The matrix file is named after the vocabulary, so editing the vocabulary rebuilds it"""
+    digest = hashlib.sha256("\n".join([PROMPT_TEMPLATE, *vocabulary]).encode()).hexdigest()[:16]
+    return os.path.join(ZERO_SHOT_MATRIX_DIR, f"zero_shot_{digest}.npy")
+
+
+def compute_matrix(vocabulary: list[str]) -> np.ndarray:
+    chunks = []
+    with torch.no_grad():
+        for i in range(0, len(vocabulary), TEXT_BATCH_SIZE):
+            texts = [PROMPT_TEMPLATE.format(tag) for tag in vocabulary[i : i + TEXT_BATCH_SIZE]]
+            inputs = image_processor.processor(text=texts, return_tensors="pt", padding=True)
+            chunks.append(image_processor.model.get_text_features(**inputs).numpy())
+    text_embeddings = np.concatenate(chunks).astype(np.float32)
+    text_embeddings /= np.linalg.norm(text_embeddings, axis=1, keepdims=True)
+    return np.ascontiguousarray(text_embeddings.T)
+
+
+def get_matrix() -> tuple[list[str], np.ndarray]:
+    """The vocabulary and its matrix, loaded from disk or computed (and saved) on first use"""
+    global _vocabulary, _matrix
+    with _lock:
+        if _matrix is None:
+            vocabulary = load_vocabulary()
+            path = matrix_path(vocabulary)
+            if os.path.exists(path):
+                matrix = np.load(path)
+            else:
+                print(f"Computing zero-shot text embeddings of {len(vocabulary)} tags ...")
+                matrix = compute_matrix(vocabulary)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                np.save(path + ".part.npy", matrix)
+                os.replace(path + ".part.npy", path)
+            _vocabulary, _matrix = vocabulary, matrix
+        return _vocabulary, _matrix
+
+
+def tags_for(embeddings: list[list[float] | None]) -> list[list[str] | None]:
+    """
+    Up to ZERO_SHOT_TOP_K vocabulary tags per image embedding (from process.get_image_embedding(s)), best
+    first; None for a missing embedding, or for all of them if zero-shot tagging is off.
+    """
+    if not ZERO_SHOT_TAGS:
+        return [None] * len(embeddings)
+    present = [i for i, embedding in enumerate(embeddings) if embedding is not None]
+    tags: list[list[str] | None] = [None] * len(embeddings)
+    if not present:
+        return tags
+    vocabulary, matrix = get_matrix()
+    images = np.asarray([embeddings[i] for i in present], dtype=np.float32)
+    images /= np.linalg.norm(images, axis=1, keepdims=True)
+    scores = images @ matrix  # (images, vocabulary) cosine similarities
+    k = min(ZERO_SHOT_TOP_K, len(vocabulary))
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    for row, i in enumerate(present):
+        best = sorted(top[row], key=lambda j: -scores[row, j])
+        tags[i] = [vocabulary[j] for j in best if scores[row, j] >= ZERO_SHOT_MIN_SCORE]
+    return tags
+
+
+if __name__ == "__main__":
+    vocabulary, matrix = get_matrix()
+    print(f"{len(vocabulary)} tags, matrix {matrix.shape} at {matrix_path(vocabulary)}")
@@ -0,0 +1,3 @@
+#!/bin/bash
+# allow streaming replication connections (used by docker-compose.replica.yml)
+echo "host replication all all scram-sha-256" >> "$PGDATA/pg_hba.conf"
@@ -14,3 +14,380 @@ ADD CONSTRAINT fk_user_id
 FOREIGN KEY (user_id) REFERENCES users(user_id)
 ON DELETE CASCADE;
 
+
+
+-- store image_detail.tags as a normalized text[] with a GIN index
+CREATE
+OR REPLACE FUNCTION tags_to_text(tags TEXT[])
+RETURNS TEXT AS $$
+  SELECT COALESCE(array_to_string(tags, ' '), '');
+$$
+LANGUAGE 'sql' IMMUTABLE;
+
+ALTER TABLE image_detail DROP COLUMN title_caption_tags_fts_vector;
+
+ALTER TABLE image_detail
+ALTER COLUMN tags TYPE TEXT[] USING string_to_array(tags, ',');
+
+-- de-duplicated in their original order, like db.normalize_tags
+UPDATE image_detail SET tags = ARRAY(
+  SELECT lower(btrim(t)) FROM unnest(tags) WITH ORDINALITY AS u (t, i)
+  WHERE btrim(t) <> ''
+  GROUP BY lower(btrim(t))
+  ORDER BY min(i)
+)
+WHERE tags IS NOT NULL;
+
+ALTER TABLE image_detail
+ADD COLUMN title_caption_tags_fts_vector tsvector generated always as (to_tsvector('english', tags_to_text(tags) || ' ' ||
+                                                                                           COALESCE(title, '') || ' ' ||
+                                                                                           COALESCE(caption, ''))) stored;
+
+CREATE INDEX IF NOT EXISTS idx_image_detail_tags ON image_detail USING GIN (tags);
+
+
+-- per-user facet counts (season, year, capture month, tag), kept up to date by triggers on image_detail
+CREATE TABLE IF NOT EXISTS image_facet (
+  user_id TEXT NOT NULL,
+  facet TEXT NOT NULL,
+  value TEXT NOT NULL,
+  count INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (user_id, facet, value),
+  FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+);
+
+-- facet rows an image contributes to
+CREATE
+OR REPLACE FUNCTION image_facet_rows(p_season TEXT, p_capture_time TIMESTAMP, p_tags TEXT[])
+RETURNS TABLE (facet TEXT, value TEXT) AS $$
+  SELECT 'season', p_season WHERE p_season IS NOT NULL
+  UNION ALL
+  SELECT 'year', to_char(p_capture_time, 'YYYY') WHERE p_capture_time IS NOT NULL
+  UNION ALL
+  SELECT 'month', to_char(p_capture_time, 'YYYY-MM') WHERE p_capture_time IS NOT NULL
+  UNION ALL
+  SELECT DISTINCT 'tag', t FROM unnest(p_tags) AS t;
+$$
+LANGUAGE 'sql' STABLE;
+
+-- statement level, so bulk writes apply one aggregated delta per facet instead of one per row
+CREATE
+OR REPLACE FUNCTION update_image_facets()
+RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    INSERT INTO image_facet (user_id, facet, value, count)
+    SELECT n.user_id, r.facet, r.value, count(*)
+    FROM new_rows n, image_facet_rows(n.season, n.capture_time, n.tags) r
+    GROUP BY 1, 2, 3
+    ON CONFLICT (user_id, facet, value) DO UPDATE SET count = image_facet.count + EXCLUDED.count;
+  ELSIF TG_OP = 'UPDATE' THEN
+    INSERT INTO image_facet (user_id, facet, value, count)
+    SELECT user_id, facet, value, sum(delta)
+    FROM (
+      SELECT n.user_id, r.facet, r.value, 1 AS delta
+      FROM new_rows n, image_facet_rows(n.season, n.capture_time, n.tags) r
+      UNION ALL
+      SELECT o.user_id, r.facet, r.value, -1 AS delta
+      FROM old_rows o, image_facet_rows(o.season, o.capture_time, o.tags) r
+    ) AS changes
+    GROUP BY 1, 2, 3
+    HAVING sum(delta) <> 0
+    ON CONFLICT (user_id, facet, value) DO UPDATE SET count = image_facet.count + EXCLUDED.count;
+    DELETE FROM image_facet WHERE count <= 0 AND user_id IN (SELECT user_id FROM old_rows);
+  ELSIF TG_OP = 'DELETE' THEN
+    UPDATE image_facet f SET count = f.count - removed.n
+    FROM (
+      SELECT o.user_id, r.facet, r.value, count(*) AS n
+      FROM old_rows o, image_facet_rows(o.season, o.capture_time, o.tags) r
+      GROUP BY 1, 2, 3
+    ) AS removed
+    WHERE f.user_id = removed.user_id AND f.facet = removed.facet AND f.value = removed.value;
+    DELETE FROM image_facet WHERE count <= 0 AND user_id IN (SELECT user_id FROM old_rows);
+  END IF;
+  RETURN NULL;
+END;
+$$
+LANGUAGE 'plpgsql';
+
+CREATE TRIGGER image_facet_insert_trigger
+AFTER INSERT ON image_detail
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_image_facets();
+
+CREATE TRIGGER image_facet_update_trigger
+AFTER UPDATE ON image_detail
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_image_facets();
+
+CREATE TRIGGER image_facet_delete_trigger
+AFTER DELETE ON image_detail
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_image_facets();
+
+-- backfill facet counts for existing images
+INSERT INTO image_facet (user_id, facet, value, count)
+SELECT d.user_id, r.facet, r.value, count(*)
+FROM image_detail d, image_facet_rows(d.season, d.capture_time, d.tags) r
+GROUP BY 1, 2, 3
+ON CONFLICT (user_id, facet, value) DO NOTHING;
+
+
+-- compact binary-quantized vector index (pgvector >= 0.7.0), used when EMBEDDING_QUANTIZATION=binary.
+-- Built without blocking writes by: python db.py vector-index binary [--drop-others]
+-- CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_image_detail_embedding_bits
+-- ON image_detail USING hnsw ((binary_quantize(embedding_vector)::bit(512)) bit_hamming_ops);
+
+
+-- optional: hash-partition image_detail by user_id with local GIST/GIN/HNSW indexes per partition.
+-- Copies the data, recreates every index and trigger on the partitioned table and swaps it in:
+--   python db.py partition --partitions 16 [--keep-old]
+-- New databases are created partitioned when IMAGE_DETAIL_PARTITIONS > 0.
+
+
+-- lease columns for SKIP LOCKED claims, and NOTIFY triggers for the event-driven queue
+ALTER TABLE FileQueue ADD COLUMN claimed_by TEXT, ADD COLUMN claimed_until TIMESTAMP;
+ALTER TABLE BatchQueue ADD COLUMN claimed_by TEXT, ADD COLUMN claimed_until TIMESTAMP;
+
+CREATE INDEX IF NOT EXISTS idx_filequeue_unbatched ON FileQueue (created_at) WHERE batch_id IS NULL AND is_saved_to_db = FALSE;
+
+-- queue events: workers LISTEN on these channels instead of polling
+CREATE
+OR REPLACE FUNCTION notify_channel()
+RETURNS TRIGGER AS $$
+BEGIN
+  PERFORM pg_notify(TG_ARGV[0], '');
+  RETURN NULL;
+END;
+$$
+LANGUAGE 'plpgsql';
+
+CREATE TRIGGER filequeue_new_notify_trigger
+AFTER INSERT ON FileQueue
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_channel('filequeue_new');
+
+CREATE TRIGGER batchqueue_new_notify_trigger
+AFTER INSERT ON BatchQueue
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_channel('batchqueue_new');
+
+CREATE TRIGGER batchqueue_finalized_notify_trigger
+AFTER UPDATE ON BatchQueue
+FOR EACH ROW
+WHEN (NEW.are_all_files_updated_in_db AND NOT OLD.are_all_files_updated_in_db)
+EXECUTE FUNCTION notify_channel('batchqueue_finalized');
+
+CREATE TRIGGER users_new_notify_trigger
+AFTER INSERT ON users
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_channel('users_new');
+
+
+-- leases for singleton background jobs, used by the standalone worker (backend/worker.py)
+CREATE TABLE IF NOT EXISTS worker_lease (
+  name TEXT PRIMARY KEY,
+  owner TEXT NOT NULL,
+  expires_at TIMESTAMP NOT NULL
+);
+
+-- adaptive status polling of running OpenAI batches
+ALTER TABLE BatchQueue ADD COLUMN next_check_at TIMESTAMP;
+
+-- durable queue for syncing titles, captions and tags back to Dropbox
+-- title, caption and tags to sync back to Dropbox, one row per file; later updates coalesce into it
+CREATE TABLE IF NOT EXISTS DropboxWriteback (
+  user_id TEXT NOT NULL,
+  path TEXT NOT NULL,
+  title TEXT,
+  caption TEXT,
+  tags TEXT[] NOT NULL DEFAULT '{}',
+  version INTEGER NOT NULL DEFAULT 1,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  last_error TEXT,
+  next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  claimed_by TEXT,
+  claimed_until TIMESTAMP,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (user_id, path),
+  FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+);
+
+CREATE TRIGGER dropboxwriteback_new_notify_trigger
+AFTER INSERT OR UPDATE OF version ON DropboxWriteback
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_channel('dropboxwriteback_new');
+
+-- Index creation for claiming due Dropbox writebacks
+CREATE INDEX IF NOT EXISTS idx_dropboxwriteback_due ON DropboxWriteback (next_attempt_at);
+
+-- set-based existence check of a Dropbox listing page in the poller
+CREATE INDEX IF NOT EXISTS idx_image_detail_user_url ON image_detail (user_id, url);
+
+-- persistent registry of files that failed to ingest, replacing the worker's in-memory IGNORE_FILES
+CREATE TABLE IF NOT EXISTS IngestFailure (
+  user_id TEXT NOT NULL,
+  path TEXT NOT NULL,
+  content_hash TEXT NOT NULL DEFAULT '',  -- a new version of the file is a new row, tried right away
+  reason TEXT,
+  attempts INTEGER NOT NULL DEFAULT 1,
+  next_retry_at TIMESTAMP NOT NULL,
+  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (user_id, path, content_hash),
+  FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_ingestfailure_due ON IngestFailure (user_id, next_retry_at);
+
+-- work that failed for good (fatal error or out of attempts), kept for `python worker.py redrive`
+CREATE TABLE IF NOT EXISTS DeadLetter (
+  id SERIAL PRIMARY KEY,
+  kind TEXT NOT NULL,  -- upload | polled_file | batch_record | dropbox_writeback
+  key TEXT NOT NULL,
+  user_id TEXT,
+  payload JSONB NOT NULL,
+  error TEXT,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  UNIQUE (kind, key)
+);
+
+-- asynchronous uploads: ingest jobs with per-file progress
+CREATE TABLE IF NOT EXISTS IngestJob (
+  job_id TEXT PRIMARY KEY,
+  user_id TEXT NOT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS IngestJobFile (
+  job_id TEXT NOT NULL,
+  file_id TEXT NOT NULL,
+  user_id TEXT NOT NULL,
+  name TEXT,  -- as uploaded
+  tmp_file_loc TEXT NOT NULL,
+  tags TEXT,
+  status TEXT NOT NULL DEFAULT 'stored',  -- stored | embedded | failed; captioned is read off FileQueue
+  image_id TEXT,
+  error TEXT,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  claimed_by TEXT,
+  claimed_until TIMESTAMP,  -- also holds back a retry
+  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (job_id, file_id),
+  FOREIGN KEY (job_id) REFERENCES IngestJob(job_id) ON DELETE CASCADE
+);
+
+CREATE TRIGGER ingestjobfile_new_notify_trigger
+AFTER INSERT ON IngestJobFile
+FOR EACH STATEMENT
+EXECUTE FUNCTION notify_channel('ingestjobfile_new');
+
+-- Index creation for claiming uploaded files to process
+CREATE INDEX IF NOT EXISTS idx_ingestjobfile_stored ON IngestJobFile (created_at) WHERE status = 'stored';
+
+-- fair share of the background queues among users
+CREATE TABLE IF NOT EXISTS TenantShare (
+  user_id TEXT PRIMARY KEY,
+  weight REAL NOT NULL DEFAULT 1 CHECK (weight > 0),
+  max_per_claim INTEGER CHECK (max_per_claim > 0),  -- NULL: no cap
+  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+);
+
+-- Index creation for numbering each user's unbatched files in fair-share claims
+CREATE INDEX IF NOT EXISTS idx_filequeue_unbatched_user ON FileQueue (user_id, created_at) WHERE batch_id IS NULL AND is_saved_to_db = FALSE;
+
+-- image_facet_rows calls to_char, which is only STABLE
+ALTER FUNCTION image_facet_rows(TEXT, TIMESTAMP, TEXT[]) STABLE;
+
+-- coordinates used to be written as POINT(latitude longitude); rebuild them as POINT(longitude latitude)
+-- from the EXIF values kept in extended_meta, so old and new images agree (safe to run more than once)
+UPDATE image_detail SET coordinates = ST_SetSRID(
+  ST_MakePoint((extended_meta->>'longitude')::float8, (extended_meta->>'latitude')::float8), 4326
+)
+WHERE coordinates IS NOT NULL
+AND extended_meta->>'latitude' IS NOT NULL AND extended_meta->>'longitude' IS NOT NULL;
+
+-- per-user version of the embeddings, bumped on every insert, delete or re-embedding of the user's images,
+-- so process-local copies (vector_search.NumpyBackend) can tell they are stale. Versions come from one
+-- sequence, so they never repeat, even for a deleted and re-created user
+CREATE SEQUENCE IF NOT EXISTS image_embedding_version_seq;
+
+CREATE TABLE IF NOT EXISTS image_embedding_version (
+  user_id TEXT PRIMARY KEY,  -- no foreign key: the trigger writes it while a user's images are cascade-deleted
+  version BIGINT NOT NULL,
+  previous_version BIGINT
+);
+
+-- statement level: one new version per user and statement; an update only counts if the embedding changed
+CREATE
+OR REPLACE FUNCTION bump_embedding_version()
+RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_OP = 'UPDATE' THEN
+    INSERT INTO image_embedding_version (user_id, version)
+    SELECT u.user_id, nextval('image_embedding_version_seq')
+    FROM (
+      SELECT n.user_id FROM new_rows n JOIN old_rows o ON o.uuid = n.uuid
+      WHERE n.embedding_vector IS DISTINCT FROM o.embedding_vector
+      GROUP BY n.user_id
+    ) AS u
+    ON CONFLICT (user_id) DO UPDATE SET
+      previous_version = image_embedding_version.version, version = EXCLUDED.version;
+  ELSE
+    INSERT INTO image_embedding_version (user_id, version)
+    SELECT u.user_id, nextval('image_embedding_version_seq')
+    FROM (SELECT user_id FROM changed_rows GROUP BY user_id) AS u
+    ON CONFLICT (user_id) DO UPDATE SET
+      previous_version = image_embedding_version.version, version = EXCLUDED.version;
+  END IF;
+  RETURN NULL;
+END;
+$$
+LANGUAGE 'plpgsql';
+
+CREATE TRIGGER embedding_version_insert_trigger
+AFTER INSERT ON image_detail
+REFERENCING NEW TABLE AS changed_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION bump_embedding_version();
+
+CREATE TRIGGER embedding_version_update_trigger
+AFTER UPDATE ON image_detail
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION bump_embedding_version();
+
+CREATE TRIGGER embedding_version_delete_trigger
+AFTER DELETE ON image_detail
+REFERENCING OLD TABLE AS changed_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION bump_embedding_version();
+
+-- read-your-writes with PG_REPLICA_DSNS: per user, a WAL position at or past their last committed write.
+-- Reads of the user only go to a replica that replayed up to it. Only read on the primary, so not WAL-logged
+CREATE UNLOGGED TABLE IF NOT EXISTS user_last_write (
+  user_id TEXT PRIMARY KEY,
+  lsn PG_LSN NOT NULL
+);
+
+-- files of OpenAI batches that failed, expired or were cancelled go back in the queue, up to a number of attempts
+ALTER TABLE FileQueue ADD COLUMN IF NOT EXISTS batch_attempts INTEGER NOT NULL DEFAULT 0;
+
+-- Index creation for reading each user's first uploads and due writebacks in fair-share claims
+CREATE INDEX IF NOT EXISTS idx_ingestjobfile_stored_user ON IngestJobFile (user_id, created_at) WHERE status = 'stored';
+CREATE INDEX IF NOT EXISTS idx_dropboxwriteback_due_user ON DropboxWriteback (user_id, next_attempt_at);
+
+-- reads only wait for a user's last write for READ_YOUR_WRITES_SECS after it
+ALTER TABLE user_last_write ADD COLUMN IF NOT EXISTS written_at TIMESTAMP NOT NULL DEFAULT now();
+
+-- uploads are staged in Dropbox upload sessions instead of the API host's /tmp
+ALTER TABLE IngestJobFile ADD COLUMN IF NOT EXISTS upload_session JSONB, ADD COLUMN IF NOT EXISTS content_hash TEXT;
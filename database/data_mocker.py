@@ -13,7 +13,7 @@ DB_HOST = "localhost"
 DB_PORT = "5555"
 
 
-def generate_random_vector(dimensions=768):
+def generate_random_vector(dimensions=512):
     return [random.random() for _ in range(dimensions)]
 
 
@@ -23,8 +23,8 @@ def generate_random_entry():
         f"https://example.com/image{random.randint(1, 1000)}.jpg",  # Random image URL
         sentence(),  # Random title as a sentence
         sentence(),  # Random description as a sentence
-        ', '.join(random.sample(['city', 'skyline', 'night', 'day', 'sunset', 'landscape'], 3)),  # Random tags
-        generate_random_vector(),  # Random vector of 2048 dimensions
+        random.sample(['city', 'skyline', 'night', 'day', 'sunset', 'landscape'], 3),  # Random tags
+        generate_random_vector(),  # Random vector matching VECTOR(512)
         f"POINT({random.uniform(-180.0, 180.0)} {random.uniform(-90.0, 90.0)})",  # Random geographic point
         (datetime.now() - timedelta(days=random.randint(0, 365))).strftime('%Y-%m-%d %H:%M:%S'),
         # Random timestamp within the last year